@@ -1,14 +1,17 @@
 from app.agent.state import AgentState
 from app.agent.graph import workflow, create_agent_workflow
+from app.agent.instrumentation import get_metrics_callback
 
 
 def build_agent_app(checkpointer=None):
     """Compile the workflow with an optional checkpointer.
     
     This function is called from main.py to create the agent
-    with memory persistence support.
+    with memory persistence support. Every run reports agent, node,
+    tool and token metrics through the instrumentation callback.
     """
-    return workflow.compile(checkpointer=checkpointer)
+    compiled = workflow.compile(checkpointer=checkpointer)
+    return compiled.with_config(callbacks=[get_metrics_callback()])
 
 
 # تجميع التطبيق الافتراضي (بدون checkpointer)
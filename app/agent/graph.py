@@ -4,16 +4,27 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-from typing import Literal
+from typing import List, Literal, Union
 from langchain_groq import ChatGroq
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage, message_chunk_to_message
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 from langgraph.graph import StateGraph, END
+from langgraph.types import Send
 
-from app.agent.state import AgentState
+from app.agent.state import AgentState, PlanStep, StepState
+from app.agent.llm_pool import get_llm_registry
+from app.agent.tool_runner import get_tool_runner
+from app.token_budget import budget_exhausted, charge_usage, usage_tokens
 from app.tools.defined_tools import get_tools, web_search, file_writer, python_repl
 
 os.makedirs("data", exist_ok=True)
 
+# Maximum number of independent plan steps executed at the same time
+MAX_PARALLEL_STEPS = max(1, int(os.getenv("PLAN_MAX_PARALLEL_STEPS", "3")))
+
+# Characters of each earlier step's output passed to dependent steps
+STEP_CONTEXT_MAX_CHARS = 2000
+
 
 SYSTEM_PROMPTS = {
     "general": """
@@ -158,43 +169,105 @@ def get_system_prompt(agent_mode: str) -> str:
     return SYSTEM_PROMPTS.get(agent_mode, SYSTEM_PROMPTS["general"])
 
 
-def get_llm(model_name: str = "llama-3.1-8b-instant") -> ChatGroq:
-    """Initialize the Groq LLM with the specified model.
+DEFAULT_MODEL = "llama-3.1-8b-instant"
+
+
+def get_llm(model_name: str = DEFAULT_MODEL) -> ChatGroq:
+    """Get the pooled Groq LLM for the specified model.
     
     Available models:
-    - llama-3.1-8b-instant (Fast)
+    - llama-3.1-8b-instant (Fast, the default)
     - llama-3.3-70b-versatile (Smart)
     """
-    return ChatGroq(
-        model=model_name,
-        api_key=os.getenv("GROQ_API_KEY"),
-        temperature=0
-    )
+    return get_llm_registry().get(model_name, temperature=0)
 
 
-def planner_node(state: AgentState) -> dict:
-    """Analyze the user query and create an execution plan."""
-    model_name = state.get("model_name", "llama-3.1-8b-instant")
-    llm = get_llm(model_name)
-    messages = state.get("messages", [])
-    user_query = messages[-1].content if messages else ""
+def get_tool_llm(model_name: str = DEFAULT_MODEL):
+    """Get the pooled Groq LLM for the specified model with all tools bound."""
+    return get_llm_registry().get_with_tools(model_name, get_tools(), temperature=0)
 
-    planner_instructions = """
+
+PLANNER_INSTRUCTIONS = """
     You are the Planner for Nabd.
-    Break the following request down into clear, sequential steps.
-    Return ONLY a JSON object with a key "plan" containing a list of strings.
-    Example: {"plan": ["search for X", "analyze Y", "write report"]}
+    Break the following request down into clear steps.
+    Steps that do not need each other's results must not depend on each other,
+    so they can run in parallel.
+    Return ONLY a JSON object with a key "plan" containing a list of steps.
+    Each step has an "id", a "task" and a "depends_on" list of earlier step ids.
+    Example: {"plan": [
+        {"id": "s1", "task": "search for X", "depends_on": []},
+        {"id": "s2", "task": "search for Y", "depends_on": []},
+        {"id": "s3", "task": "compare X and Y", "depends_on": ["s1", "s2"]}
+    ]}
     """
+
+EXECUTOR_INSTRUCTIONS = """
+    You MUST use one of the available tools to achieve the objective below.
+    - If you need information, call 'web_search'.
+    - If you need to write a file, call 'file_writer'.
+    - If you need calculations, call 'python_repl'.
     
+    Do not just talk. ACT.
+    """
+
+WRITER_INSTRUCTIONS = """
+    Review all the previous messages and tool outputs.
+    Write a comprehensive, professional response to the original user query.
+    Use Markdown formatting (headers, tables, lists).
+    Support your answer with the data found.
+    """
+
+
+def _planner_messages(state: AgentState) -> list:
+    messages = state.get("messages", [])
+    user_query = messages[-1].content if messages else ""
     system_prompt = get_system_prompt(state.get("agent_mode", "general"))
-    
+
     # 🛡️ SECURITY: Separate instructions from user input to prevent Prompt Injection
-    response = llm.invoke([
+    return [
         SystemMessage(content=system_prompt),
-        SystemMessage(content=planner_instructions),
+        SystemMessage(content=PLANNER_INSTRUCTIONS),
         HumanMessage(content=f"Request: {user_query}")
-    ])
-    
+    ]
+
+
+def _normalize_plan(raw_plan: list) -> List[PlanStep]:
+    """Turn the planner output into PlanSteps with valid, acyclic dependencies.
+
+    Plain strings are treated as a sequential chain (each depends on the
+    previous step). Dependencies may only point at earlier steps; anything
+    else is dropped, which also rules out cycles.
+    """
+    steps: List[PlanStep] = []
+    seen_ids = set()
+    for index, item in enumerate(raw_plan):
+        if isinstance(item, dict):
+            task = str(item.get("task") or item.get("step") or "").strip()
+            step_id = str(item.get("id") or f"s{index + 1}")
+            depends_on = item.get("depends_on") or []
+            if not isinstance(depends_on, list):
+                depends_on = [depends_on]
+            depends_on = [str(dep) for dep in depends_on]
+        else:
+            task = str(item).strip()
+            step_id = f"s{index + 1}"
+            depends_on = [steps[-1]["id"]] if steps else []
+
+        if not task:
+            continue
+        if step_id in seen_ids:
+            step_id = f"{step_id}_{index + 1}"
+
+        steps.append({
+            "id": step_id,
+            "task": task,
+            "depends_on": [dep for dep in dict.fromkeys(depends_on) if dep in seen_ids],
+        })
+        seen_ids.add(step_id)
+    return steps
+
+
+def _plan_update(response) -> dict:
     try:
         content = response.content.strip()
         if "```json" in content:
@@ -203,13 +276,16 @@ def planner_node(state: AgentState) -> dict:
             content = content.split("```")[1].split("```")[0]
             
         plan_data = json.loads(content)
-        plan = plan_data.get("plan", [])
+        plan_steps = _normalize_plan(plan_data.get("plan", []))
     except Exception as e:
         print(f"Planning Error: {e}")
-        plan = ["web_search based on query", "write final summary"]
+        plan_steps = _normalize_plan(["web_search based on query", "write final summary"])
 
+    plan = [step["task"] for step in plan_steps]
     return {
         "plan": plan, 
+        "plan_steps": plan_steps,
+        "step_results": None,
         "current_step": plan[0] if plan else "Complete",
         "current_step_index": 0,
         "tools_output": {},
@@ -218,56 +294,158 @@ def planner_node(state: AgentState) -> dict:
     }
 
 
-def executor_node(state: AgentState) -> dict:
-    """Execute the current step using appropriate tools."""
-    plan = state.get("plan", [])
-    if not plan:
-        return {"current_step": "done"}
+def planner_node(state: AgentState, config: RunnableConfig) -> dict:
+    """Analyze the user query and create an execution plan."""
+    model_name = state.get("model_name", DEFAULT_MODEL)
+    prompt = _planner_messages(state)
+    response = get_llm(model_name).invoke(prompt)
+    charge_usage(config, usage_tokens(response, prompt))
+    return _plan_update(response)
 
-    current_task = plan[0]
-    remaining_plan = plan[1:]
-    
-    model_name = state.get("model_name", "llama-3.1-8b-instant")
-    tools = get_tools()
-    llm = get_llm(model_name).bind_tools(tools)
+
+async def aplanner_node(state: AgentState, config: RunnableConfig) -> dict:
+    """Async variant of planner_node."""
+    model_name = state.get("model_name", DEFAULT_MODEL)
+    prompt = _planner_messages(state)
+    response = await get_llm(model_name).ainvoke(prompt)
+    charge_usage(config, usage_tokens(response, prompt))
+    return _plan_update(response)
+
+
+def _executor_messages(state: StepState) -> list:
+    system_prompt = get_system_prompt(state.get("agent_mode", "general"))
+
+    # 🛡️ SECURITY: Separate instructions from task content
+    messages = [
+        SystemMessage(content=system_prompt),
+        SystemMessage(content=EXECUTOR_INSTRUCTIONS),
+        HumanMessage(content=f"Current Objective: {state['step']['task']}")
+    ]
+    context = state.get("context") or {}
+    if context:
+        results = "\n\n".join(
+            f"[{task}]\n{str(output)[:STEP_CONTEXT_MAX_CHARS]}" for task, output in context.items()
+        )
+        messages.append(HumanMessage(content=f"Results from earlier steps:\n{results}"))
+    return messages
+
+
+def _step_output(step_messages: list) -> str:
+    """Combine tool results and the model's final words into one step output."""
+    parts = [
+        str(message.content) for message in step_messages
+        if isinstance(message, ToolMessage) and message.content
+    ]
+    last = step_messages[-1] if step_messages else None
+    if isinstance(last, AIMessage) and last.content:
+        parts.append(str(last.content))
+    return "\n\n".join(parts)
+
+
+def _executed_update(state: StepState, step_messages: list) -> dict:
+    return {
+        "messages": step_messages,
+        "step_results": {state["step"]["id"]: _step_output(step_messages)}
+    }
+
+
+# Shown in place of model output once the client's token budget is spent
+BUDGET_EXHAUSTED_NOTE = "Stopped early: the token budget for this user is exhausted."
+
+
+def _failed_update(state: StepState, step_messages: list, error: Exception) -> dict:
+    message = f"Error executing step: {str(error)}"
+    return {
+        "messages": step_messages + [AIMessage(content=message)],
+        "step_results": {state["step"]["id"]: message}
+    }
+
+
+def executor_node(state: StepState, config: RunnableConfig) -> dict:
+    """Execute one plan step, running the tools the model asks for.
+
+    Each model turn's tool calls run concurrently through the ToolRunner and
+    their ToolMessages are fed back, for up to max_rounds turns.
+    """
+    model_name = state.get("model_name") or DEFAULT_MODEL
+    llm = get_tool_llm(model_name)
+    runner = get_tool_runner()
+    messages = _executor_messages(state)
+    step_messages = []
     
-    executor_instructions = """
-    You MUST use one of the available tools to achieve the objective below.
-    - If you need information, call 'web_search'.
-    - If you need to write a file, call 'file_writer'.
-    - If you need calculations, call 'python_repl'.
+    tokens = 0
     
-    Do not just talk. ACT.
-    """
+    try:
+        for _ in range(runner.config.max_rounds):
+            if budget_exhausted(config):
+                step_messages.append(AIMessage(content=BUDGET_EXHAUSTED_NOTE))
+                break
+            result = llm.invoke(messages, config)
+            tokens += usage_tokens(result, messages)
+            step_messages.append(result)
+            if not result.tool_calls:
+                break
+            tool_messages = runner.run(result.tool_calls, config)
+            step_messages.extend(tool_messages)
+            messages = messages + [result] + tool_messages
+        return _executed_update(state, step_messages)
+    except Exception as e:
+        return _failed_update(state, step_messages, e)
+    finally:
+        charge_usage(config, tokens)
+
+
+async def aexecutor_node(state: StepState, config: RunnableConfig) -> dict:
+    """Async variant of executor_node."""
+    model_name = state.get("model_name") or DEFAULT_MODEL
+    llm = get_tool_llm(model_name)
+    runner = get_tool_runner()
+    messages = _executor_messages(state)
+    step_messages = []
     
-    system_prompt = get_system_prompt(state.get("agent_mode", "general"))
+    tokens = 0
     
-    # 🛡️ SECURITY: Separate instructions from task content
     try:
-        result = llm.invoke([
-            SystemMessage(content=system_prompt),
-            SystemMessage(content=executor_instructions),
-            HumanMessage(content=f"Current Objective: {current_task}")
-        ])
-        
-        return {
-            "plan": remaining_plan,
-            "current_step": f"executed: {current_task}",
-            "messages": [result],
-            "tools_output": {current_task: result.content}
-        }
-        
+        for _ in range(runner.config.max_rounds):
+            if budget_exhausted(config):
+                step_messages.append(AIMessage(content=BUDGET_EXHAUSTED_NOTE))
+                break
+            result = await llm.ainvoke(messages, config)
+            tokens += usage_tokens(result, messages)
+            step_messages.append(result)
+            if not result.tool_calls:
+                break
+            tool_messages = await runner.arun(result.tool_calls, config)
+            step_messages.extend(tool_messages)
+            messages = messages + [result] + tool_messages
+        return _executed_update(state, step_messages)
     except Exception as e:
-        return {
-            "plan": remaining_plan,
-            "current_step": f"failed: {current_task}",
-            "messages": [AIMessage(content=f"Error executing step: {str(e)}")]
-        }
+        return _failed_update(state, step_messages, e)
+    finally:
+        charge_usage(config, tokens)
+
+
+def join_node(state: AgentState) -> dict:
+    """Collect finished steps into tools_output in plan order."""
+    plan_steps = state.get("plan_steps", [])
+    step_results = state.get("step_results") or {}
+
+    tools_output = {
+        step["task"]: step_results[step["id"]]
+        for step in plan_steps if step["id"] in step_results
+    }
+    remaining = [step["task"] for step in plan_steps if step["id"] not in step_results]
+    return {
+        "plan": remaining,
+        "tools_output": tools_output,
+        "current_step_index": len(tools_output),
+        "current_step": remaining[0] if remaining else "Complete",
+    }
 
 
 def reviewer_node(state: AgentState) -> dict:
     """Review the execution results and decide next steps."""
-    model_name = state.get("model_name", "llama-3.1-8b-instant")
+    model_name = state.get("model_name", DEFAULT_MODEL)
     llm = get_llm(model_name)
     
     plan = state.get("plan", [])
@@ -343,20 +521,34 @@ Only respond with the JSON, no other text."""
         }
 
 
-def writer_node(state: AgentState) -> dict:
-    """Compile all gathered data into a final report."""
-    llm = get_llm()
+def _writer_messages(state: AgentState) -> list:
     messages = state.get("messages", [])
     system_prompt = get_system_prompt(state.get("agent_mode", "general"))
-    
-    writer_prompt = """
-    Review all the previous messages and tool outputs.
-    Write a comprehensive, professional response to the original user query.
-    Use Markdown formatting (headers, tables, lists).
-    Support your answer with the data found.
-    """
-    
-    final_response = llm.invoke([SystemMessage(content=system_prompt)] + messages + [HumanMessage(content=writer_prompt)])
+    return [SystemMessage(content=system_prompt)] + messages + [HumanMessage(content=WRITER_INSTRUCTIONS)]
+
+
+def _degraded_update(state: AgentState) -> dict:
+    """Final answer built from step outputs alone, without another model call."""
+    tools_output = state.get("tools_output") or {}
+    sections = [f"### {task}\n{str(output)[:STEP_CONTEXT_MAX_CHARS]}" for task, output in tools_output.items()]
+    report = "\n\n".join(
+        ["عذراً، تم استهلاك حصة الاستخدام المتاحة لك مؤقتاً. هذه النتائج التي جُمعت حتى الآن:"] + sections
+    )
+    final_response = AIMessage(content=report)
+    return {
+        "final_report": report,
+        "messages": [final_response]
+    }
+
+
+def writer_node(state: AgentState, config: RunnableConfig) -> dict:
+    """Compile all gathered data into a final report."""
+    if budget_exhausted(config):
+        return _degraded_update(state)
+
+    prompt = _writer_messages(state)
+    final_response = get_llm().invoke(prompt)
+    charge_usage(config, usage_tokens(final_response, prompt))
     
     return {
         "final_report": final_response.content,
@@ -364,27 +556,83 @@ def writer_node(state: AgentState) -> dict:
     }
 
 
-def check_plan(state: AgentState) -> Literal["executor", "writer"]:
-    """Check if there are remaining steps in the plan."""
-    if state.get("plan") and len(state["plan"]) > 0:
-        return "executor"
-    return "writer"
+async def awriter_node(state: AgentState, config: RunnableConfig) -> dict:
+    """Async variant of writer_node; streams the report from the model."""
+    if budget_exhausted(config):
+        return _degraded_update(state)
 
+    prompt = _writer_messages(state)
+    final_response = None
+    async for chunk in get_llm().astream(prompt):
+        final_response = chunk if final_response is None else final_response + chunk
 
-def create_agent_workflow() -> StateGraph:
+    if final_response is None:
+        final_response = AIMessage(content="")
+    else:
+        final_response = message_chunk_to_message(final_response)
+    charge_usage(config, usage_tokens(final_response, prompt))
+    
+    return {
+        "final_report": final_response.content,
+        "messages": [final_response]
+    }
+
+
+def schedule_steps(state: AgentState) -> Union[List[Send], Literal["writer"]]:
+    """Fan out every step whose dependencies are done, up to MAX_PARALLEL_STEPS.
+
+    Steps beyond the limit, and steps waiting on running ones, are picked up
+    after the join that follows this wave.
+    """
+    plan_steps = state.get("plan_steps", [])
+    step_results = state.get("step_results") or {}
+    tasks_by_id = {step["id"]: step["task"] for step in plan_steps}
+
+    ready = [
+        step for step in plan_steps
+        if step["id"] not in step_results
+        and all(dep in step_results for dep in step["depends_on"])
+    ]
+    if not ready:
+        return "writer"
+
+    return [
+        Send("executor", {
+            "step": step,
+            "context": {tasks_by_id[dep]: step_results[dep] for dep in step["depends_on"]},
+            "agent_mode": state.get("agent_mode", "general"),
+            "model_name": state.get("model_name", DEFAULT_MODEL),
+        })
+        for step in ready[:MAX_PARALLEL_STEPS]
+    ]
+
+
+def _node(name: str, func, afunc, use_async: bool):
+    """Wrap a node so the graph uses `afunc` under ainvoke and `func` under invoke."""
+    if not use_async:
+        return func
+    return RunnableLambda(func, afunc=afunc, name=name)
+
+
+def create_agent_workflow(use_async: bool = True) -> StateGraph:
     """Create the agent state graph (without compilation).
     
     The graph will be compiled in main.py with AsyncSqliteSaver for persistence.
+    With `use_async` the nodes run natively on the event loop under
+    ainvoke/astream_events; invoke() keeps using the sync variants.
     """
     workflow = StateGraph(AgentState)
     
-    workflow.add_node("planner", planner_node)
-    workflow.add_node("executor", executor_node)
-    workflow.add_node("writer", writer_node)
+    workflow.add_node("planner", _node("planner", planner_node, aplanner_node, use_async))
+    workflow.add_node("executor", _node("executor", executor_node, aexecutor_node, use_async))
+    workflow.add_node("writer", _node("writer", writer_node, awriter_node, use_async))
+    
+    workflow.add_node("join", join_node)
     
     workflow.set_entry_point("planner")
-    workflow.add_edge("planner", "executor")
-    workflow.add_conditional_edges("executor", check_plan)
+    workflow.add_conditional_edges("planner", schedule_steps, ["executor", "writer"])
+    workflow.add_edge("executor", "join")
+    workflow.add_conditional_edges("join", schedule_steps, ["executor", "writer"])
     workflow.add_edge("writer", END)
     
     return workflow
@@ -0,0 +1,188 @@
+"""
+Graph instrumentation for the Nabd agent.
+
+A LangChain callback handler, attached to the compiled graph in
+build_agent_app(), that feeds NabdMetrics from inside a run:
+
+- the whole run: agent_requests_total / agent_request_duration_seconds
+- each planner / executor / writer node: agent_node_duration_seconds
+- each tool call: tool_calls_total / tool_call_duration_seconds
+- model calls: prompt and completion tokens per model, from the
+  provider's usage metadata
+- errors by exception type: agent_errors_total
+"""
+
+import asyncio
+import time
+from typing import Any, Dict, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from app.metrics import get_metrics
+
+
+# Graph nodes timed individually
+TIMED_NODES = ("planner", "executor", "writer")
+# Open runs remembered at most; runs that never report an end (e.g. a
+# cancelled tool call) are forgotten oldest first past this
+MAX_OPEN_RUNS = 10_000
+
+
+class _Run:
+    """An open run: what it is, when it started, and the graph run it belongs to."""
+    __slots__ = ("kind", "name", "start", "root")
+
+    def __init__(self, kind: str, name: str, root: UUID):
+        self.kind = kind
+        self.name = name
+        self.start = time.perf_counter()
+        self.root = root
+
+
+class _Root:
+    """Per graph run: labels for its metrics and errors already counted."""
+    __slots__ = ("mode", "model", "errors")
+
+    def __init__(self, mode: str, model: Optional[str]):
+        self.mode = mode
+        self.model = model
+        self.errors: set = set()
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Records agent, node, tool and token metrics from graph callbacks."""
+
+    # Only dict updates and metric increments; no need for a thread hop
+    run_inline = True
+
+    def __init__(self):
+        self._runs: Dict[UUID, _Run] = {}
+        self._roots: Dict[UUID, _Root] = {}
+
+    def _open(self, run_id: UUID, kind: str, name: str, root: UUID):
+        if len(self._runs) >= MAX_OPEN_RUNS:
+            stale = self._runs.pop(next(iter(self._runs)), None)
+            if stale is not None and stale.kind == "graph":
+                self._roots.pop(stale.root, None)
+        self._runs[run_id] = _Run(kind, name, root)
+
+    def _root_of(self, parent_run_id: Optional[UUID]) -> Optional[UUID]:
+        parent = self._runs.get(parent_run_id) if parent_run_id else None
+        return parent.root if parent else None
+
+    def _count_error(self, root_id: UUID, error: BaseException):
+        """Count an error once per graph run, even as it propagates through parent runs."""
+        root = self._roots.get(root_id)
+        if root is None or id(error) in root.errors or isinstance(error, asyncio.CancelledError):
+            # Cancelled runs (client disconnects) are counted by agent_runs_cancelled_total
+            return
+        root.errors.add(id(error))
+        get_metrics().agent_errors_total.inc({"mode": root.mode, "error_type": type(error).__name__})
+
+    # ─── Chains: the graph run and its nodes ───
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Any, *, run_id: UUID,
+                       parent_run_id: Optional[UUID] = None, metadata: Optional[dict] = None, **kwargs: Any):
+        name = kwargs.get("name") or ""
+        if parent_run_id is None:
+            state = inputs if isinstance(inputs, dict) else {}
+            self._roots[run_id] = _Root(state.get("agent_mode") or "general", state.get("model_name"))
+            self._open(run_id, "graph", name, run_id)
+            return
+        root = self._root_of(parent_run_id)
+        if root is None:
+            return
+        parent = self._runs[parent_run_id]
+        is_node = (
+            name in TIMED_NODES
+            and (metadata or {}).get("langgraph_node") == name
+            # A node's inner runnable carries the node's name too
+            and not (parent.kind == "node" and parent.name == name)
+        )
+        self._open(run_id, "node" if is_node else "chain", name, root)
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any):
+        self._finish_chain(run_id, None)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._finish_chain(run_id, error)
+
+    def _finish_chain(self, run_id: UUID, error: Optional[BaseException]):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        duration = time.perf_counter() - run.start
+        metrics = get_metrics()
+        if run.kind == "node":
+            status = "success" if error is None else "error"
+            metrics.agent_node_duration_seconds.observe(duration, {"node": run.name, "status": status})
+        elif run.kind == "graph":
+            if error is not None:
+                self._count_error(run_id, error)
+            root = self._roots.pop(run_id, None)
+            if root is not None:
+                metrics.record_agent_request(root.mode, root.model or "unknown", duration)
+
+    # ─── Tools ───
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID,
+                      parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        root = self._root_of(parent_run_id)
+        if root is not None:
+            self._open(run_id, "tool", kwargs.get("name") or serialized.get("name") or "unknown", root)
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any):
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            get_metrics().record_tool_call(run.name, time.perf_counter() - run.start, success=True)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            get_metrics().record_tool_call(run.name, time.perf_counter() - run.start, success=False)
+            self._count_error(run.root, error)
+
+    # ─── Model calls ───
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: Any, *, run_id: UUID,
+                            parent_run_id: Optional[UUID] = None, metadata: Optional[dict] = None,
+                            **kwargs: Any):
+        root = self._root_of(parent_run_id)
+        if root is None:
+            return
+        model = (metadata or {}).get("ls_model_name") or "unknown"
+        self._open(run_id, "llm", model, root)
+        if self._roots.get(root) and self._roots[root].model is None:
+            self._roots[root].model = model
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        input_tokens = output_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                input_tokens += usage.get("input_tokens", 0)
+                output_tokens += usage.get("output_tokens", 0)
+        if input_tokens or output_tokens:
+            get_metrics().record_tokens(input_tokens, output_tokens, run.name)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            self._count_error(run.root, error)
+
+
+# Singleton instance
+_metrics_callback = None
+
+
+def get_metrics_callback() -> MetricsCallbackHandler:
+    """Get the global graph instrumentation handler."""
+    global _metrics_callback
+    if _metrics_callback is None:
+        _metrics_callback = MetricsCallbackHandler()
+    return _metrics_callback
@@ -0,0 +1,153 @@
+"""
+Process-wide LLM client registry for the Nabd agent graph.
+
+Graph nodes used to build a fresh ChatGroq (and a fresh HTTP client) on
+every step, and the executor re-ran bind_tools() each time. The registry
+below keeps one ChatGroq per (model, temperature) and one tool-bound
+runnable per (model, temperature, tool set), all sharing keep-alive
+connection pools.
+"""
+
+import os
+import threading
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence, Tuple
+
+import httpx
+from langchain_core.runnables import Runnable
+from langchain_groq import ChatGroq
+
+from app.metrics import get_metrics
+
+
+@dataclass
+class LLMPoolConfig:
+    """Connection pool settings shared by all pooled LLM clients."""
+    # Maximum number of concurrent connections to the provider
+    max_connections: int = 100
+    # Idle connections kept open for reuse
+    max_keepalive_connections: int = 20
+    # Seconds an idle connection stays in the pool
+    keepalive_expiry: float = 30.0
+    # Per-request timeout in seconds
+    request_timeout: float = 60.0
+
+
+class LLMClientRegistry:
+    """Caches ChatGroq clients and tool-bound runnables for reuse."""
+
+    def __init__(self, config: Optional[LLMPoolConfig] = None):
+        self.config = config or LLMPoolConfig()
+        self._load_env_config()
+        self._lock = threading.Lock()
+        self._clients: Dict[Tuple[str, float], ChatGroq] = {}
+        self._bound: Dict[Tuple[str, float, Tuple[str, ...]], Runnable] = {}
+        self._http_client: Optional[httpx.Client] = None
+        self._http_async_client: Optional[httpx.AsyncClient] = None
+
+    def _load_env_config(self):
+        """Load configuration from environment variables."""
+        if os.getenv("LLM_POOL_MAX_CONNECTIONS"):
+            self.config.max_connections = int(os.getenv("LLM_POOL_MAX_CONNECTIONS"))
+        if os.getenv("LLM_POOL_MAX_KEEPALIVE"):
+            self.config.max_keepalive_connections = int(os.getenv("LLM_POOL_MAX_KEEPALIVE"))
+        if os.getenv("LLM_POOL_KEEPALIVE_SEC"):
+            self.config.keepalive_expiry = float(os.getenv("LLM_POOL_KEEPALIVE_SEC"))
+        if os.getenv("LLM_REQUEST_TIMEOUT_SEC"):
+            self.config.request_timeout = float(os.getenv("LLM_REQUEST_TIMEOUT_SEC"))
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.config.max_connections,
+            max_keepalive_connections=self.config.max_keepalive_connections,
+            keepalive_expiry=self.config.keepalive_expiry,
+        )
+
+    def _build_client(self, model_name: str, temperature: float) -> ChatGroq:
+        # Called with self._lock held
+        if self._http_client is None:
+            self._http_client = httpx.Client(
+                limits=self._limits(), timeout=self.config.request_timeout
+            )
+        if self._http_async_client is None:
+            self._http_async_client = httpx.AsyncClient(
+                limits=self._limits(), timeout=self.config.request_timeout
+            )
+        return ChatGroq(
+            model=model_name,
+            api_key=os.getenv("GROQ_API_KEY"),
+            temperature=temperature,
+            http_client=self._http_client,
+            http_async_client=self._http_async_client,
+        )
+
+    def get(self, model_name: str, temperature: float = 0.0) -> ChatGroq:
+        """Return the pooled client for (model, temperature)."""
+        key = (model_name, float(temperature))
+        client = self._clients.get(key)
+        if client is not None:
+            get_metrics().record_llm_client_lookup("client", hit=True)
+            return client
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._build_client(model_name, temperature)
+                self._clients[key] = client
+                get_metrics().record_llm_client_lookup("client", hit=False)
+            else:
+                get_metrics().record_llm_client_lookup("client", hit=True)
+        return client
+
+    def get_with_tools(self, model_name: str, tools: Sequence, temperature: float = 0.0) -> Runnable:
+        """Return the pooled client for (model, temperature) with `tools` bound.
+
+        The tool set is keyed by tool name, so the schemas are serialized
+        once per process rather than once per executor step.
+        """
+        key = (model_name, float(temperature), tuple(sorted(t.name for t in tools)))
+        bound = self._bound.get(key)
+        if bound is not None:
+            get_metrics().record_llm_client_lookup("bound", hit=True)
+            return bound
+
+        llm = self.get(model_name, temperature)
+        with self._lock:
+            bound = self._bound.get(key)
+            if bound is None:
+                bound = llm.bind_tools(list(tools))
+                self._bound[key] = bound
+                get_metrics().record_llm_client_lookup("bound", hit=False)
+            else:
+                get_metrics().record_llm_client_lookup("bound", hit=True)
+        return bound
+
+    def clear(self):
+        """Drop all cached clients (the HTTP pools stay open)."""
+        with self._lock:
+            self._clients.clear()
+            self._bound.clear()
+
+    async def aclose(self):
+        """Close the shared HTTP pools and drop all cached clients."""
+        with self._lock:
+            http_client, self._http_client = self._http_client, None
+            http_async_client, self._http_async_client = self._http_async_client, None
+            self._clients.clear()
+            self._bound.clear()
+        if http_async_client is not None:
+            await http_async_client.aclose()
+        if http_client is not None:
+            http_client.close()
+
+
+# Singleton instance
+_registry = None
+
+
+def get_llm_registry() -> LLMClientRegistry:
+    """Get the global LLM client registry."""
+    global _registry
+    if _registry is None:
+        _registry = LLMClientRegistry()
+    return _registry
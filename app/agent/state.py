@@ -3,9 +3,27 @@ from langchain_core.messages import BaseMessage
 from langgraph.graph.message import add_messages
 
 
+def merge_step_results(left: Optional[Dict[str, Any]], right: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Merge results written by parallel executor steps.
+
+    Writing None resets the results (the planner does this at the start of a run).
+    """
+    if right is None:
+        return {}
+    return {**(left or {}), **right}
+
+
+class PlanStep(TypedDict):
+    id: str
+    task: str
+    depends_on: List[str]
+
+
 class AgentState(TypedDict):
     messages: Annotated[List[BaseMessage], add_messages]
     plan: List[str]
+    plan_steps: List[PlanStep]
+    step_results: Annotated[Dict[str, Any], merge_step_results]
     current_step: str
     current_step_index: int
     tools_output: Dict[str, Any]
@@ -16,3 +34,10 @@ class AgentState(TypedDict):
     image_path: Optional[str]
     model_name: str
 
+
+class StepState(TypedDict):
+    """Input sent to one executor run when the plan fans out."""
+    step: PlanStep
+    context: Dict[str, Any]
+    agent_mode: str
+    model_name: str
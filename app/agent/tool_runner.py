@@ -0,0 +1,171 @@
+"""
+Tool execution stage for the plan/execute graph.
+
+Runs every tool call from one model turn at the same time, bounded by a
+per-tool concurrency limit and a per-tool timeout, and returns the results
+as ToolMessages in the order the model requested them.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+from langchain_core.messages import ToolMessage
+from langchain_core.runnables import RunnableConfig
+
+from app.tools.defined_tools import get_tools
+
+
+def _parse_overrides(raw: str) -> Dict[str, float]:
+    """Parse 'tool=value,tool=value' into a dict."""
+    overrides = {}
+    for item in raw.split(","):
+        name, sep, value = item.partition("=")
+        if sep and name.strip() and value.strip():
+            overrides[name.strip()] = float(value)
+    return overrides
+
+
+@dataclass
+class ToolRunnerConfig:
+    """Limits applied when executing tool calls."""
+    # Seconds a single tool call may take before it is reported as timed out
+    default_timeout: float = 30.0
+    # Concurrent calls allowed per tool, across all runs in this process
+    default_concurrency: int = 4
+    # Per-tool overrides
+    timeouts: Dict[str, float] = field(default_factory=lambda: {
+        "browse_website": 60.0,
+        "python_repl": 60.0,
+    })
+    concurrency: Dict[str, int] = field(default_factory=lambda: {
+        "browse_website": 2,
+        "python_repl": 2,
+        "generate_image": 2,
+    })
+    # Model turns per plan step (each turn may request a batch of tool calls)
+    max_rounds: int = 3
+
+
+class ToolRunner:
+    """Executes batches of tool calls with per-tool limits."""
+
+    def __init__(self, tools: Sequence, config: Optional[ToolRunnerConfig] = None):
+        self.config = config or ToolRunnerConfig()
+        self._load_env_config()
+        self.tools = {t.name: t for t in tools}
+        self._thread_limits = {
+            name: threading.BoundedSemaphore(self._concurrency_for(name)) for name in self.tools
+        }
+        self._async_limits: Dict[str, asyncio.Semaphore] = {}
+        self._async_loop = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=sum(self._concurrency_for(name) for name in self.tools) or 1,
+            thread_name_prefix="nabd-tool",
+        )
+
+    def _load_env_config(self):
+        """Load configuration from environment variables."""
+        if os.getenv("TOOL_TIMEOUT_SEC"):
+            self.config.default_timeout = float(os.getenv("TOOL_TIMEOUT_SEC"))
+        if os.getenv("TOOL_MAX_CONCURRENCY"):
+            self.config.default_concurrency = int(os.getenv("TOOL_MAX_CONCURRENCY"))
+        if os.getenv("TOOL_TIMEOUTS"):
+            self.config.timeouts.update(_parse_overrides(os.getenv("TOOL_TIMEOUTS")))
+        if os.getenv("TOOL_CONCURRENCY"):
+            self.config.concurrency.update(
+                {name: int(value) for name, value in _parse_overrides(os.getenv("TOOL_CONCURRENCY")).items()}
+            )
+        if os.getenv("EXECUTOR_MAX_TOOL_ROUNDS"):
+            self.config.max_rounds = int(os.getenv("EXECUTOR_MAX_TOOL_ROUNDS"))
+
+    def _timeout_for(self, name: str) -> float:
+        return self.config.timeouts.get(name, self.config.default_timeout)
+
+    def _concurrency_for(self, name: str) -> int:
+        return max(1, self.config.concurrency.get(name, self.config.default_concurrency))
+
+    def _async_limit(self, name: str) -> asyncio.Semaphore:
+        # Semaphores belong to one event loop; rebuild them if scripts run several loops
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            self._async_loop = loop
+            self._async_limits = {}
+        if name not in self._async_limits:
+            self._async_limits[name] = asyncio.Semaphore(self._concurrency_for(name))
+        return self._async_limits[name]
+
+    @staticmethod
+    def _message(call: dict, content, status: str = "success") -> ToolMessage:
+        return ToolMessage(
+            content=str(content),
+            tool_call_id=call.get("id") or "",
+            name=call.get("name"),
+            status=status,
+        )
+
+    async def _arun_one(self, call: dict, config: Optional[RunnableConfig]) -> ToolMessage:
+        name = call.get("name")
+        tool = self.tools.get(name)
+        if tool is None:
+            return self._message(call, f"Error: unknown tool '{name}'.", status="error")
+
+        timeout = self._timeout_for(name)
+        async with self._async_limit(name):
+            try:
+                output = await asyncio.wait_for(tool.ainvoke(call.get("args", {}), config), timeout)
+            except asyncio.TimeoutError:
+                return self._message(call, f"Error: {name} timed out after {timeout:g}s.", status="error")
+            except Exception as e:
+                return self._message(call, f"Error: {name} failed: {str(e)}", status="error")
+        return self._message(call, output)
+
+    async def arun(self, tool_calls: List[dict], config: Optional[RunnableConfig] = None) -> List[ToolMessage]:
+        """Run all tool calls concurrently; results keep the request order."""
+        return list(await asyncio.gather(*(self._arun_one(call, config) for call in tool_calls)))
+
+    def _run_one(self, call: dict, config: Optional[RunnableConfig]):
+        name = call.get("name")
+        with self._thread_limits[name]:
+            return self.tools[name].invoke(call.get("args", {}), config)
+
+    def run(self, tool_calls: List[dict], config: Optional[RunnableConfig] = None) -> List[ToolMessage]:
+        """Sync variant of arun() for scripts; tools run on a bounded thread pool."""
+        started = time.monotonic()
+        futures = [
+            self._executor.submit(self._run_one, call, config) if call.get("name") in self.tools else None
+            for call in tool_calls
+        ]
+
+        messages = []
+        for call, future in zip(tool_calls, futures):
+            name = call.get("name")
+            if future is None:
+                messages.append(self._message(call, f"Error: unknown tool '{name}'.", status="error"))
+                continue
+            timeout = self._timeout_for(name)
+            try:
+                remaining = max(0.0, started + timeout - time.monotonic())
+                messages.append(self._message(call, future.result(timeout=remaining)))
+            except FutureTimeoutError:
+                future.cancel()
+                messages.append(self._message(call, f"Error: {name} timed out after {timeout:g}s.", status="error"))
+            except Exception as e:
+                messages.append(self._message(call, f"Error: {name} failed: {str(e)}", status="error"))
+        return messages
+
+
+# Singleton instance
+_tool_runner = None
+
+
+def get_tool_runner() -> ToolRunner:
+    """Get the global tool runner for the agent's tool set."""
+    global _tool_runner
+    if _tool_runner is None:
+        _tool_runner = ToolRunner(get_tools())
+    return _tool_runner
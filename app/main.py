@@ -1,9 +1,11 @@
+import asyncio
+import json
 import os
 import uvicorn
-from contextlib import asynccontextmanager
-from typing import List, Optional, Dict, AsyncGenerator
+from contextlib import aclosing, asynccontextmanager, suppress
+from typing import List, Optional, Dict, AsyncGenerator, Tuple
 from uuid import uuid4
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
@@ -18,8 +20,15 @@ from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 load_dotenv()
 
 from app.agent import build_agent_app, agent_app as fallback_agent_app
+from app.agent.graph import DEFAULT_MODEL
+from app.agent.llm_pool import get_llm_registry
+from app.tools.browser_pool import get_browser_pool
+from app.sandbox import get_sandbox_pool, close_sandbox_pool
 from app.rate_limiter import RateLimitMiddleware, get_rate_limiter
-from app.metrics import MetricsMiddleware, get_metrics, metrics_endpoint
+from app.token_budget import budget_config, estimate_tokens, get_token_budget
+from app.metrics import MetricsMiddleware, StreamRecorder, get_metrics, metrics_endpoint
+from app.sse import SSEEmitter, SSEFrame
+from app.response_cache import StreamFlight, ToolUseTracker, get_response_cache
 
 def _normalize_backend(raw: Optional[str]) -> str:
     if not raw:
@@ -66,11 +75,22 @@ async def lifespan(app: FastAPI):
     checkpointer, cm = await init_checkpointer()
     app.state.agent_app = build_agent_app(checkpointer=checkpointer)
     app.state.checkpointer_cm = cm
+    browser_pool = get_browser_pool()
+    try:
+        await browser_pool.start()
+    except Exception as exc:
+        print(f"Browser pool disabled: {exc}")
+    if (os.getenv("PYTHON_TOOL_MODE") or "").strip().lower() == "docker":
+        # Start warming sandbox containers before the first python_repl call
+        get_sandbox_pool()
     try:
         yield
     finally:
         if cm:
             await cm.__aexit__(None, None, None)
+        await browser_pool.stop()
+        close_sandbox_pool()
+        await get_llm_registry().aclose()
 
 # --- إعدادات التطبيق ---
 app = FastAPI(
@@ -181,8 +201,57 @@ def _get_agent_app():
     return getattr(app.state, "agent_app", fallback_agent_app)
 
 
-def _invoke_config(session_id: str) -> Dict[str, Dict[str, str]]:
-    return {"configurable": {"thread_id": session_id}}
+def _invoke_config(session_id: str, budget: Optional[Dict[str, str]] = None, callbacks: Optional[list] = None) -> dict:
+    config = {"configurable": {"thread_id": session_id, **(budget or {})}}
+    if callbacks:
+        config["callbacks"] = callbacks
+    return config
+
+
+def _request_mode(request: ChatRequest) -> str:
+    return request.mode if request.mode in SYSTEM_PROMPTS else "general"
+
+
+def _response_cache_key(request: ChatRequest) -> Optional[str]:
+    """Response cache key, or None when the request must run the graph.
+
+    Requests that continue a session are never served from the cache: their
+    answer depends on the checkpointed thread, not just the request body.
+    """
+    cache = get_response_cache()
+    if not cache.enabled or request.session_id:
+        return None
+    return cache.key(_request_mode(request), DEFAULT_MODEL, request.message, request.history)
+
+
+def _budget_spent(budget: Optional[Dict[str, str]]) -> bool:
+    """True when the client ran out of tokens, so the answer may be a degraded one."""
+    if budget is None:
+        return False
+    return get_token_budget().remaining(budget["budget_key"], budget["budget_tier"]) <= 0
+
+
+def _check_token_budget(http_request: Request, request: ChatRequest) -> Optional[Dict[str, str]]:
+    """Reject early if the prompt alone exceeds the client's remaining tokens.
+
+    Returns the configurable entries that bill the run to the client, or
+    None when token budgets are disabled.
+    """
+    token_budget = get_token_budget()
+    if not token_budget.enabled:
+        return None
+
+    key, tier = get_rate_limiter().client_identity(http_request)
+    allowed, retry_after = token_budget.check(key, tier, estimate_tokens(build_messages(request)))
+    if not allowed:
+        if retry_after is None:
+            raise HTTPException(status_code=413, detail="الرسالة أطول من الحد المسموح به لحسابك.")
+        raise HTTPException(
+            status_code=429,
+            detail="تم استهلاك حصة الاستخدام المتاحة لك مؤقتاً. يرجى المحاولة لاحقاً.",
+            headers={"Retry-After": str(retry_after)},
+        )
+    return budget_config(key, tier)
 
 def build_messages(request: ChatRequest) -> List[BaseMessage]:
     selected_system_prompt = SYSTEM_PROMPTS.get(request.mode, SYSTEM_PROMPTS["general"])
@@ -200,15 +269,6 @@ def build_messages(request: ChatRequest) -> List[BaseMessage]:
     return messages
 
 
-def _format_sse(data: str, event: Optional[str] = None) -> str:
-    lines = data.splitlines() or [""]
-    payload = []
-    if event:
-        payload.append(f"event: {event}")
-    payload.extend([f"data: {line}" for line in lines])
-    return "\n".join(payload) + "\n\n"
-
-
 def _chunk_text(text: str, chunk_size: int = 8) -> List[str]:
     words = text.split()
     if not words:
@@ -219,49 +279,293 @@ def _chunk_text(text: str, chunk_size: int = 8) -> List[str]:
     return chunks
 
 
-async def process_chat(request: ChatRequest, session_id: str) -> str:
+async def _run_chat(
+    request: ChatRequest, session_id: str, budget: Optional[Dict[str, str]] = None,
+    tracker: Optional[ToolUseTracker] = None
+) -> Tuple[str, bool]:
+    """The answer of one graph run, and whether the run succeeded."""
     messages = build_messages(request)
     agent_app = _get_agent_app()
+    config = _invoke_config(session_id, budget, [tracker] if tracker else None)
 
     try:
-        result = await agent_app.ainvoke({"messages": messages}, config=_invoke_config(session_id))
+        result = await agent_app.ainvoke({"messages": messages}, config=config)
         last_message = result["messages"][-1]
-        return last_message.content
+        return last_message.content, True
     except Exception as e:
         print(f"Error: {str(e)}") # للتشخيص في التيرمينال
-        return "عذراً، واجهت مشكلة تقنية أثناء معالجة طلبك. يرجى المحاولة مرة أخرى."
+        return "عذراً، واجهت مشكلة تقنية أثناء معالجة طلبك. يرجى المحاولة مرة أخرى.", False
+
+
+async def process_chat(request: ChatRequest, session_id: str, budget: Optional[Dict[str, str]] = None) -> str:
+    key = _response_cache_key(request)
+    if key is None:
+        answer, _ = await _run_chat(request, session_id, budget)
+        return answer
+
+    cache = get_response_cache()
+    mode = _request_mode(request)
+    cached = cache.get(key, mode)
+    if cached is not None:
+        return cached
+
+    async def run() -> str:
+        tracker = ToolUseTracker()
+        answer, ok = await _run_chat(request, session_id, budget, tracker)
+        if ok and not _budget_spent(budget):
+            cache.store(key, mode, answer, tracker.tools)
+        return answer
+
+    # Identical requests already in flight share that run
+    return await cache.run_once(key, mode, run)
+
+
+# The only node whose model tokens are sent to the client as the answer
+ANSWER_NODE = "writer"
+
+
+def _progress_event(event: dict) -> Optional[dict]:
+    """Small structured progress update for a node-level graph event, if any."""
+    name, kind = event.get("name"), event.get("event")
+    data = event.get("data") or {}
+    if kind == "on_chain_end" and name == "planner":
+        steps = (data.get("output") or {}).get("plan_steps") or []
+        return {"type": "plan", "steps": [{"id": step["id"], "task": step["task"]} for step in steps]}
+    if kind == "on_chain_start" and name == "executor":
+        step = (data.get("input") or {}).get("step") or {}
+        return {"type": "step_started", "step": step.get("id"), "task": step.get("task")}
+    if kind == "on_chain_end" and name == "executor":
+        results = (data.get("output") or {}).get("step_results") or {}
+        return {"type": "step_finished", "step": next(iter(results), None)}
+    if kind == "on_chain_start" and name == ANSWER_NODE:
+        return {"type": "writing"}
+    return None
+
+
+class _RunProgress:
+    """How far a streamed run got, from its progress events; used when it is cancelled."""
+
+    def __init__(self):
+        self.planned: Optional[int] = None
+        self.started = 0
+        self.writing = False
+
+    def observe(self, progress: dict):
+        kind = progress["type"]
+        if kind == "plan":
+            self.planned = len(progress["steps"])
+        elif kind == "step_started":
+            self.started += 1
+        elif kind == "writing":
+            self.writing = True
+
+    @property
+    def stage(self) -> str:
+        if self.writing:
+            return "writing"
+        return "planning" if self.planned is None else "executing"
+
+    def calls_saved(self) -> int:
+        """Model calls the rest of the run would have made, at one per node or step."""
+        if self.writing:
+            return 0
+        if self.planned is None:
+            # Plan not known yet: at least one step, then the writer
+            return 2
+        return max(0, self.planned - self.started) + 1
+
+
+async def _fallback_answer(
+    agent_app, request: ChatRequest, session_id: str, budget: Optional[Dict[str, str]]
+) -> AsyncGenerator[str, None]:
+    """Answer text for apps without astream_events: writer messages as they stream, else the finished answer."""
+    if not hasattr(agent_app, "astream"):
+        full_text = await process_chat(request, session_id, budget)
+        for chunk in _chunk_text(full_text):
+            yield chunk
+        return
+
+    async for message, metadata in agent_app.astream(
+        {"messages": build_messages(request)},
+        config=_invoke_config(session_id, budget),
+        stream_mode="messages",
+    ):
+        if metadata.get("langgraph_node") == ANSWER_NODE and message.content:
+            yield str(message.content)
 
 
-async def stream_chat(request: ChatRequest, session_id: str) -> AsyncGenerator[str, None]:
+async def _chat_frames(
+    request: ChatRequest, session_id: str, budget: Optional[Dict[str, str]], recorder: StreamRecorder,
+    tracker: Optional[ToolUseTracker] = None
+) -> AsyncGenerator[SSEFrame, None]:
+    """Frames of one run: session, progress events, then the writer's tokens."""
     messages = build_messages(request)
     agent_app = _get_agent_app()
 
-    yield _format_sse(session_id, event="session")
-
-    if not hasattr(agent_app, "astream_events"):
-        full_text = await process_chat(request, session_id)
-        for chunk in _chunk_text(full_text):
-            yield _format_sse(chunk)
-        yield _format_sse("[DONE]")
-        return
+    yield SSEFrame(session_id, event="session")
 
+    progress_seen = _RunProgress()
     try:
-        async for event in agent_app.astream_events(
+        if not hasattr(agent_app, "astream_events"):
+            async for text in _fallback_answer(agent_app, request, session_id, budget):
+                yield SSEFrame(text, merge=True)
+            yield SSEFrame("[DONE]")
+            recorder.outcome = "completed"
+            return
+
+        streamed = False
+        # Closing the event stream cancels the graph task and everything under it
+        events = agent_app.astream_events(
             {"messages": messages},
-            config=_invoke_config(session_id),
-            version="v1",
-        ):
-            if event.get("event") != "on_chat_model_stream":
-                continue
-
-            chunk = event.get("data", {}).get("chunk")
-            text = getattr(chunk, "content", None)
-            if text:
-                yield _format_sse(text)
-
-        yield _format_sse("[DONE]")
+            config=_invoke_config(session_id, budget, [tracker] if tracker else None),
+            version="v2",
+        )
+        async with aclosing(events):
+            async for event in events:
+                kind = event.get("event")
+                if kind == "on_chat_model_stream":
+                    text = getattr(event.get("data", {}).get("chunk"), "content", None)
+                    if not text:
+                        continue
+                    metadata = event.get("metadata") or {}
+                    recorder.token(metadata.get("ls_model_name"))
+                    if metadata.get("langgraph_node") != ANSWER_NODE:
+                        continue
+                    streamed = True
+                    yield SSEFrame(text, merge=True)
+                    continue
+
+                # Nodes are direct children of the graph run; deeper runs repeat their names
+                if len(event.get("parent_ids") or ()) != 1:
+                    continue
+
+                progress = _progress_event(event)
+                if progress:
+                    progress_seen.observe(progress)
+                    yield SSEFrame(json.dumps(progress, ensure_ascii=False), event="progress")
+
+                if kind == "on_chain_end" and event.get("name") == ANSWER_NODE and not streamed:
+                    # The writer answered without the model (token budget spent)
+                    output = event.get("data", {}).get("output") or {}
+                    if isinstance(output, dict) and output.get("final_report"):
+                        for chunk in _chunk_text(output["final_report"]):
+                            yield SSEFrame(chunk, merge=True)
+
+        yield SSEFrame("[DONE]")
+        recorder.outcome = "completed"
     except Exception as e:
-        yield _format_sse(f"عذراً، حدث خطأ أثناء البث: {str(e)}", event="error")
+        recorder.outcome = "error"
+        yield SSEFrame(f"عذراً، حدث خطأ أثناء البث: {str(e)}", event="error")
+    finally:
+        if recorder.outcome == "aborted":
+            # The client went away mid-run and the stream was cancelled or closed
+            get_metrics().record_cancelled_run(
+                recorder.mode, progress_seen.stage, progress_seen.calls_saved()
+            )
+
+
+async def _watch_disconnect(http_request: Request, emitter: SSEEmitter):
+    """Close the stream as soon as the client disconnects, rather than at the next failed send."""
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            emitter.close()
+            return
+
+
+async def _cached_frames(session_id: str, answer: str, recorder: StreamRecorder) -> AsyncGenerator[SSEFrame, None]:
+    """Frames replaying a cached answer."""
+    yield SSEFrame(session_id, event="session")
+    yield SSEFrame(answer, merge=True)
+    yield SSEFrame("[DONE]")
+    recorder.outcome = "completed"
+
+
+async def _caching_frames(
+    key: str, request: ChatRequest, session_id: str, budget: Optional[Dict[str, str]], recorder: StreamRecorder
+) -> AsyncGenerator[SSEFrame, None]:
+    """_chat_frames for a cacheable request; the answer is cached once the run completes."""
+    tracker = ToolUseTracker()
+    answer = []
+    frames = _chat_frames(request, session_id, budget, recorder, tracker)
+    async with aclosing(frames):
+        async for frame in frames:
+            if frame.merge:
+                answer.append(frame.data)
+            yield frame
+    if recorder.outcome == "completed" and not _budget_spent(budget):
+        get_response_cache().store(key, recorder.mode, "".join(answer), tracker.tools)
+
+
+async def _shared_frames(flight: StreamFlight, session_id: str, recorder: StreamRecorder) -> AsyncGenerator[SSEFrame, None]:
+    """One subscriber's view of a shared run: its own session id, then the run's frames."""
+    frames = flight.subscribe()
+    async with aclosing(frames):
+        async for frame in frames:
+            if frame.event == "session":
+                frame = SSEFrame(session_id, event="session")
+            yield frame
+    # The leader's recorder saw the run's tokens and how it ended
+    run_recorder = flight.context
+    if run_recorder is not recorder:
+        recorder.model = run_recorder.model
+        if flight.frames and flight.frames[-1].data == "[DONE]":
+            recorder.outcome = "completed"
+        elif run_recorder.outcome == "error":
+            recorder.outcome = "error"
+
+
+def _stream_frames(
+    request: ChatRequest, session_id: str, budget: Optional[Dict[str, str]], recorder: StreamRecorder
+) -> AsyncGenerator[SSEFrame, None]:
+    """Frames for one /run/stream client: from the cache, a shared run, or a run of its own."""
+    key = _response_cache_key(request)
+    if key is None:
+        return _chat_frames(request, session_id, budget, recorder)
+
+    cache = get_response_cache()
+    cached = cache.get(key, recorder.mode)
+    if cached is not None:
+        return _cached_frames(session_id, cached, recorder)
+    if not cache.config.singleflight:
+        get_metrics().record_response_cache(recorder.mode, "miss")
+        return _caching_frames(key, request, session_id, budget, recorder)
+
+    flight = cache.join_stream(
+        key, recorder.mode,
+        lambda: (_caching_frames(key, request, session_id, budget, recorder), recorder),
+    )
+    return _shared_frames(flight, session_id, recorder)
+
+
+async def stream_chat(
+    request: ChatRequest, session_id: str, budget: Optional[Dict[str, str]] = None,
+    http_request: Optional[Request] = None
+) -> AsyncGenerator[str, None]:
+    """
+    SSE stream of one run: a `session` event, `progress` events while the
+    planner and executor work, then the writer's tokens as data frames,
+    coalesced per flush window by SSEEmitter.
+
+    When the client disconnects the run is cancelled: model requests,
+    sandbox executions and browser pages in flight are abandoned, and the
+    session's checkpoint stays at the last completed step, so the run can
+    be resumed with the same session_id. A run shared by identical
+    requests is cancelled once all of its clients have gone.
+    """
+    recorder = get_metrics().stream_recorder(_request_mode(request))
+    emitter = SSEEmitter(on_data=recorder.frame)
+    watcher = asyncio.create_task(_watch_disconnect(http_request, emitter)) if http_request else None
+    try:
+        async for text in emitter.stream(_stream_frames(request, session_id, budget, recorder)):
+            yield text
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+            with suppress(asyncio.CancelledError):
+                await watcher
+        # outcome stays "aborted" if the client disconnects before [DONE]
+        recorder.finish()
 
 # --- نقاط النهاية (Endpoints) ---
 
@@ -274,20 +578,21 @@ async def health_check():
     return {"status": "healthy", "model": "llama3-70b-8192"}
 
 @app.get("/metrics")
-async def prometheus_metrics():
+async def prometheus_metrics(request: Request):
     """Prometheus metrics endpoint for monitoring."""
-    return metrics_endpoint()
+    return metrics_endpoint(request)
 
 @app.post("/run", response_model=ChatResponse)
-async def run_agent(request: ChatRequest):
+async def run_agent(request: ChatRequest, http_request: Request):
     """
     نقطة النهاية الرئيسية للمحادثة.
     تستقبل الرسالة والوضع (Mode) وتعيد الرد الذكي.
     """
+    budget = _check_token_budget(http_request, request)
     if request.stream:
         session_id = _resolve_session_id(request)
         return StreamingResponse(
-            stream_chat(request, session_id),
+            stream_chat(request, session_id, budget, http_request),
             media_type="text/event-stream",
             headers={
                 "Cache-Control": "no-cache",
@@ -295,18 +600,19 @@ async def run_agent(request: ChatRequest):
             }
         )
     session_id = _resolve_session_id(request)
-    ai_reply = await process_chat(request, session_id)
+    ai_reply = await process_chat(request, session_id, budget)
     return ChatResponse(response=ai_reply, session_id=session_id)
 
 
 @app.post("/run/stream")
-async def run_agent_stream(request: ChatRequest):
+async def run_agent_stream(request: ChatRequest, http_request: Request):
     """
     نقطة نهاية للبث المباشر (Streaming) على شكل SSE.
     """
+    budget = _check_token_budget(http_request, request)
     session_id = _resolve_session_id(request)
     return StreamingResponse(
-        stream_chat(request, session_id),
+        stream_chat(request, session_id, budget, http_request),
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
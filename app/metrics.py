@@ -7,17 +7,29 @@ Provides comprehensive monitoring metrics for:
 - Tool usage statistics
 - Error rates
 - Token usage estimation
+
+With several uvicorn workers, set METRICS_MULTIPROC_DIR: each worker then
+keeps its values in a memory-mapped file in that directory and /metrics
+merges every worker's file at scrape time.
 """
 
+import fcntl
+import json
+import mmap
 import os
+import re
+import struct
+import threading
 import time
-from typing import Callable, Optional
+import zlib
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional
 from functools import wraps
 from dataclasses import dataclass, field
-from collections import defaultdict
 from fastapi import Request
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import Response
+from starlette.responses import StreamingResponse
+from starlette.routing import Match
 
 
 @dataclass
@@ -27,114 +39,647 @@ class MetricValue:
     labels: dict = field(default_factory=dict)
 
 
-class Counter:
-    """A counter metric that only goes up."""
+# ═══════════════════════════════════════════════════════════════════════════════
+# MULTIPROCESS STORAGE
+# ═══════════════════════════════════════════════════════════════════════════════
+
+MULTIPROC_DIR_ENV = "METRICS_MULTIPROC_DIR"
+# Bytes of the file in use, written after each new entry is complete
+_USED = struct.Struct("<Q")
+_KEY_LENGTH = struct.Struct("<I")
+_VALUE = struct.Struct("<d")
+_WORKER_FILE = re.compile(r"^metrics_(\d+)\.db$")
+_ARCHIVE_FILE = "archive.db"
+_LOCK_FILE = "archive.lock"
+
+
+def _read_entries(data, used: int):
+    """Yield (key, value offset, value) for each entry of a values file."""
+    position = _USED.size
+    while position + _KEY_LENGTH.size <= used:
+        length = _KEY_LENGTH.unpack_from(data, position)[0]
+        key_start = position + _KEY_LENGTH.size
+        offset = (key_start + length + 7) & ~7
+        if offset + _VALUE.size > used:
+            break
+        key = bytes(data[key_start:key_start + length]).decode("utf-8")
+        yield key, offset, _VALUE.unpack_from(data, offset)[0]
+        position = offset + _VALUE.size
+
+
+class _MmapValues:
+    """
+    Float values by key in a memory-mapped file written by one process.
+    
+    Layout: the used length (8 bytes), then entries of a 4-byte key
+    length, the UTF-8 key padded to 8 bytes and a double. Entries are only
+    appended and the used length is bumped once an entry is complete, so
+    other processes can read the file at any time without locking.
+    """
+    
+    INITIAL_SIZE = 64 * 1024
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size < self.INITIAL_SIZE:
+            os.ftruncate(self._fd, self.INITIAL_SIZE)
+            size = self.INITIAL_SIZE
+        self._map = mmap.mmap(self._fd, size)
+        self._used = _USED.unpack_from(self._map, 0)[0] or _USED.size
+        self._offsets = {key: offset for key, offset, _ in _read_entries(self._map, self._used)}
+    
+    def offset(self, key: str) -> int:
+        """Offset of the value for `key`, appending a zero entry if new."""
+        with self.lock:
+            offset = self._offsets.get(key)
+            if offset is None:
+                offset = self._append(key)
+            return offset
+    
+    def _append(self, key: str) -> int:
+        encoded = key.encode("utf-8")
+        position = self._used
+        offset = (position + _KEY_LENGTH.size + len(encoded) + 7) & ~7
+        end = offset + _VALUE.size
+        if end > len(self._map):
+            self._grow(end)
+        _KEY_LENGTH.pack_into(self._map, position, len(encoded))
+        self._map[position + _KEY_LENGTH.size:position + _KEY_LENGTH.size + len(encoded)] = encoded
+        _VALUE.pack_into(self._map, offset, 0.0)
+        self._used = end
+        _USED.pack_into(self._map, 0, end)
+        self._offsets[key] = offset
+        return offset
+    
+    def _grow(self, needed: int):
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+        self._map.close()
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+    
+    # read/write/add expect the caller to hold self.lock
+    def read(self, offset: int) -> float:
+        return _VALUE.unpack_from(self._map, offset)[0]
+    
+    def write(self, offset: int, value: float):
+        _VALUE.pack_into(self._map, offset, value)
+    
+    def add(self, offset: int, value: float):
+        _VALUE.pack_into(self._map, offset, _VALUE.unpack_from(self._map, offset)[0] + value)
+    
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextmanager
+def _directory_lock(directory: str, exclusive: bool):
+    """Serialize folding dead workers' files against scrapes reading them."""
+    fd = os.open(os.path.join(directory, _LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _read_values(path: str) -> list:
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    if len(data) < _USED.size:
+        return []
+    used = min(_USED.unpack_from(data, 0)[0], len(data))
+    return [(key, value) for key, _, value in _read_entries(data, used)]
+
+
+def _fold_into_archive(directory: str, path: str):
+    """
+    Add a dead worker's counters and histograms to the archive file and
+    delete it. Its gauges describe a process that is gone and are dropped.
+    Caller holds the exclusive directory lock.
+    """
+    archive = _MmapValues(os.path.join(directory, _ARCHIVE_FILE))
+    try:
+        for key, value in _read_values(path):
+            if json.loads(key)[0] == "gauge":
+                continue
+            offset = archive.offset(key)
+            with archive.lock:
+                archive.add(offset, value)
+    finally:
+        archive.close()
+    os.unlink(path)
+
+
+def _worker_files(directory: str) -> list:
+    files = []
+    for name in os.listdir(directory):
+        match = _WORKER_FILE.match(name)
+        if match:
+            files.append((int(match.group(1)), os.path.join(directory, name)))
+    return files
+
+
+def _fold_dead_workers(directory: str):
+    """Fold the files of workers that are no longer running."""
+    if all(_pid_alive(pid) for pid, _ in _worker_files(directory)):
+        return
+    with _directory_lock(directory, exclusive=True):
+        for pid, path in _worker_files(directory):
+            if not _pid_alive(pid) and os.path.exists(path):
+                _fold_into_archive(directory, path)
+
+
+def _read_multiprocess(directory: str) -> dict:
+    """
+    Merge every worker's file and the archive into
+    {metric name: {label values: {sample: value}}}.
+    
+    Counter and histogram samples are summed; gauge samples are kept per
+    pid for the gauge's multiprocess_mode to combine.
+    """
+    _fold_dead_workers(directory)
+    series: dict = {}
+    with _directory_lock(directory, exclusive=False):
+        sources = [(None, os.path.join(directory, _ARCHIVE_FILE))] + _worker_files(directory)
+        for pid, path in sources:
+            for key, value in _read_values(path):
+                kind, name, label_values, sample = json.loads(key)
+                samples = series.setdefault(name, {}).setdefault(tuple(label_values), {})
+                if kind == "gauge":
+                    samples[pid] = value
+                else:
+                    samples[sample] = samples.get(sample, 0.0) + value
+    return series
+
+
+_process_values: Optional[_MmapValues] = None
+_process_values_lock = threading.Lock()
+
+
+def multiprocess_dir() -> Optional[str]:
+    """The shared metrics directory, or None in single-process mode."""
+    return os.getenv(MULTIPROC_DIR_ENV) or None
+
+
+def _get_process_values() -> Optional[_MmapValues]:
+    """This worker's values file, created on first use in multiprocess mode."""
+    global _process_values
+    directory = multiprocess_dir()
+    if directory is None:
+        return None
+    with _process_values_lock:
+        pid = os.getpid()
+        if _process_values is None or _process_values.path != os.path.join(directory, f"metrics_{pid}.db"):
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"metrics_{pid}.db")
+            if os.path.exists(path):
+                # Left by an earlier process that had the same pid
+                with _directory_lock(directory, exclusive=True):
+                    if os.path.exists(path):
+                        _fold_into_archive(directory, path)
+            _process_values = _MmapValues(path)
+        return _process_values
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# METRIC TYPES
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# Formatted sample prefixes kept per metric before the cache is reset
+PREFIX_CACHE_LIMIT = 65536
+# Series joined into one exposition chunk
+EXPOSITION_BATCH = 256
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _LabelledMetric:
+    """
+    Base for metrics with a fixed set of label names.
+    
+    Each label combination gets a child holding its value; children are
+    cached, so `metric.labels(...)` can be called once and the handle kept
+    for hot paths. A single lock per metric makes updates safe from the
+    thread-pool threads that sync graph nodes run on.
+    
+    In multiprocess mode children keep their values in this worker's
+    memory-mapped file instead of in Python attributes.
+    
+    `max_series` caps the label combinations kept; past it, new ones are
+    folded into a single series with every label set to OVERFLOW_LABEL and
+    `on_drop` is called.
+    """
+    
+    kind = ""
+    OVERFLOW_LABEL = "_overflow"
     
     def __init__(self, name: str, description: str, labels: list = None):
         self.name = name
         self.description = description
-        self.label_names = labels or []
-        self._values: dict = defaultdict(float)
+        self.label_names = tuple(labels or [])
+        self._lock = threading.Lock()
+        self._children: dict = {}
+        self._values = _get_process_values()
+        self.max_series: Optional[int] = None
+        self.on_drop: Optional[Callable[[str], None]] = None
+        self._prefix_cache: dict = {}
     
-    def inc(self, labels: dict = None, value: float = 1.0):
-        """Increment the counter."""
-        key = self._labels_to_key(labels or {})
-        self._values[key] += value
+    def _new_child(self, key: tuple):
+        raise NotImplementedError
+    
+    def _entry_key(self, key: tuple, sample: str) -> str:
+        label_values = ["" if value is None else str(value) for value in key]
+        return json.dumps([self.kind, self.name, label_values, sample])
+    
+    def labels(self, *values, **labels):
+        """Return the cached child for one label combination."""
+        if labels:
+            values = tuple(map(labels.get, self.label_names))
+        return self._get_child(tuple(values))
+    
+    def _child_for(self, labels: Optional[dict]):
+        if not labels:
+            return self._get_child(())
+        return self._get_child(tuple(map(labels.get, self.label_names)))
+    
+    def _get_child(self, key: tuple):
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    if self.max_series is not None and len(self._children) >= self.max_series and key:
+                        return self._overflow_child()
+                    child = self._new_child(key)
+                    self._children[key] = child
+        return child
+    
+    def _overflow_child(self):
+        """The series absorbing label sets past max_series; caller holds the lock."""
+        if self.on_drop is not None:
+            self.on_drop(self.name)
+        key = (self.OVERFLOW_LABEL,) * len(self.label_names)
+        child = self._children.get(key)
+        if child is None:
+            child = self._new_child(key)
+            self._children[key] = child
+        return child
     
-    def _labels_to_key(self, labels: dict) -> tuple:
-        return tuple(sorted(labels.items()))
+    def _items(self) -> list:
+        with self._lock:
+            return list(self._children.items())
+    
+    def _labels_dict(self, key: tuple) -> dict:
+        # A key one longer than label_names carries a gauge's pid
+        names = self.label_names + ("pid",)
+        return {name: "" if value is None else value for name, value in zip(names, key)}
+    
+    # ─── Exposition ───
+    
+    def _label_pairs(self, key: tuple) -> list:
+        return [f'{name}="{_escape_label(value)}"' for name, value in self._labels_dict(key).items()]
+    
+    @staticmethod
+    def _labels_text(pairs: list) -> str:
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+    
+    def _build_prefixes(self, key: tuple) -> tuple:
+        raise NotImplementedError
+    
+    def _prefixes(self, key: tuple) -> tuple:
+        """The series' sample names and labels, formatted once and cached."""
+        prefixes = self._prefix_cache.get(key)
+        if prefixes is None:
+            if len(self._prefix_cache) >= PREFIX_CACHE_LIMIT:
+                self._prefix_cache.clear()
+            prefixes = self._prefix_cache[key] = self._build_prefixes(key)
+        return prefixes
+    
+    def _sample_lines(self, series: Optional[dict]) -> Iterator[str]:
+        raise NotImplementedError
+    
+    def expose(self, series: Optional[dict] = None, openmetrics: bool = False) -> Iterator[str]:
+        """
+        Yield this metric family in text exposition format, a few hundred
+        series per chunk, from this process or from merged multiprocess
+        `series`.
+        """
+        family = self.name
+        if openmetrics and self.kind == "counter" and family.endswith("_total"):
+            # OpenMetrics names the counter family without the _total suffix
+            family = family[:-len("_total")]
+        parts = [f"# HELP {family} {self.description}\n# TYPE {family} {self.kind}\n"]
+        for line in self._sample_lines(series):
+            parts.append(line)
+            if len(parts) >= EXPOSITION_BATCH:
+                yield "".join(parts)
+                parts = []
+        if parts:
+            yield "".join(parts)
+
+
+class _ValueChild:
+    """Value of one label combination of a Counter or Gauge."""
+    __slots__ = ("_lock", "value")
+    
+    def __init__(self, lock: threading.Lock):
+        self._lock = lock
+        self.value = 0.0
+    
+    def inc(self, value: float = 1.0):
+        with self._lock:
+            self.value += value
+    
+    def dec(self, value: float = 1.0):
+        with self._lock:
+            self.value -= value
+    
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+
+class _MmapValueChild:
+    """Value of one label combination, kept in the worker's values file."""
+    __slots__ = ("_values", "_offset")
+    
+    def __init__(self, values: _MmapValues, key: str):
+        self._values = values
+        self._offset = values.offset(key)
+    
+    @property
+    def value(self) -> float:
+        with self._values.lock:
+            return self._values.read(self._offset)
+    
+    def inc(self, value: float = 1.0):
+        with self._values.lock:
+            self._values.add(self._offset, value)
+    
+    def dec(self, value: float = 1.0):
+        with self._values.lock:
+            self._values.add(self._offset, -value)
+    
+    def set(self, value: float):
+        with self._values.lock:
+            self._values.write(self._offset, value)
+
+
+class _ValueMetric(_LabelledMetric):
+    """Shared parts of Counter and Gauge: one float per series."""
+    
+    def _new_child(self, key: tuple):
+        if self._values is not None:
+            return _MmapValueChild(self._values, self._entry_key(key, ""))
+        return _ValueChild(self._lock)
+    
+    def _values_of(self, series: Optional[dict]) -> list:
+        """(key, value) pairs from this process, or from merged `series`."""
+        if series is None:
+            return [(key, child.value) for key, child in self._items()]
+        return [(key, samples.get("", 0.0)) for key, samples in series.items()]
     
     def collect(self) -> list:
         """Collect all metric values."""
-        return [
-            {"labels": dict(key), "value": value}
-            for key, value in self._values.items()
-        ]
+        return [{"labels": self._labels_dict(key), "value": value} for key, value in self._values_of(None)]
+    
+    def _build_prefixes(self, key: tuple) -> tuple:
+        return (f"{self.name}{self._labels_text(self._label_pairs(key))} ",)
+    
+    def _sample_lines(self, series: Optional[dict]) -> Iterator[str]:
+        for key, value in self._values_of(series):
+            yield f"{self._prefixes(key)[0]}{value}\n"
 
 
-class Histogram:
+class Counter(_ValueMetric):
+    """A counter metric that only goes up."""
+    
+    kind = "counter"
+    
+    def inc(self, labels: dict = None, value: float = 1.0):
+        """Increment the counter."""
+        self._child_for(labels).inc(value)
+
+
+class _HistogramChild:
+    """Bucket counts of one label combination, one slot per bucket."""
+    __slots__ = ("_lock", "_bounds", "counts", "sum", "count")
+    
+    def __init__(self, lock: threading.Lock, bounds: list):
+        self._lock = lock
+        self._bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        """Record an observation."""
+        index = bisect_left(self._bounds, value)
+        with self._lock:
+            if index < len(self.counts):
+                self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class _MmapHistogramChild:
+    """Bucket counts of one label combination, kept in the worker's values file."""
+    __slots__ = ("_values", "_bounds", "_bucket_offsets", "_sum_offset", "_count_offset")
+    
+    def __init__(self, values: _MmapValues, bounds: list, entry_key: Callable[[str], str]):
+        self._values = values
+        self._bounds = bounds
+        self._bucket_offsets = [values.offset(entry_key(f"b{i}")) for i in range(len(bounds))]
+        self._sum_offset = values.offset(entry_key("sum"))
+        self._count_offset = values.offset(entry_key("count"))
+    
+    def observe(self, value: float):
+        """Record an observation."""
+        index = bisect_left(self._bounds, value)
+        with self._values.lock:
+            if index < len(self._bucket_offsets):
+                self._values.add(self._bucket_offsets[index], 1)
+            self._values.add(self._sum_offset, value)
+            self._values.add(self._count_offset, 1)
+    
+    @property
+    def counts(self) -> list:
+        with self._values.lock:
+            return [int(self._values.read(offset)) for offset in self._bucket_offsets]
+    
+    @property
+    def sum(self) -> float:
+        with self._values.lock:
+            return self._values.read(self._sum_offset)
+    
+    @property
+    def count(self) -> int:
+        with self._values.lock:
+            return int(self._values.read(self._count_offset))
+
+
+class Histogram(_LabelledMetric):
     """A histogram metric for measuring distributions."""
     
+    kind = "histogram"
     DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
     
     def __init__(self, name: str, description: str, labels: list = None, buckets: tuple = None):
-        self.name = name
-        self.description = description
-        self.label_names = labels or []
-        self.buckets = buckets or self.DEFAULT_BUCKETS
-        self._values: dict = defaultdict(lambda: {"buckets": defaultdict(float), "sum": 0.0, "count": 0})
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+        self._bounds = list(self.buckets)
+    
+    def _new_child(self, key: tuple):
+        if self._values is not None:
+            return _MmapHistogramChild(self._values, self._bounds, lambda sample: self._entry_key(key, sample))
+        return _HistogramChild(self._lock, self._bounds)
     
     def observe(self, value: float, labels: dict = None):
         """Record an observation."""
-        key = self._labels_to_key(labels or {})
-        entry = self._values[key]
-        
-        for bucket in self.buckets:
-            if value <= bucket:
-                entry["buckets"][bucket] += 1
-        
-        entry["sum"] += value
-        entry["count"] += 1
+        self._child_for(labels).observe(value)
     
-    def _labels_to_key(self, labels: dict) -> tuple:
-        return tuple(sorted(labels.items()))
-    
-    def collect(self) -> list:
-        """Collect all metric values."""
+    def _samples_of(self, series: Optional[dict]) -> list:
+        """(key, bucket counts, sum, count) from this process, or from merged `series`."""
+        if series is None:
+            samples = []
+            for key, child in self._items():
+                with self._lock:
+                    samples.append((key, list(child.counts), child.sum, child.count))
+            return samples
         return [
-            {
-                "labels": dict(key),
-                "buckets": dict(entry["buckets"]),
-                "sum": entry["sum"],
-                "count": entry["count"]
-            }
-            for key, entry in self._values.items()
+            (key, [int(merged.get(f"b{i}", 0)) for i in range(len(self.buckets))],
+             merged.get("sum", 0.0), int(merged.get("count", 0)))
+            for key, merged in series.items()
         ]
+    
+    def collect(self) -> list:
+        """Collect all metric values, with cumulative bucket counts."""
+        items = []
+        for key, counts, total, count in self._samples_of(None):
+            buckets = {}
+            running = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                running += bucket_count
+                buckets[bound] = running
+            items.append({
+                "labels": self._labels_dict(key),
+                "buckets": buckets,
+                "sum": total,
+                "count": count
+            })
+        return items
+    
+    def _build_prefixes(self, key: tuple) -> tuple:
+        pairs = self._label_pairs(key)
+        prefixes = []
+        for bound in self.buckets:
+            le = "+Inf" if bound == float("inf") else str(bound)
+            labels = self._labels_text(pairs + ['le="' + le + '"'])
+            prefixes.append(f"{self.name}_bucket{labels} ")
+        labels = self._labels_text(pairs)
+        prefixes.append(f"{self.name}_sum{labels} ")
+        prefixes.append(f"{self.name}_count{labels} ")
+        return tuple(prefixes)
+    
+    def _sample_lines(self, series: Optional[dict]) -> Iterator[str]:
+        """One string per series: its buckets, sum and count."""
+        for key, counts, total, count in self._samples_of(series):
+            prefixes = self._prefixes(key)
+            lines = []
+            running = 0
+            for prefix, bucket_count in zip(prefixes, counts):
+                running += bucket_count
+                lines.append(f"{prefix}{running}\n")
+            lines.append(f"{prefixes[-2]}{total}\n{prefixes[-1]}{count}\n")
+            yield "".join(lines)
 
 
-class Gauge:
-    """A gauge metric that can go up and down."""
+class Gauge(_ValueMetric):
+    """
+    A gauge metric that can go up and down.
     
-    def __init__(self, name: str, description: str, labels: list = None):
-        self.name = name
-        self.description = description
-        self.label_names = labels or []
-        self._values: dict = defaultdict(float)
+    `multiprocess_mode` says how workers' values are combined in
+    multiprocess mode: livesum (default), max, min, or all (one series per
+    worker with a `pid` label). Only running workers count.
+    """
+    
+    kind = "gauge"
+    MULTIPROCESS_MODES = ("livesum", "max", "min", "all")
+    
+    def __init__(self, name: str, description: str, labels: list = None, multiprocess_mode: str = "livesum"):
+        if multiprocess_mode not in self.MULTIPROCESS_MODES:
+            raise ValueError(f"Invalid multiprocess_mode: {multiprocess_mode}")
+        super().__init__(name, description, labels)
+        self.multiprocess_mode = multiprocess_mode
     
     def set(self, value: float, labels: dict = None):
         """Set the gauge value."""
-        key = self._labels_to_key(labels or {})
-        self._values[key] = value
+        self._child_for(labels).set(value)
     
     def inc(self, labels: dict = None, value: float = 1.0):
         """Increment the gauge."""
-        key = self._labels_to_key(labels or {})
-        self._values[key] += value
+        self._child_for(labels).inc(value)
     
     def dec(self, labels: dict = None, value: float = 1.0):
         """Decrement the gauge."""
-        key = self._labels_to_key(labels or {})
-        self._values[key] -= value
-    
-    def _labels_to_key(self, labels: dict) -> tuple:
-        return tuple(sorted(labels.items()))
+        self._child_for(labels).dec(value)
     
-    def collect(self) -> list:
-        """Collect all metric values."""
-        return [
-            {"labels": dict(key), "value": value}
-            for key, value in self._values.items()
-        ]
+    def _values_of(self, series: Optional[dict]) -> list:
+        """(key, value) pairs; merged series hold {pid: value} and are combined per multiprocess_mode."""
+        if series is None:
+            return super()._values_of(None)
+        values = []
+        for key, by_pid in series.items():
+            live = {pid: value for pid, value in by_pid.items() if _pid_alive(pid)}
+            if not live:
+                continue
+            if self.multiprocess_mode == "all":
+                values.extend((key + (str(pid),), value) for pid, value in sorted(live.items()))
+                continue
+            combine = {"livesum": sum, "max": max, "min": min}[self.multiprocess_mode]
+            values.append((key, combine(live.values())))
+        return values
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # NABD AI METRICS
 # ═══════════════════════════════════════════════════════════════════════════════
 
+@dataclass
+class MetricsConfig:
+    """Configuration for the metrics registry."""
+    # Label combinations kept per metric before new ones go to the overflow series
+    max_series: int = 1000
+
+
 class NabdMetrics:
     """Central metrics registry for Nabd AI Platform."""
     
-    def __init__(self):
+    def __init__(self, config: Optional[MetricsConfig] = None):
+        self.config = config or MetricsConfig()
+        self._load_env_config()
+        
         # Request metrics
         self.http_requests_total = Counter(
             "nabd_http_requests_total",
@@ -144,7 +689,13 @@ class NabdMetrics:
         
         self.http_request_duration_seconds = Histogram(
             "nabd_http_request_duration_seconds",
-            "HTTP request latency",
+            "HTTP request latency, until the last body byte is sent",
+            labels=["method", "path"]
+        )
+        
+        self.http_response_bytes_total = Counter(
+            "nabd_http_response_bytes_total",
+            "Response body bytes sent",
             labels=["method", "path"]
         )
         
@@ -162,6 +713,13 @@ class NabdMetrics:
             buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, float("inf"))
         )
         
+        self.agent_node_duration_seconds = Histogram(
+            "nabd_agent_node_duration_seconds",
+            "Time spent in each agent graph node",
+            labels=["node", "status"],  # node: planner/executor/writer, status: success/error
+            buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+        )
+        
         self.agent_errors_total = Counter(
             "nabd_agent_errors_total",
             "Total agent errors",
@@ -182,10 +740,10 @@ class NabdMetrics:
             buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
         )
         
-        # Token usage (estimated)
+        # Token usage, as reported by the provider
         self.estimated_tokens_total = Counter(
             "nabd_estimated_tokens_total",
-            "Estimated tokens used",
+            "Tokens used, as reported by the provider",
             labels=["type", "model"]  # type: input/output
         )
         
@@ -202,11 +760,216 @@ class NabdMetrics:
             "Rate limit exceeded events",
             labels=["tier"]
         )
+        
+        # Token budgets
+        self.token_budget_charged_total = Counter(
+            "nabd_token_budget_charged_total",
+            "LLM tokens charged against per-user budgets",
+            labels=["tier"]
+        )
+        
+        self.token_budget_rejected_total = Counter(
+            "nabd_token_budget_rejected_total",
+            "Requests refused or cut short by an exhausted token budget",
+            labels=["tier", "stage"]  # stage: admission/midrun
+        )
+        
+        # LLM client registry
+        self.llm_client_cache_total = Counter(
+            "nabd_llm_client_cache_total",
+            "LLM client registry lookups",
+            labels=["kind", "result"]  # kind: client/bound, result: hit/miss
+        )
+        
+        # Search result cache
+        self.search_cache_requests_total = Counter(
+            "nabd_search_cache_requests_total",
+            "web_search cache lookups",
+            labels=["provider", "result"]  # result: hit/miss
+        )
+        
+        self.search_cache_saved_seconds_total = Counter(
+            "nabd_search_cache_saved_seconds_total",
+            "Provider latency avoided by web_search cache hits",
+            labels=["provider"]
+        )
+        
+        # /run response cache
+        self.response_cache_requests_total = Counter(
+            "nabd_response_cache_requests_total",
+            "Cacheable /run requests by how they were answered",
+            labels=["mode", "result"]  # result: hit/miss/coalesced
+        )
+        
+        self.response_cache_skipped_total = Counter(
+            "nabd_response_cache_skipped_total",
+            "Finished runs not cached because they called a tool with side effects",
+            labels=["mode"]
+        )
+        
+        # Python sandbox warm pool
+        self.sandbox_pool_idle = Gauge(
+            "nabd_sandbox_pool_idle",
+            "Warm sandbox containers ready for a job"
+        )
+        
+        self.sandbox_pool_wait_seconds = Histogram(
+            "nabd_sandbox_pool_wait_seconds",
+            "Time spent waiting for a warm sandbox container",
+            buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 2.0, 5.0, float("inf"))
+        )
+        
+        self.sandbox_cold_starts_total = Counter(
+            "nabd_sandbox_cold_starts_total",
+            "Sandbox runs that fell back to a cold docker run",
+            labels=["reason"]  # reason: pool_empty/pool_disabled
+        )
+        
+        # Python sandbox job queue
+        self.sandbox_queue_depth = Gauge(
+            "nabd_sandbox_queue_depth",
+            "Sandbox jobs waiting for or holding an execution slot",
+            labels=["state"]  # state: waiting/running
+        )
+        
+        self.sandbox_queue_wait_seconds = Histogram(
+            "nabd_sandbox_queue_wait_seconds",
+            "Time sandbox jobs waited for an execution slot",
+            buckets=(0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, float("inf"))
+        )
+        
+        self.sandbox_rejected_total = Counter(
+            "nabd_sandbox_rejected_total",
+            "Sandbox jobs rejected by the job queue",
+            labels=["reason"]  # reason: queue_full/queue_timeout
+        )
+        
+        self.sandbox_execution_seconds = Histogram(
+            "nabd_sandbox_execution_seconds",
+            "Sandbox job execution time",
+            labels=["mode"],
+            buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+        )
+        
+        # Per-session sandbox kernels
+        self.sandbox_kernels_live = Gauge(
+            "nabd_sandbox_kernels_live",
+            "Persistent sandbox kernels currently running"
+        )
+        
+        self.sandbox_kernel_requests_total = Counter(
+            "nabd_sandbox_kernel_requests_total",
+            "python_repl calls served by a session kernel",
+            labels=["result"]  # result: reused/started/fallback
+        )
+        
+        self.sandbox_kernel_evictions_total = Counter(
+            "nabd_sandbox_kernel_evictions_total",
+            "Session kernels shut down",
+            labels=["reason"]  # reason: ttl/lru/timeout/exited/cancelled/shutdown
+        )
+        
+        # SSE streaming latency
+        self.sse_time_to_first_frame_seconds = Histogram(
+            "nabd_sse_time_to_first_frame_seconds",
+            "Time from stream start to the first answer data frame",
+            labels=["mode", "model"],
+            buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 30.0, 60.0, float("inf"))
+        )
+        
+        self.sse_time_to_first_token_seconds = Histogram(
+            "nabd_sse_time_to_first_token_seconds",
+            "Time from stream start to the first model token of any node",
+            labels=["mode", "model"],
+            buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 30.0, 60.0, float("inf"))
+        )
+        
+        self.sse_inter_token_seconds = Histogram(
+            "nabd_sse_inter_token_seconds",
+            "Gap between consecutive model tokens in a stream",
+            labels=["mode", "model"],
+            buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+        )
+        
+        self.sse_stream_duration_seconds = Histogram(
+            "nabd_sse_stream_duration_seconds",
+            "Total duration of an SSE stream",
+            labels=["mode", "model"],
+            buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, float("inf"))
+        )
+        
+        self.sse_streams_total = Counter(
+            "nabd_sse_streams_total",
+            "SSE streams by how they ended",
+            labels=["mode", "outcome"]  # outcome: completed/aborted/error
+        )
+        
+        # Runs cancelled because their client disconnected
+        self.agent_runs_cancelled_total = Counter(
+            "nabd_agent_runs_cancelled_total",
+            "Streamed agent runs cancelled after the client disconnected, by the stage they reached",
+            labels=["mode", "stage"]  # stage: planning/executing/writing
+        )
+        
+        self.llm_calls_saved_total = Counter(
+            "nabd_llm_calls_saved_total",
+            "Model calls cancelled runs did not make (lower bound: one per unstarted node or step)",
+            labels=["mode"]
+        )
+        
+        # Label cardinality
+        self.metrics_series_dropped_total = Counter(
+            "nabd_metrics_series_dropped_total",
+            "Updates to new label sets redirected to the overflow series by the per-metric cap",
+            labels=["metric"]
+        )
+        
+        for metric in self._all_metrics():
+            if metric is not self.metrics_series_dropped_total:
+                metric.max_series = self.config.max_series
+                metric.on_drop = self._record_dropped_series
+    
+    def _load_env_config(self):
+        """Load configuration from environment variables."""
+        if os.getenv("METRICS_MAX_SERIES"):
+            self.config.max_series = int(os.getenv("METRICS_MAX_SERIES"))
+    
+    def _record_dropped_series(self, name: str):
+        self.metrics_series_dropped_total.inc({"metric": name})
+    
+    def _counters(self) -> list:
+        return [self.http_requests_total, self.http_response_bytes_total, self.agent_requests_total,
+                self.agent_errors_total, self.tool_calls_total,
+                self.estimated_tokens_total, self.rate_limit_exceeded_total,
+                self.token_budget_charged_total, self.token_budget_rejected_total,
+                self.llm_client_cache_total, self.search_cache_requests_total,
+                self.search_cache_saved_seconds_total, self.response_cache_requests_total,
+                self.response_cache_skipped_total, self.sandbox_cold_starts_total,
+                self.sandbox_rejected_total, self.sandbox_kernel_requests_total,
+                self.sandbox_kernel_evictions_total, self.sse_streams_total,
+                self.agent_runs_cancelled_total, self.llm_calls_saved_total,
+                self.metrics_series_dropped_total]
+    
+    def _gauges(self) -> list:
+        return [self.active_connections, self.sandbox_pool_idle, self.sandbox_queue_depth,
+                self.sandbox_kernels_live]
+    
+    def _histograms(self) -> list:
+        return [self.http_request_duration_seconds, self.agent_request_duration_seconds,
+                self.agent_node_duration_seconds, self.tool_call_duration_seconds, self.sandbox_pool_wait_seconds,
+                self.sandbox_queue_wait_seconds, self.sandbox_execution_seconds,
+                self.sse_time_to_first_frame_seconds, self.sse_time_to_first_token_seconds,
+                self.sse_inter_token_seconds, self.sse_stream_duration_seconds]
+    
+    def _all_metrics(self) -> list:
+        return self._counters() + self._gauges() + self._histograms()
     
-    def record_http_request(self, method: str, path: str, status: int, duration: float):
+    def record_http_request(self, method: str, path: str, status: int, duration: float, response_bytes: int = 0):
         """Record an HTTP request."""
         self.http_requests_total.inc({"method": method, "path": path, "status": str(status)})
         self.http_request_duration_seconds.observe(duration, {"method": method, "path": path})
+        if response_bytes:
+            self.http_response_bytes_total.inc({"method": method, "path": path}, response_bytes)
     
     def record_agent_request(self, mode: str, model: str, duration: float, error: str = None):
         """Record an agent request."""
@@ -227,76 +990,162 @@ class NabdMetrics:
         self.estimated_tokens_total.inc({"type": "input", "model": model}, input_tokens)
         self.estimated_tokens_total.inc({"type": "output", "model": model}, output_tokens)
     
+    def record_llm_client_lookup(self, kind: str, hit: bool):
+        """Record a lookup in the pooled LLM client registry."""
+        self.llm_client_cache_total.inc({"kind": kind, "result": "hit" if hit else "miss"})
+    
+    def record_search_cache(self, provider: str, hit: bool, saved_seconds: float = 0.0):
+        """Record a web_search cache lookup and the latency a hit saved."""
+        self.search_cache_requests_total.inc({"provider": provider, "result": "hit" if hit else "miss"})
+        if hit:
+            self.search_cache_saved_seconds_total.inc({"provider": provider}, saved_seconds)
+    
+    def record_response_cache(self, mode: str, result: str):
+        """Record how a cacheable /run request was answered: hit, miss or coalesced."""
+        self.response_cache_requests_total.inc({"mode": mode, "result": result})
+    
+    def record_cancelled_run(self, mode: str, stage: str, calls_saved: int):
+        """Record an agent run cancelled mid-stream and the model calls it no longer makes."""
+        self.agent_runs_cancelled_total.inc({"mode": mode, "stage": stage})
+        if calls_saved:
+            self.llm_calls_saved_total.inc({"mode": mode}, calls_saved)
+    
+    def stream_recorder(self, mode: str) -> "StreamRecorder":
+        """Start timing one SSE stream."""
+        return StreamRecorder(self, mode)
+    
+    def iter_exposition(self, openmetrics: bool = False) -> Iterator[str]:
+        """
+        Yield the exposition one metric family at a time, in Prometheus
+        text format or OpenMetrics. In multiprocess mode every worker's
+        file is merged first.
+        """
+        directory = multiprocess_dir()
+        series = None
+        if directory is not None and os.path.isdir(directory):
+            series = _read_multiprocess(directory)
+        for metric in self._all_metrics():
+            yield from metric.expose(None if series is None else series.get(metric.name, {}), openmetrics)
+        if openmetrics:
+            yield "# EOF\n"
+    
     def format_prometheus(self) -> str:
         """Format all metrics in Prometheus text format."""
-        lines = []
-        
-        # Counter metrics
-        for metric in [self.http_requests_total, self.agent_requests_total, 
-                       self.agent_errors_total, self.tool_calls_total,
-                       self.estimated_tokens_total, self.rate_limit_exceeded_total]:
-            lines.append(f"# HELP {metric.name} {metric.description}")
-            lines.append(f"# TYPE {metric.name} counter")
-            for item in metric.collect():
-                labels_str = ",".join(f'{k}="{v}"' for k, v in item["labels"].items())
-                lines.append(f'{metric.name}{{{labels_str}}} {item["value"]}')
-        
-        # Gauge metrics
-        for metric in [self.active_connections]:
-            lines.append(f"# HELP {metric.name} {metric.description}")
-            lines.append(f"# TYPE {metric.name} gauge")
-            for item in metric.collect():
-                labels_str = ",".join(f'{k}="{v}"' for k, v in item["labels"].items())
-                lines.append(f'{metric.name}{{{labels_str}}} {item["value"]}')
-        
-        # Histogram metrics
-        for metric in [self.http_request_duration_seconds, self.agent_request_duration_seconds,
-                       self.tool_call_duration_seconds]:
-            lines.append(f"# HELP {metric.name} {metric.description}")
-            lines.append(f"# TYPE {metric.name} histogram")
-            for item in metric.collect():
-                labels_str = ",".join(f'{k}="{v}"' for k, v in item["labels"].items())
-                for bucket, count in sorted(item["buckets"].items()):
-                    le = "+Inf" if bucket == float("inf") else str(bucket)
-                    lines.append(f'{metric.name}_bucket{{{labels_str},le="{le}"}} {count}')
-                lines.append(f'{metric.name}_sum{{{labels_str}}} {item["sum"]}')
-                lines.append(f'{metric.name}_count{{{labels_str}}} {item["count"]}')
-        
-        return "\n".join(lines)
-
-
-class MetricsMiddleware(BaseHTTPMiddleware):
-    """FastAPI middleware for collecting HTTP metrics."""
+        return "".join(self.iter_exposition())
+
+
+class StreamRecorder:
+    """
+    Latency of one SSE stream: time to the first answer frame, time to
+    the first model token, gaps between tokens, and total duration.
+    
+    The model label comes from the first token, so first-frame and
+    first-token times are observed when the stream finishes. `outcome`
+    stays "aborted" unless the stream sets it to completed or error.
+    """
+    
+    def __init__(self, metrics: NabdMetrics, mode: str):
+        self.metrics = metrics
+        self.mode = mode
+        self.model: Optional[str] = None
+        self.start = time.perf_counter()
+        self.first_frame: Optional[float] = None
+        self.first_token: Optional[float] = None
+        self._last_token: Optional[float] = None
+        self._gaps = None
+        self.outcome = "aborted"
+    
+    def frame(self):
+        """An answer data frame was sent to the client."""
+        if self.first_frame is None:
+            self.first_frame = time.perf_counter() - self.start
+    
+    def token(self, model: Optional[str] = None):
+        """A model token arrived from any graph node."""
+        now = time.perf_counter()
+        if self._last_token is None:
+            self.first_token = now - self.start
+            self.model = model or "unknown"
+            self._gaps = self.metrics.sse_inter_token_seconds.labels(mode=self.mode, model=self.model)
+        else:
+            self._gaps.observe(now - self._last_token)
+        self._last_token = now
+    
+    def finish(self):
+        """Record the stream's totals and outcome."""
+        labels = {"mode": self.mode, "model": self.model or "none"}
+        if self.first_frame is not None:
+            self.metrics.sse_time_to_first_frame_seconds.observe(self.first_frame, labels)
+        if self.first_token is not None:
+            self.metrics.sse_time_to_first_token_seconds.observe(self.first_token, labels)
+        self.metrics.sse_stream_duration_seconds.observe(time.perf_counter() - self.start, labels)
+        self.metrics.sse_streams_total.inc({"mode": self.mode, "outcome": self.outcome})
+
+
+UNMATCHED_PATH = "unmatched"
+
+
+def route_template(scope) -> str:
+    """
+    The path template of the app route a request matches (e.g.
+    "/sessions/{session_id}"), or UNMATCHED_PATH, so label values stay
+    bounded by the routes the app defines rather than the URLs clients send.
+    """
+    app = scope.get("app")
+    router = getattr(app, "router", None)
+    for route in getattr(router, "routes", ()):
+        match, _ = route.matches(scope)
+        # PARTIAL: right path, wrong method (405)
+        if match != Match.NONE:
+            return getattr(route, "path", UNMATCHED_PATH)
+    return UNMATCHED_PATH
+
+
+class MetricsMiddleware:
+    """ASGI middleware for collecting HTTP metrics.
+    
+    Written against raw ASGI rather than BaseHTTPMiddleware so streaming
+    bodies pass straight through, and the recorded duration covers the
+    whole response (the end of an SSE stream, not just its headers).
+    Paths are labelled with their route template (see route_template).
+    """
     
     def __init__(self, app, metrics: NabdMetrics):
-        super().__init__(app)
+        self.app = app
         self.metrics = metrics
     
-    async def dispatch(self, request: Request, call_next: Callable):
-        # Skip metrics endpoint itself
-        if request.url.path == "/metrics":
-            return await call_next(request)
+    async def __call__(self, scope, receive, send):
+        # Skip non-HTTP traffic and the metrics endpoint itself
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
         
         start_time = time.time()
+        path = route_template(scope)
+        status = 500
+        response_bytes = 0
+        
+        async def send_wrapper(message):
+            nonlocal status, response_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
         
         # Track active connections
-        path = request.url.path
         self.metrics.active_connections.inc({"endpoint": path})
-        
         try:
-            response = await call_next(request)
-            duration = time.time() - start_time
-            
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.metrics.active_connections.dec({"endpoint": path})
             self.metrics.record_http_request(
-                method=request.method,
+                method=scope["method"],
                 path=path,
-                status=response.status_code,
-                duration=duration
+                status=status,
+                duration=time.time() - start_time,
+                response_bytes=response_bytes
             )
-            
-            return response
-        finally:
-            self.metrics.active_connections.dec({"endpoint": path})
 
 
 # Singleton instance
@@ -311,10 +1160,68 @@ def get_metrics() -> NabdMetrics:
     return _metrics
 
 
-def metrics_endpoint():
-    """Endpoint handler for /metrics."""
-    metrics = get_metrics()
-    return Response(
-        content=metrics.format_prometheus(),
-        media_type="text/plain; version=0.0.4"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+# Bytes gathered before a body chunk is handed to the server
+EXPOSITION_CHUNK_SIZE = 64 * 1024
+
+
+def _accepts(header: str, token: str) -> bool:
+    """Whether an Accept / Accept-Encoding header lists `token` with q > 0."""
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        if name.strip().lower() != token:
+            continue
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def _batched(chunks: Iterable[str]) -> Iterator[bytes]:
+    buffer, size = [], 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        buffer.append(data)
+        size += len(data)
+        if size >= EXPOSITION_CHUNK_SIZE:
+            yield b"".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def _gzipped(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def metrics_endpoint(request: Optional[Request] = None):
+    """
+    Endpoint handler for /metrics.
+    
+    The body is streamed as it is formatted. OpenMetrics is served when
+    the scraper's Accept header asks for it, and gzip when its
+    Accept-Encoding allows it.
+    """
+    headers = request.headers if request is not None else {}
+    openmetrics = _accepts(headers.get("accept", ""), "application/openmetrics-text")
+    body = _batched(get_metrics().iter_exposition(openmetrics))
+    response_headers = {"Vary": "Accept, Accept-Encoding"}
+    if _accepts(headers.get("accept-encoding", ""), "gzip"):
+        body = _gzipped(body)
+        response_headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(
+        body,
+        media_type=OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE,
+        headers=response_headers
     )
@@ -0,0 +1,122 @@
+"""
+Shared-memory GCRA store for the rate limiter (RATE_LIMIT_BACKEND=shm).
+
+Every uvicorn worker on the host maps the same file (under /dev/shm when
+available) holding a fixed-size hash table of (key hash, TAT) slots. The
+table is split into stripes; a read-modify-write holds an fcntl lock on
+its stripe's byte range (plus a thread lock, since fcntl locks are per
+process), so workers only contend when their clients hash to the same
+stripe. No external service is needed.
+
+Slots whose TAT has passed are reused in place; when a stripe's probe
+window is full of live clients, the one closest to expiry is evicted.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from typing import Optional, Tuple
+
+from app.rate_limiter import gcra_update
+
+
+MAGIC = b"NABDRL01"
+# magic, slot count, stripe count
+HEADER = struct.Struct("<8sII")
+HEADER_SIZE = 64
+# key hash (0 = empty), TAT
+SLOT = struct.Struct("<Qd")
+STRIPES = 64
+# Slots inspected per lookup before evicting
+PROBE_LIMIT = 32
+
+
+def default_shm_path() -> str:
+    """A per-user file in /dev/shm, or the temp dir where that is missing."""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    uid = os.getuid() if hasattr(os, "getuid") else 0
+    return os.path.join(directory, f"nabd-ratelimit-{uid}")
+
+
+class SharedMemoryRateLimitStore:
+    """GCRA state shared by all processes that map the same file."""
+
+    def __init__(self, path: Optional[str] = None, slots: int = 65536):
+        self.path = path or default_shm_path()
+        # Round up so every stripe has the same number of slots
+        self.stripe_slots = max(PROBE_LIMIT, -(-slots // STRIPES))
+        self.slots = self.stripe_slots * STRIPES
+        self.size = HEADER_SIZE + self.slots * SLOT.size
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._init_file()
+        self._map = mmap.mmap(self._fd, self.size)
+        self._thread_locks = [threading.Lock() for _ in range(STRIPES)]
+
+    def _init_file(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self._fd, HEADER.size, 0)
+            expected = HEADER.pack(MAGIC, self.slots, STRIPES)
+            if header != expected or os.fstat(self._fd).st_size != self.size:
+                # New file, or one left by a run with a different table size
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self.size)
+                os.pwrite(self._fd, expected, 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _hash(client_key: str) -> int:
+        digest = hashlib.blake2b(client_key.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") or 1
+
+    def update(self, client_key: str, tier: str, now: float, interval: float, tolerance: float) -> Tuple[bool, float]:
+        """Run one GCRA step for the client atomically across processes."""
+        key_hash = self._hash(client_key)
+        stripe = key_hash % STRIPES
+        first = stripe * self.stripe_slots
+        start = (key_hash // STRIPES) % self.stripe_slots
+        offset = HEADER_SIZE + first * SLOT.size
+        length = self.stripe_slots * SLOT.size
+
+        with self._thread_locks[stripe]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+            try:
+                found, free, oldest, oldest_tat = None, None, None, None
+                for step in range(min(PROBE_LIMIT, self.stripe_slots)):
+                    index = first + (start + step) % self.stripe_slots
+                    slot_hash, tat = SLOT.unpack_from(self._map, HEADER_SIZE + index * SLOT.size)
+                    if slot_hash == key_hash:
+                        found = (index, tat)
+                        break
+                    if slot_hash == 0:
+                        if free is None:
+                            free = index
+                        break
+                    if tat <= now and free is None:
+                        free = index
+                    if oldest_tat is None or tat < oldest_tat:
+                        oldest, oldest_tat = index, tat
+
+                if found is not None:
+                    index, tat = found
+                else:
+                    index, tat = (free if free is not None else oldest), now
+
+                allowed, tat = gcra_update(tat, now, interval, tolerance)
+                if allowed:
+                    SLOT.pack_into(self._map, HEADER_SIZE + index * SLOT.size, key_hash, tat)
+                return allowed, tat
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
+
+    def cleanup_expired(self):
+        """Expired slots are reused in place, so there is nothing to sweep."""
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
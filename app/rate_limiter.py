@@ -5,15 +5,17 @@ Provides configurable rate limiting to protect the API from abuse
 and ensure fair usage across all users.
 """
 
+import math
 import os
 import time
-from collections import defaultdict
 from dataclasses import dataclass, field
-from typing import Dict, Optional, Callable
+from typing import Dict, List, Optional, Set, Tuple
 from fastapi import Request, HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import MutableHeaders
 from starlette.responses import JSONResponse
 
+from app.metrics import get_metrics
+
 
 @dataclass
 class RateLimitConfig:
@@ -26,24 +28,161 @@ class RateLimitConfig:
     premium_rpm: int = 200
     # Window size in seconds
     window_seconds: int = 60
+    # Share of a window's requests that may arrive back to back (GCRA burst)
+    burst_ratio: float = 0.25
+    # Concurrent in-flight requests (including open streams) per client
+    anonymous_concurrency: int = 2
+    authenticated_concurrency: int = 4
+    premium_concurrency: int = 10
     # Endpoints to exclude from rate limiting
     excluded_paths: list = field(default_factory=lambda: ["/", "/api/health", "/docs", "/openapi.json"])
+    # Hard cap on tracked client keys; new clients beyond it share one entry per tier
+    max_keys: int = 100_000
+    # Where GCRA state lives: "memory" (this process) or "shm" (all workers on the host)
+    backend: str = "memory"
+    # Shared-memory table file and its capacity (shm backend only)
+    shm_path: Optional[str] = None
+    shm_slots: int = 65536
 
 
-@dataclass
 class RateLimitEntry:
     """Tracks rate limit state for a single client."""
-    request_count: int = 0
-    window_start: float = field(default_factory=time.time)
+    __slots__ = ("tat", "slot")
+
+    def __init__(self, tat: float):
+        # GCRA theoretical arrival time; the entry is idle once it has passed
+        self.tat = tat
+        # Timing wheel slot holding this key
+        self.slot = -1
+
+
+class TimingWheel:
+    """Buckets keys by expiry time so expired keys are found without a scan.
+
+    Expiries must lie at most `horizon` seconds ahead. Advancing visits
+    only the slots whose time has passed, so the cost is proportional to
+    the keys that actually expire.
+    """
+
+    def __init__(self, horizon: float, slots: int = 64):
+        self.resolution = max(horizon, 0.001) / (slots - 1)
+        self.slots: List[Set[str]] = [set() for _ in range(slots)]
+        self.tick: Optional[int] = None
+
+    def schedule(self, key: str, expires_at: float) -> int:
+        """Add key to the slot for its expiry and return the slot index."""
+        slot = math.ceil(expires_at / self.resolution) % len(self.slots)
+        self.slots[slot].add(key)
+        return slot
+
+    def unschedule(self, key: str, slot: int):
+        if slot >= 0:
+            self.slots[slot].discard(key)
+
+    def advance(self, now: float) -> List[str]:
+        """Return keys from every slot that came due since the last call."""
+        current = math.floor(now / self.resolution)
+        if self.tick is None:
+            self.tick = current
+        if current <= self.tick:
+            return []
+
+        due = []
+        # After a long idle period, one pass over every slot is enough
+        for tick in range(max(self.tick + 1, current - len(self.slots) + 1), current + 1):
+            bucket = self.slots[tick % len(self.slots)]
+            if bucket:
+                due.extend(bucket)
+                bucket.clear()
+        self.tick = current
+        return due
+
+
+def gcra_update(tat: float, now: float, interval: float, tolerance: float) -> Tuple[bool, float]:
+    """
+    Apply one GCRA step to a stored theoretical arrival time.
+    
+    Returns (allowed, tat): the TAT to store if allowed, otherwise the
+    unchanged TAT (the request may be retried at tat - tolerance).
+    """
+    tat = max(tat, now)
+    if now < tat - tolerance:
+        return False, tat
+    return True, tat + interval
+
+
+class MemoryRateLimitStore:
+    """GCRA state for this process only, expired through a timing wheel."""
+    
+    def __init__(self, config: RateLimitConfig):
+        self.config = config
+        self.clients: Dict[str, RateLimitEntry] = {}
+        self._wheel = TimingWheel(self.config.window_seconds)
+        self._overflowing = False
+    
+    def update(self, client_key: str, tier: str, now: float, interval: float, tolerance: float) -> Tuple[bool, float]:
+        """Run one GCRA step for the client; see gcra_update."""
+        self._expire(now)
+        client_key, entry = self._get_entry(client_key, tier, now)
+        allowed, tat = gcra_update(entry.tat, now, interval, tolerance)
+        if allowed:
+            entry.tat = tat
+            self._wheel.unschedule(client_key, entry.slot)
+            entry.slot = self._wheel.schedule(client_key, tat)
+        return allowed, tat
+    
+    def _get_entry(self, client_key: str, tier: str, current_time: float) -> Tuple[str, RateLimitEntry]:
+        entry = self.clients.get(client_key)
+        if entry is not None:
+            return client_key, entry
+
+        if len(self.clients) >= self.config.max_keys:
+            # Key flood: new clients share one entry per tier instead of growing memory
+            if not self._overflowing:
+                print(f"Rate limiter tracking {len(self.clients)} keys; new clients share an overflow entry")
+                self._overflowing = True
+            client_key = f"overflow:{tier}"
+            entry = self.clients.get(client_key)
+            if entry is not None:
+                return client_key, entry
+        else:
+            self._overflowing = False
+
+        entry = RateLimitEntry(current_time)
+        self.clients[client_key] = entry
+        return client_key, entry
+    
+    def _expire(self, current_time: float):
+        """Drop entries whose TAT has passed, as found by the timing wheel."""
+        for key in self._wheel.advance(current_time):
+            entry = self.clients.get(key)
+            if entry is None:
+                continue
+            if entry.tat <= current_time:
+                del self.clients[key]
+            else:
+                # Not due yet (seen early after an idle gap): put it back
+                entry.slot = self._wheel.schedule(key, entry.tat)
+    
+    def cleanup_expired(self):
+        self._expire(time.time())
 
 
 class RateLimiter:
-    """In-memory rate limiter using sliding window algorithm."""
+    """Rate limiter using the generic cell rate algorithm (GCRA).
+
+    Each tier's per-window limit becomes a steady emission interval plus a
+    small burst allowance, so clients cannot double up across a window
+    boundary. Concurrent in-flight requests are capped per client by tier.
+    GCRA state is kept in this process by default; RATE_LIMIT_BACKEND=shm
+    shares it between all uvicorn workers on the host.
+    """
     
     def __init__(self, config: Optional[RateLimitConfig] = None):
         self.config = config or RateLimitConfig()
         self._load_env_config()
-        self.clients: Dict[str, RateLimitEntry] = defaultdict(RateLimitEntry)
+        self.store = self._create_store()
+        self.in_flight: Dict[str, int] = {}
     
     def _load_env_config(self):
         """Load configuration from environment variables."""
@@ -55,6 +194,31 @@ class RateLimiter:
             self.config.premium_rpm = int(os.getenv("RATE_LIMIT_PREMIUM_RPM"))
         if os.getenv("RATE_LIMIT_WINDOW_SECONDS"):
             self.config.window_seconds = int(os.getenv("RATE_LIMIT_WINDOW_SECONDS"))
+        if os.getenv("RATE_LIMIT_BURST_RATIO"):
+            self.config.burst_ratio = float(os.getenv("RATE_LIMIT_BURST_RATIO"))
+        if os.getenv("RATE_LIMIT_ANONYMOUS_CONCURRENCY"):
+            self.config.anonymous_concurrency = int(os.getenv("RATE_LIMIT_ANONYMOUS_CONCURRENCY"))
+        if os.getenv("RATE_LIMIT_AUTHENTICATED_CONCURRENCY"):
+            self.config.authenticated_concurrency = int(os.getenv("RATE_LIMIT_AUTHENTICATED_CONCURRENCY"))
+        if os.getenv("RATE_LIMIT_PREMIUM_CONCURRENCY"):
+            self.config.premium_concurrency = int(os.getenv("RATE_LIMIT_PREMIUM_CONCURRENCY"))
+        if os.getenv("RATE_LIMIT_MAX_KEYS"):
+            self.config.max_keys = int(os.getenv("RATE_LIMIT_MAX_KEYS"))
+        if os.getenv("RATE_LIMIT_BACKEND"):
+            self.config.backend = os.getenv("RATE_LIMIT_BACKEND").lower()
+        if os.getenv("RATE_LIMIT_SHM_PATH"):
+            self.config.shm_path = os.getenv("RATE_LIMIT_SHM_PATH")
+        if os.getenv("RATE_LIMIT_SHM_SLOTS"):
+            self.config.shm_slots = int(os.getenv("RATE_LIMIT_SHM_SLOTS"))
+    
+    def _create_store(self):
+        """Build the GCRA state store selected by config.backend."""
+        if self.config.backend == "shm":
+            from app.rate_limit_shm import SharedMemoryRateLimitStore
+            return SharedMemoryRateLimitStore(self.config.shm_path, self.config.shm_slots)
+        if self.config.backend != "memory":
+            print(f"Unknown RATE_LIMIT_BACKEND '{self.config.backend}', using memory")
+        return MemoryRateLimitStore(self.config)
     
     def _get_client_key(self, request: Request) -> str:
         """Generate a unique key for the client."""
@@ -85,6 +249,10 @@ class RateLimiter:
         
         return "anonymous"
     
+    def client_identity(self, request: Request) -> Tuple[str, str]:
+        """Return the (client key, tier) this limiter uses for a request."""
+        return self._get_client_key(request), self._get_user_tier(request)
+    
     def _get_limit_for_tier(self, tier: str) -> int:
         """Get the rate limit for a given tier."""
         limits = {
@@ -94,6 +262,15 @@ class RateLimiter:
         }
         return limits.get(tier, self.config.anonymous_rpm)
     
+    def _get_concurrency_for_tier(self, tier: str) -> int:
+        """Get the in-flight request cap for a given tier."""
+        limits = {
+            "anonymous": self.config.anonymous_concurrency,
+            "authenticated": self.config.authenticated_concurrency,
+            "premium": self.config.premium_concurrency,
+        }
+        return limits.get(tier, self.config.anonymous_concurrency)
+    
     def is_allowed(self, request: Request) -> tuple[bool, dict]:
         """
         Check if request is allowed under rate limiting rules.
@@ -109,91 +286,126 @@ class RateLimiter:
         tier = self._get_user_tier(request)
         limit = self._get_limit_for_tier(tier)
         
-        current_time = time.time()
-        entry = self.clients[client_key]
-        
-        # Reset window if expired
-        if current_time - entry.window_start >= self.config.window_seconds:
-            entry.request_count = 0
-            entry.window_start = current_time
+        # GCRA: requests are spaced `interval` apart, with `tolerance` of burst
+        interval = self.config.window_seconds / max(1, limit)
+        burst = max(1, math.ceil(limit * self.config.burst_ratio))
+        tolerance = interval * (burst - 1)
         
-        # Check if limit exceeded
-        remaining = max(0, limit - entry.request_count)
-        reset_time = int(entry.window_start + self.config.window_seconds)
+        current_time = time.time()
+        allowed, new_tat = self.store.update(client_key, tier, current_time, interval, tolerance)
         
         rate_info = {
             "X-RateLimit-Limit": str(limit),
-            "X-RateLimit-Remaining": str(remaining),
-            "X-RateLimit-Reset": str(reset_time),
+            "X-RateLimit-Remaining": "0",
+            "X-RateLimit-Reset": str(math.ceil(new_tat)),
             "X-RateLimit-Tier": tier,
         }
         
-        if entry.request_count >= limit:
+        if not allowed:
+            rate_info["Retry-After"] = str(math.ceil(new_tat - tolerance - current_time))
             return False, rate_info
         
-        # Increment counter
-        entry.request_count += 1
-        rate_info["X-RateLimit-Remaining"] = str(max(0, limit - entry.request_count))
+        remaining = math.floor((tolerance - (new_tat - current_time)) / interval + 1e-9) + 1
+        rate_info["X-RateLimit-Remaining"] = str(max(0, remaining))
         
         return True, rate_info
     
+    def acquire_slot(self, request: Request) -> Optional[str]:
+        """
+        Reserve one in-flight slot for the client.
+        
+        Returns the key to pass to release_slot, or None when the client
+        already has its tier's maximum of requests in flight.
+        """
+        client_key = self._get_client_key(request)
+        in_flight = self.in_flight.get(client_key, 0)
+        if in_flight >= self._get_concurrency_for_tier(self._get_user_tier(request)):
+            return None
+        self.in_flight[client_key] = in_flight + 1
+        return client_key
+    
+    def release_slot(self, client_key: str):
+        """Release a slot taken by acquire_slot."""
+        in_flight = self.in_flight.get(client_key, 0) - 1
+        if in_flight > 0:
+            self.in_flight[client_key] = in_flight
+        else:
+            self.in_flight.pop(client_key, None)
+    
     def cleanup_expired(self):
         """Remove expired entries to prevent memory bloat."""
-        current_time = time.time()
-        expired_keys = [
-            key for key, entry in self.clients.items()
-            if current_time - entry.window_start >= self.config.window_seconds * 2
-        ]
-        for key in expired_keys:
-            del self.clients[key]
+        self.store.cleanup_expired()
 
 
-class RateLimitMiddleware(BaseHTTPMiddleware):
-    """FastAPI middleware for rate limiting."""
+class RateLimitMiddleware:
+    """ASGI middleware for rate limiting.
+    
+    Settings are read once at startup. In-flight slots are held until the
+    wrapped app returns, i.e. until a streamed body has been fully sent or
+    the client went away.
+    """
     
     def __init__(self, app, rate_limiter: Optional[RateLimiter] = None):
-        super().__init__(app)
+        self.app = app
         self.rate_limiter = rate_limiter or RateLimiter()
-        self._cleanup_counter = 0
-    
-    async def dispatch(self, request: Request, call_next: Callable):
+        
         # Check rate limit (disabled in development by default)
         env = os.getenv("ENV", "development").lower()
         rate_limit_enabled = os.getenv("RATE_LIMIT_ENABLED", "auto").lower()
+        self.enabled = rate_limit_enabled == "true" or (rate_limit_enabled == "auto" and env == "production")
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.enabled:
+            await self.app(scope, receive, send)
+            return
         
-        if rate_limit_enabled == "false":
-            return await call_next(request)
-        
-        if rate_limit_enabled == "auto" and env != "production":
-            return await call_next(request)
-        
+        request = Request(scope)
         is_allowed, rate_info = self.rate_limiter.is_allowed(request)
         
         if not is_allowed:
-            return JSONResponse(
+            get_metrics().rate_limit_exceeded_total.inc({"tier": rate_info["X-RateLimit-Tier"]})
+            response = JSONResponse(
                 status_code=429,
                 content={
                     "detail": "Rate limit exceeded. Please try again later.",
                     "error": "too_many_requests",
-                    "retry_after": int(rate_info.get("X-RateLimit-Reset", 60)) - int(time.time())
+                    "retry_after": int(rate_info.get("Retry-After", 1))
                 },
                 headers=rate_info
             )
+            await response(scope, receive, send)
+            return
         
-        # Process request
-        response = await call_next(request)
-        
-        # Add rate limit headers to response
-        for key, value in rate_info.items():
-            response.headers[key] = value
+        slot = None
+        if rate_info:
+            slot = self.rate_limiter.acquire_slot(request)
+            if slot is None:
+                get_metrics().rate_limit_exceeded_total.inc({"tier": rate_info["X-RateLimit-Tier"]})
+                response = JSONResponse(
+                    status_code=429,
+                    content={
+                        "detail": "Too many concurrent requests. Wait for one to finish.",
+                        "error": "too_many_concurrent_requests",
+                        "retry_after": 1
+                    },
+                    headers={**rate_info, "Retry-After": "1"}
+                )
+                await response(scope, receive, send)
+                return
         
-        # Periodic cleanup (every 100 requests)
-        self._cleanup_counter += 1
-        if self._cleanup_counter >= 100:
-            self.rate_limiter.cleanup_expired()
-            self._cleanup_counter = 0
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                # Add rate limit headers to response
+                headers = MutableHeaders(scope=message)
+                for key, value in rate_info.items():
+                    headers[key] = value
+            await send(message)
         
-        return response
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if slot is not None:
+                self.rate_limiter.release_slot(slot)
 
 
 # Singleton instance
@@ -0,0 +1,255 @@
+"""
+Exact-match response cache and request coalescing for /run.
+
+Opt-in with RESPONSE_CACHE_ENABLED. Answers are keyed by mode, model, the
+normalized message and a digest of the history, expire after a TTL, and
+the least recently used are evicted past max_entries. A run that called a
+tool with side effects (python_repl, file_writer, ...) is not stored:
+replaying its answer would silently skip the effect.
+
+With singleflight on, identical requests that arrive while a run is in
+flight share it. /run callers await the leader's answer; /run/stream
+callers subscribe to a StreamFlight, which replays the frames sent so far
+and then fans out each new frame to every subscriber.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from app.metrics import get_metrics
+
+
+@dataclass
+class ResponseCacheConfig:
+    """Configuration for the /run response cache."""
+    enabled: bool = False
+    # Seconds a cached answer stays valid
+    ttl_seconds: float = 300.0
+    # Maximum answers kept in memory
+    max_entries: int = 512
+    # Let identical in-flight requests share one graph run
+    singleflight: bool = True
+    # Tools whose effects a cached answer would skip
+    side_effect_tools: Set[str] = field(default_factory=lambda: {
+        "python_repl",
+        "file_writer",
+        "generate_image",
+    })
+
+
+def normalize_message(message: str) -> str:
+    """Case-fold and collapse whitespace so trivially different messages share an entry."""
+    return " ".join(message.casefold().split())
+
+
+def history_digest(history: List[Dict[str, str]]) -> str:
+    """Stable digest of a request's history."""
+    raw = json.dumps(history, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ToolUseTracker(BaseCallbackHandler):
+    """Collects the names of tools called during one graph run."""
+
+    run_inline = True
+
+    def __init__(self):
+        self.tools: Set[str] = set()
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any):
+        self.tools.add(kwargs.get("name") or (serialized or {}).get("name") or "unknown")
+
+
+class StreamFlight:
+    """
+    One streaming run shared by identical requests.
+
+    Frames are kept for the lifetime of the run so late subscribers start
+    from the beginning. The run is cancelled once its last subscriber
+    leaves, as an unshared stream is when its client disconnects.
+    """
+
+    def __init__(self, source: AsyncIterator, context: Any = None):
+        self.frames: list = []
+        self.done = False
+        # Whatever the leader wants subscribers to see (e.g. its stream recorder)
+        self.context = context
+        self.subscribers = 0
+        self.on_close: Optional[Callable[["StreamFlight"], None]] = None
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._pump(source))
+
+    async def _pump(self, source: AsyncIterator):
+        try:
+            async for frame in source:
+                self.frames.append(frame)
+                self._notify()
+        except Exception as e:
+            print(f"Shared stream error: {e}")
+        finally:
+            self._close()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _close(self):
+        if not self.done:
+            self.done = True
+            self._notify()
+            if self.on_close is not None:
+                self.on_close(self)
+
+    async def subscribe(self) -> AsyncIterator:
+        """Yield every frame of the run, from the first."""
+        self.subscribers += 1
+        try:
+            sent = 0
+            while True:
+                while sent < len(self.frames):
+                    yield self.frames[sent]
+                    sent += 1
+                if self.done:
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                # Nobody is listening any more: stop the run, and let the next
+                # identical request start a fresh one
+                self._close()
+                self._task.cancel()
+
+
+class ResponseCache:
+    """TTL + LRU cache of /run answers, with singleflight for in-flight runs."""
+
+    def __init__(self, config: Optional[ResponseCacheConfig] = None):
+        self.config = config or ResponseCacheConfig()
+        self._load_env_config()
+        self._lock = threading.Lock()
+        # key -> (expires_at, answer)
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        # key -> in-flight run, for /run and /run/stream respectively
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._flights: Dict[str, StreamFlight] = {}
+
+    def _load_env_config(self):
+        """Load configuration from environment variables."""
+        if os.getenv("RESPONSE_CACHE_ENABLED"):
+            self.config.enabled = os.getenv("RESPONSE_CACHE_ENABLED").lower() == "true"
+        if os.getenv("RESPONSE_CACHE_TTL_SEC"):
+            self.config.ttl_seconds = float(os.getenv("RESPONSE_CACHE_TTL_SEC"))
+        if os.getenv("RESPONSE_CACHE_MAX_ENTRIES"):
+            self.config.max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES"))
+        if os.getenv("RESPONSE_CACHE_SINGLEFLIGHT"):
+            self.config.singleflight = os.getenv("RESPONSE_CACHE_SINGLEFLIGHT").lower() != "false"
+        if os.getenv("RESPONSE_CACHE_SIDE_EFFECT_TOOLS") is not None:
+            raw = os.getenv("RESPONSE_CACHE_SIDE_EFFECT_TOOLS")
+            self.config.side_effect_tools = {name.strip() for name in raw.split(",") if name.strip()}
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.enabled
+
+    def key(self, mode: str, model: str, message: str, history: List[Dict[str, str]]) -> str:
+        """Cache key of a request."""
+        raw = "\x1f".join((mode, model, normalize_message(message), history_digest(history)))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str, mode: str) -> Optional[str]:
+        """Return a cached answer, or None on a miss."""
+        if not self.config.enabled:
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+
+        get_metrics().record_response_cache(mode, "hit")
+        return entry[1]
+
+    def store(self, key: str, mode: str, answer: str, tools_used: Iterable[str]) -> bool:
+        """Cache a finished run's answer unless it called a side-effect tool."""
+        if not self.config.enabled:
+            return False
+        if self.config.side_effect_tools.intersection(tools_used):
+            get_metrics().response_cache_skipped_total.inc({"mode": mode})
+            return False
+
+        with self._lock:
+            self._entries[key] = (time.time() + self.config.ttl_seconds, answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.config.max_entries:
+                self._entries.popitem(last=False)
+        return True
+
+    def clear(self):
+        """Drop every cached answer."""
+        with self._lock:
+            self._entries.clear()
+
+    async def run_once(self, key: str, mode: str, run: Callable[[], Awaitable[str]]) -> str:
+        """Await `run()`, or the identical run already in flight."""
+        pending = self._pending.get(key) if self.config.singleflight else None
+        if pending is not None:
+            get_metrics().record_response_cache(mode, "coalesced")
+            return await asyncio.shield(pending)
+
+        get_metrics().record_response_cache(mode, "miss")
+        if not self.config.singleflight:
+            return await run()
+
+        # A task of its own, so the leader's caller going away does not fail the followers
+        pending = asyncio.ensure_future(run())
+        self._pending[key] = pending
+        pending.add_done_callback(lambda done: self._forget(self._pending, key, done))
+        return await asyncio.shield(pending)
+
+    def join_stream(self, key: str, mode: str, start: Callable[[], Tuple[AsyncIterator, Any]]) -> StreamFlight:
+        """
+        The streaming run in flight for `key`, or a new one from `start()`,
+        which returns the run's frames and the flight's context.
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            get_metrics().record_response_cache(mode, "coalesced")
+            return flight
+
+        get_metrics().record_response_cache(mode, "miss")
+        flight = StreamFlight(*start())
+        flight.on_close = lambda closed: self._forget(self._flights, key, closed)
+        self._flights[key] = flight
+        return flight
+
+    @staticmethod
+    def _forget(registry: dict, key: str, value: Any):
+        if registry.get(key) is value:
+            del registry[key]
+
+
+# Singleton instance
+_response_cache = None
+
+
+def get_response_cache() -> ResponseCache:
+    """Get the global response cache instance."""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
@@ -1,106 +1,433 @@
+import asyncio
 import os
 import shutil
 import subprocess
 import tempfile
-from typing import Optional
+import threading
+import time
+import uuid
+from typing import List, Optional, Tuple
 
+from app.metrics import get_metrics
+from app.sandbox_kernels import KERNEL_LOOP, KernelManager, KernelResult
+from app.sandbox_pool import POOL_LABEL, DockerSandboxPool
+from app.sandbox_process import ProcessLimits, ProcessResult, run_process, arun_process, spawn_process, stop_process
+from app.sandbox_queue import SandboxJobQueue, SandboxQueueFull
 
-def run_python_sandboxed(code: str) -> str:
-    """
-    Execute Python code inside a locked-down Docker container.
-    The tool is disabled by default; enable via PYTHON_TOOL_MODE=docker.
-    """
-    mode = (os.getenv("PYTHON_TOOL_MODE") or "disabled").strip().lower()
+
+SANDBOX_MODES = {"docker", "process"}
+
+
+def _get_mode() -> str:
+    return (os.getenv("PYTHON_TOOL_MODE") or "disabled").strip().lower()
+
+
+def _mode_error(mode: str) -> Optional[str]:
     if mode in {"", "0", "false", "off", "disabled"}:
         return (
             "Python tool is disabled for safety. "
-            "Set PYTHON_TOOL_MODE=docker to enable sandboxed execution."
+            "Set PYTHON_TOOL_MODE=docker (or process) to enable sandboxed execution."
         )
 
-    if mode != "docker":
-        return f"Unsupported PYTHON_TOOL_MODE '{mode}'. Use 'docker'."
+    if mode not in SANDBOX_MODES:
+        return f"Unsupported PYTHON_TOOL_MODE '{mode}'. Use 'docker' or 'process'."
+    return None
 
+
+def run_python_sandboxed(code: str, session_id: Optional[str] = None) -> str:
+    """
+    Execute Python code inside a locked-down Docker container, or a
+    resource-limited child process when PYTHON_TOOL_MODE=process.
+    The tool is disabled by default; enable via PYTHON_TOOL_MODE=docker.
+
+    With PYTHON_SANDBOX_KERNELS=true and a session_id, the code runs in
+    that session's persistent kernel so state carries over between calls.
+    """
+    mode = _get_mode()
+    error = _mode_error(mode)
+    if error:
+        return error
+
+    if session_id and _kernels_enabled():
+        output = _run_in_kernel(session_id, code)
+        if output is not None:
+            return output
+    if mode == "process":
+        return _run_in_process(code)
     return _run_in_docker(code)
 
 
-def _run_in_docker(code: str) -> str:
+async def arun_python_sandboxed(code: str, session_id: Optional[str] = None) -> str:
+    """
+    Async variant of run_python_sandboxed built on asyncio subprocesses.
+
+    Jobs go through a process-wide bounded queue. If the caller is
+    cancelled, the container (or child process group) running the job
+    is killed.
+    """
+    mode = _get_mode()
+    error = _mode_error(mode)
+    if error:
+        return error
+
+    try:
+        async with get_sandbox_queue().slot():
+            start_time = time.time()
+            try:
+                if session_id and _kernels_enabled():
+                    output = await _arun_in_kernel(session_id, code)
+                    if output is not None:
+                        return output
+                if mode == "process":
+                    return await _arun_in_process(code)
+                return await _arun_in_docker(code)
+            finally:
+                get_metrics().sandbox_execution_seconds.observe(time.time() - start_time, {"mode": mode})
+    except SandboxQueueFull as exc:
+        return str(exc)
+
+
+def _code_error(code: str) -> Optional[str]:
     if not isinstance(code, str) or not code.strip():
         return "No code provided."
 
     max_code_chars = _get_env_int("PYTHON_SANDBOX_MAX_CODE_CHARS", 4000, 100, 20000)
     if len(code) > max_code_chars:
         return f"Code too long. Max {max_code_chars} characters."
+    return None
+
+
+def _docker_error(code: str) -> Optional[str]:
+    error = _code_error(code)
+    if error:
+        return error
 
     if shutil.which("docker") is None:
         return "Docker is not available on this host."
+    return None
 
-    image = os.getenv("PYTHON_SANDBOX_IMAGE", "python:3.12-alpine").strip()
-    timeout_sec = _get_env_int("PYTHON_SANDBOX_TIMEOUT_SEC", 10, 1, 120)
-    memory_mb = _get_env_int("PYTHON_SANDBOX_MEMORY_MB", 256, 64, 2048)
-    pids_limit = _get_env_int("PYTHON_SANDBOX_PIDS", 64, 16, 1024)
-    cpu_limit = _get_env_float("PYTHON_SANDBOX_CPU", 0.5, 0.1, 4.0)
-    max_output_chars = _get_env_int("PYTHON_SANDBOX_MAX_OUTPUT_CHARS", 4000, 200, 20000)
 
+def _process_limits(timeout_sec: int) -> ProcessLimits:
+    return ProcessLimits(
+        cpu_seconds=timeout_sec,
+        address_space_mb=_get_env_int("PYTHON_SANDBOX_ADDRESS_SPACE_MB", 1024, 128, 8192),
+        open_files=_get_env_int("PYTHON_SANDBOX_OPEN_FILES", 64, 16, 1024),
+        file_size_mb=_get_env_int("PYTHON_SANDBOX_FILE_SIZE_MB", 64, 1, 1024),
+        processes=_get_env_int("PYTHON_SANDBOX_PIDS", 64, 16, 1024),
+        isolate_network=True,
+        require_network_isolation=os.getenv("PYTHON_SANDBOX_REQUIRE_NETNS", "false").lower() == "true",
+        isolate_filesystem=True,
+        require_filesystem_isolation=os.getenv("PYTHON_SANDBOX_REQUIRE_FS_ISOLATION", "true").lower() != "false",
+    )
+
+
+def _sandbox_data_dir() -> str:
     data_dir = os.path.abspath(os.getenv("PYTHON_SANDBOX_DATA_DIR", "data"))
     os.makedirs(data_dir, exist_ok=True)
+    return data_dir
+
+
+def _format_process_result(result: ProcessResult, timeout_sec: int, max_output_chars: int) -> str:
+    if result.timed_out:
+        return f"Execution timed out after {timeout_sec}s."
+    return _format_output(result.stdout, result.stderr, max_output_chars)
+
+
+def _run_in_process(code: str) -> str:
+    error = _code_error(code)
+    if error:
+        return error
+
+    timeout_sec = _get_env_int("PYTHON_SANDBOX_TIMEOUT_SEC", 10, 1, 120)
+    max_output_chars = _get_env_int("PYTHON_SANDBOX_MAX_OUTPUT_CHARS", 4000, 200, 20000)
+    try:
+        result = run_process(code, _process_limits(timeout_sec), timeout_sec, _sandbox_data_dir())
+    except Exception as exc:
+        return f"Sandbox execution failed: {exc}"
+    return _format_process_result(result, timeout_sec, max_output_chars)
+
+
+async def _arun_in_process(code: str) -> str:
+    error = _code_error(code)
+    if error:
+        return error
+
+    timeout_sec = _get_env_int("PYTHON_SANDBOX_TIMEOUT_SEC", 10, 1, 120)
+    max_output_chars = _get_env_int("PYTHON_SANDBOX_MAX_OUTPUT_CHARS", 4000, 200, 20000)
+    try:
+        result = await arun_process(code, _process_limits(timeout_sec), timeout_sec, _sandbox_data_dir())
+    except Exception as exc:
+        return f"Sandbox execution failed: {exc}"
+    return _format_process_result(result, timeout_sec, max_output_chars)
+
+
+def _kernels_enabled() -> bool:
+    return os.getenv("PYTHON_SANDBOX_KERNELS", "false").lower() == "true"
+
+
+def _format_kernel_result(result: KernelResult, timeout_sec: int, max_output_chars: int) -> str:
+    if result.status == "timeout":
+        return f"Execution timed out after {timeout_sec}s. The session kernel was restarted; earlier state is lost."
+    if result.status == "exited":
+        detail = f"\n{result.stderr.strip()}" if result.stderr.strip() else ""
+        return _truncate(f"The session kernel exited; earlier state is lost.{detail}", max_output_chars)
+    return _format_output(result.stdout, result.stderr, max_output_chars)
+
+
+def _run_in_kernel(session_id: str, code: str) -> Optional[str]:
+    """Run code in the session's kernel; None means no kernel was free."""
+    error = _code_error(code)
+    if error:
+        return error
+
+    timeout_sec = _get_env_int("PYTHON_SANDBOX_TIMEOUT_SEC", 10, 1, 120)
+    max_output_chars = _get_env_int("PYTHON_SANDBOX_MAX_OUTPUT_CHARS", 4000, 200, 20000)
+    result = get_kernel_manager().execute(session_id, code, timeout_sec, max_output_chars)
+    if result is None:
+        return None
+    return _format_kernel_result(result, timeout_sec, max_output_chars)
+
+
+async def _arun_in_kernel(session_id: str, code: str) -> Optional[str]:
+    try:
+        return await asyncio.to_thread(_run_in_kernel, session_id, code)
+    except asyncio.CancelledError:
+        # The worker thread cannot be cancelled; killing the kernel unblocks it
+        await asyncio.shield(asyncio.to_thread(get_kernel_manager().discard, session_id))
+        raise
+
+
+def _spawn_kernel():
+    """Start a kernel under the current mode's isolation."""
+    if _get_mode() == "process":
+        limits = _process_limits(_get_env_int("PYTHON_SANDBOX_KERNEL_CPU_SEC", 300, 10, 3600))
+        proc, workdir = spawn_process(KERNEL_LOOP, limits, _sandbox_data_dir())
+        return proc, lambda: stop_process(proc, workdir)
+
+    if shutil.which("docker") is None:
+        raise RuntimeError("Docker is not available on this host.")
+    container = f"nabd-sbx-kernel-{uuid.uuid4().hex[:12]}"
+    proc = subprocess.Popen(
+        [
+            "docker", "run", "-i", "--rm", "--name", container,
+            "--label", f"{POOL_LABEL}={os.getpid()}",
+            *_docker_run_args(), _sandbox_image(),
+            "python", "-u", "-c", KERNEL_LOOP,
+        ],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+
+    def cleanup():
+        proc.kill()
+        _remove_container(container)
+        proc.wait()
+
+    return proc, cleanup
+
+
+def _acquire_warm_container() -> Tuple[Optional[DockerSandboxPool], Optional[str]]:
+    """Take a warm container, together with the pool it must be handed back to.
+
+    The pool is returned rather than looked up again on discard: once
+    close_sandbox_pool() has run, get_sandbox_pool() would build a new pool.
+    """
+    pool = get_sandbox_pool()
+    if pool is None:
+        get_metrics().sandbox_cold_starts_total.inc({"reason": "pool_disabled"})
+        return None, None
+    container = pool.acquire(_get_env_float("PYTHON_SANDBOX_POOL_WAIT_SEC", 2.0, 0.0, 30.0))
+    if container is None:
+        get_metrics().sandbox_cold_starts_total.inc({"reason": "pool_empty"})
+    return pool, container
+
+
+def _discard_acquired(acquiring: "asyncio.Future[Tuple[Optional[DockerSandboxPool], Optional[str]]]"):
+    if acquiring.cancelled() or acquiring.exception() is not None:
+        return
+    pool, container = acquiring.result()
+    if container is not None:
+        pool.discard(container)
+
+
+async def _aacquire_warm_container() -> Tuple[Optional[DockerSandboxPool], Optional[str]]:
+    """_acquire_warm_container off the event loop.
+
+    The worker thread cannot be interrupted, so if the caller is cancelled
+    while it waits, the container it still takes is discarded once it does.
+    """
+    acquiring = asyncio.ensure_future(asyncio.to_thread(_acquire_warm_container))
+    try:
+        return await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        acquiring.add_done_callback(_discard_acquired)
+        raise
+
+
+def _cold_run_cmd(container: str, sandbox_dir: str) -> List[str]:
+    return [
+        "docker",
+        "run",
+        "--rm",
+        "--name",
+        container,
+        *_docker_run_args(),
+        "-v",
+        f"{_format_mount_path(sandbox_dir)}:/sandbox:ro",
+        _sandbox_image(),
+        "python",
+        "-u",
+        "main.py",
+    ]
+
+
+def _run_in_docker(code: str) -> str:
+    error = _docker_error(code)
+    if error:
+        return error
+
+    timeout_sec = _get_env_int("PYTHON_SANDBOX_TIMEOUT_SEC", 10, 1, 120)
+    max_output_chars = _get_env_int("PYTHON_SANDBOX_MAX_OUTPUT_CHARS", 4000, 200, 20000)
+
+    pool, container = _acquire_warm_container()
+    if container is not None:
+        try:
+            return _exec_in_container(container, code, timeout_sec, max_output_chars)
+        finally:
+            pool.discard(container)
 
     with tempfile.TemporaryDirectory() as temp_dir:
         script_path = os.path.join(temp_dir, "main.py")
         with open(script_path, "w", encoding="utf-8") as handle:
             handle.write(code)
 
-        sandbox_mount = _format_mount_path(temp_dir)
-        data_mount = _format_mount_path(data_dir)
-
-        cmd = [
-            "docker",
-            "run",
-            "--rm",
-            "--network",
-            "none",
-            "--cpus",
-            str(cpu_limit),
-            "--memory",
-            f"{memory_mb}m",
-            "--pids-limit",
-            str(pids_limit),
-            "--security-opt",
-            "no-new-privileges",
-            "--cap-drop",
-            "ALL",
-            "--tmpfs",
-            "/tmp:rw,noexec,nosuid,nodev,size=64m",
-            "--read-only",
-            "-e",
-            "PYTHONDONTWRITEBYTECODE=1",
-            "-e",
-            "PYTHONUNBUFFERED=1",
-            "-v",
-            f"{sandbox_mount}:/sandbox:ro",
-            "-v",
-            f"{data_mount}:/sandbox/data:rw",
-            "-w",
-            "/sandbox",
-            image,
-            "python",
-            "-u",
-            "main.py",
-        ]
-
+        container = _cold_container_name()
         try:
             result = subprocess.run(
-                cmd,
+                _cold_run_cmd(container, temp_dir),
                 capture_output=True,
                 text=True,
                 timeout=timeout_sec,
             )
         except subprocess.TimeoutExpired:
+            # Killing the docker client does not stop the container itself
+            _remove_container(container)
             return f"Execution timed out after {timeout_sec}s."
         except Exception as exc:
             return f"Sandbox execution failed: {exc}"
 
-    stdout = (result.stdout or "").strip()
-    stderr = (result.stderr or "").strip()
+    return _format_output(result.stdout, result.stderr, max_output_chars)
+
+
+async def _arun_in_docker(code: str) -> str:
+    error = _docker_error(code)
+    if error:
+        return error
+
+    timeout_sec = _get_env_int("PYTHON_SANDBOX_TIMEOUT_SEC", 10, 1, 120)
+    max_output_chars = _get_env_int("PYTHON_SANDBOX_MAX_OUTPUT_CHARS", 4000, 200, 20000)
+
+    pool, container = await _aacquire_warm_container()
+    if container is not None:
+        cmd = ["docker", "exec", "-i", "-w", "/sandbox", container, "python", "-u", "-"]
+        try:
+            return await _acommunicate(cmd, code, timeout_sec, max_output_chars)
+        except asyncio.TimeoutError:
+            return f"Execution timed out after {timeout_sec}s."
+        finally:
+            # Used, timed-out and cancelled containers are all thrown away
+            pool.discard(container)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        script_path = os.path.join(temp_dir, "main.py")
+        with open(script_path, "w", encoding="utf-8") as handle:
+            handle.write(code)
+
+        container = _cold_container_name()
+        try:
+            return await _acommunicate(_cold_run_cmd(container, temp_dir), None, timeout_sec, max_output_chars)
+        except asyncio.TimeoutError:
+            # Killing the docker client does not stop the container itself
+            await asyncio.to_thread(_remove_container, container)
+            return f"Execution timed out after {timeout_sec}s."
+        except asyncio.CancelledError:
+            await asyncio.shield(asyncio.to_thread(_remove_container, container))
+            raise
+
+
+async def _acommunicate(cmd: List[str], stdin: Optional[str], timeout_sec: int, max_output_chars: int) -> str:
+    """Run a docker command and format its output.
+
+    On timeout (asyncio.TimeoutError) or cancellation the docker client is
+    killed; the caller is responsible for removing the container.
+    """
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except Exception as exc:
+        return f"Sandbox execution failed: {exc}"
+
+    try:
+        stdout, stderr = await asyncio.wait_for(
+            proc.communicate(stdin.encode("utf-8") if stdin is not None else None),
+            timeout_sec,
+        )
+    except BaseException:
+        _kill(proc)
+        raise
+
+    return _format_output(
+        stdout.decode("utf-8", errors="replace"),
+        stderr.decode("utf-8", errors="replace"),
+        max_output_chars,
+    )
+
+
+def _kill(proc: asyncio.subprocess.Process):
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        pass
+
+
+def _cold_container_name() -> str:
+    return f"nabd-sbx-run-{uuid.uuid4().hex[:12]}"
+
+
+def _remove_container(container: str):
+    try:
+        subprocess.run(["docker", "rm", "-f", container], capture_output=True, timeout=30)
+    except Exception:
+        pass
+
+
+def _exec_in_container(container: str, code: str, timeout_sec: int, max_output_chars: int) -> str:
+    """Run one job in a warm pool container, feeding the script on stdin."""
+    cmd = ["docker", "exec", "-i", "-w", "/sandbox", container, "python", "-u", "-"]
+    try:
+        result = subprocess.run(
+            cmd,
+            input=code,
+            capture_output=True,
+            text=True,
+            timeout=timeout_sec,
+        )
+    except subprocess.TimeoutExpired:
+        return f"Execution timed out after {timeout_sec}s."
+    except Exception as exc:
+        return f"Sandbox execution failed: {exc}"
+
+    return _format_output(result.stdout, result.stderr, max_output_chars)
+
+
+def _format_output(stdout: Optional[str], stderr: Optional[str], max_output_chars: int) -> str:
+    stdout = (stdout or "").strip()
+    stderr = (stderr or "").strip()
     if stdout and stderr:
         output = f"{stdout}\n{stderr}"
     else:
@@ -112,6 +439,106 @@ def _run_in_docker(code: str) -> str:
     return _truncate(output, max_output_chars)
 
 
+def _sandbox_image() -> str:
+    return os.getenv("PYTHON_SANDBOX_IMAGE", "python:3.12-alpine").strip()
+
+
+def _docker_run_args() -> List[str]:
+    """Isolation flags, data mount and workdir shared by one-shot and pooled containers."""
+    memory_mb = _get_env_int("PYTHON_SANDBOX_MEMORY_MB", 256, 64, 2048)
+    pids_limit = _get_env_int("PYTHON_SANDBOX_PIDS", 64, 16, 1024)
+    cpu_limit = _get_env_float("PYTHON_SANDBOX_CPU", 0.5, 0.1, 4.0)
+
+    data_mount = _format_mount_path(_sandbox_data_dir())
+
+    return [
+        "--network",
+        "none",
+        "--cpus",
+        str(cpu_limit),
+        "--memory",
+        f"{memory_mb}m",
+        "--pids-limit",
+        str(pids_limit),
+        "--security-opt",
+        "no-new-privileges",
+        "--cap-drop",
+        "ALL",
+        "--tmpfs",
+        "/tmp:rw,noexec,nosuid,nodev,size=64m",
+        "--read-only",
+        "-e",
+        "PYTHONDONTWRITEBYTECODE=1",
+        "-e",
+        "PYTHONUNBUFFERED=1",
+        "-v",
+        f"{data_mount}:/sandbox/data:rw",
+        "-w",
+        "/sandbox",
+    ]
+
+
+_sandbox_pool = None
+_sandbox_pool_lock = threading.Lock()
+
+
+def get_sandbox_pool() -> Optional[DockerSandboxPool]:
+    """Get the warm container pool, or None when PYTHON_SANDBOX_POOL_SIZE is 0."""
+    global _sandbox_pool
+    if _sandbox_pool is None:
+        size = _get_env_int("PYTHON_SANDBOX_POOL_SIZE", 2, 0, 32)
+        if size == 0 or shutil.which("docker") is None:
+            return None
+        with _sandbox_pool_lock:
+            if _sandbox_pool is None:
+                _sandbox_pool = DockerSandboxPool(size, _docker_run_args(), _sandbox_image())
+    return _sandbox_pool
+
+
+_sandbox_queue = None
+
+
+def get_sandbox_queue() -> SandboxJobQueue:
+    """Get the process-wide queue that bounds concurrent async sandbox jobs."""
+    global _sandbox_queue
+    if _sandbox_queue is None:
+        _sandbox_queue = SandboxJobQueue(
+            max_concurrent=_get_env_int("PYTHON_SANDBOX_MAX_CONCURRENT", 4, 1, 64),
+            max_waiting=_get_env_int("PYTHON_SANDBOX_QUEUE_SIZE", 32, 0, 1024),
+            wait_timeout=_get_env_float("PYTHON_SANDBOX_QUEUE_TIMEOUT_SEC", 30.0, 0.1, 600.0),
+        )
+    return _sandbox_queue
+
+
+_kernel_manager = None
+
+
+def get_kernel_manager() -> KernelManager:
+    """Get the registry of persistent per-session kernels."""
+    global _kernel_manager
+    if _kernel_manager is None:
+        with _sandbox_pool_lock:
+            if _kernel_manager is None:
+                _kernel_manager = KernelManager(
+                    _spawn_kernel,
+                    max_kernels=_get_env_int("PYTHON_SANDBOX_KERNEL_MAX", 8, 1, 256),
+                    idle_ttl=_get_env_float("PYTHON_SANDBOX_KERNEL_IDLE_SEC", 600.0, 10.0, 86400.0),
+                )
+    return _kernel_manager
+
+
+def close_sandbox_pool():
+    """Remove the pool's idle containers and stop session kernels (called on shutdown)."""
+    global _sandbox_pool, _kernel_manager
+    with _sandbox_pool_lock:
+        pool, _sandbox_pool = _sandbox_pool, None
+        kernels, _kernel_manager = _kernel_manager, None
+    if pool is not None:
+        pool.close()
+    if kernels is not None:
+        kernels.close()
+
+
 def _format_mount_path(path: str) -> str:
     path = os.path.abspath(path)
     if os.name == "nt":
@@ -0,0 +1,262 @@
+"""
+Persistent per-session Python kernels for the sandbox.
+
+With PYTHON_SANDBOX_KERNELS=true, python_repl keeps one sandboxed
+interpreter alive per conversation thread so imports, variables and loaded
+data survive between plan steps. Kernels run under the same limits as
+one-shot jobs (a container or a limited child process), are shut down
+after an idle TTL or when the LRU cap on live kernels is reached, and are
+killed whenever a call times out.
+"""
+
+import json
+import queue
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from app.metrics import get_metrics
+
+
+# Request loop run inside the sandbox. Each stdin line is a JSON request;
+# each reply is one JSON line on a private copy of stdout. The real fds
+# 0-2 point at /dev/null so stray writes cannot corrupt the protocol.
+KERNEL_LOOP = r'''
+import io, json, os, sys, traceback
+
+_replies = os.fdopen(os.dup(1), "w", encoding="utf-8")
+_requests = os.fdopen(os.dup(0), "r", encoding="utf-8")
+_null = os.open(os.devnull, os.O_RDWR)
+for _fd in (0, 1, 2):
+    os.dup2(_null, _fd)
+
+_namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+_replies.write(json.dumps({"ready": True}) + "\n")
+_replies.flush()
+
+for _line in _requests:
+    _request = json.loads(_line)
+    _out, _err = io.StringIO(), io.StringIO()
+    sys.stdout, sys.stderr = _out, _err
+    try:
+        exec(compile(_request["code"], "<cell>", "exec"), _namespace)
+    except SystemExit:
+        pass
+    except BaseException as _exc:
+        traceback.print_exception(type(_exc), _exc, _exc.__traceback__.tb_next)
+    finally:
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    _limit = _request["max_chars"]
+    _replies.write(json.dumps({"stdout": _out.getvalue()[:_limit], "stderr": _err.getvalue()[:_limit]}) + "\n")
+    _replies.flush()
+'''
+
+
+class KernelResult(NamedTuple):
+    stdout: str
+    stderr: str
+    # ok, timeout or exited
+    status: str
+
+
+# Starts a kernel process; returns it with a callback that tears it down
+KernelSpawner = Callable[[], Tuple[subprocess.Popen, Callable[[], None]]]
+
+
+class SessionKernel:
+    """One long-lived sandboxed interpreter; calls are serialized."""
+
+    def __init__(self, spawn: KernelSpawner):
+        self._spawn = spawn
+        self._proc: Optional[subprocess.Popen] = None
+        self._cleanup: Optional[Callable[[], None]] = None
+        self._lines: "queue.Queue[Optional[str]]" = queue.Queue()
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        self.closed = False
+
+    @property
+    def busy(self) -> bool:
+        return self.lock.locked()
+
+    def _start(self, timeout_sec: float):
+        self._proc, self._cleanup = self._spawn()
+        threading.Thread(target=self._read_replies, name="nabd-sandbox-kernel", daemon=True).start()
+        reply, noise = self._next_reply(time.time() + timeout_sec)
+        if reply is None or not reply.get("ready"):
+            raise RuntimeError("\n".join(noise).strip() or "Kernel failed to start.")
+
+    def _read_replies(self):
+        for raw in self._proc.stdout:
+            self._lines.put(raw.decode("utf-8", errors="replace"))
+        self._lines.put(None)
+
+    def _next_reply(self, deadline: float) -> Tuple[Optional[dict], List[str]]:
+        """Wait for the next protocol line, keeping anything else as noise.
+
+        Returns (None, noise) when the kernel exits; raises queue.Empty
+        when the deadline passes.
+        """
+        noise = []
+        while True:
+            line = self._lines.get(timeout=max(0.0, deadline - time.time()))
+            if line is None:
+                return None, noise
+            try:
+                reply = json.loads(line)
+            except ValueError:
+                reply = None
+            if isinstance(reply, dict):
+                return reply, noise
+            noise.append(line.rstrip("\n"))
+
+    def execute(self, code: str, timeout_sec: float, max_chars: int) -> KernelResult:
+        """Run `code` in the kernel's namespace. Call with self.lock held."""
+        self.last_used = time.time()
+        deadline = time.time() + timeout_sec
+        try:
+            if self._proc is None:
+                self._start(timeout_sec)
+            request = json.dumps({"code": code, "max_chars": max_chars}) + "\n"
+            self._proc.stdin.write(request.encode("utf-8"))
+            self._proc.stdin.flush()
+            reply, noise = self._next_reply(deadline)
+        except queue.Empty:
+            return KernelResult("", "", "timeout")
+        except (OSError, ValueError):
+            # Broken pipe: the kernel died between calls
+            return KernelResult("", "", "exited")
+        finally:
+            self.last_used = time.time()
+
+        if reply is None:
+            return KernelResult("", "\n".join(noise), "exited")
+        return KernelResult(reply.get("stdout", ""), reply.get("stderr", ""), "ok")
+
+    def close(self):
+        self.closed = True
+        if self._cleanup is not None:
+            try:
+                self._cleanup()
+            except Exception as e:
+                print(f"Sandbox kernel cleanup error: {e}")
+
+
+class KernelManager:
+    """Maps session ids to kernels with an idle TTL and an LRU cap."""
+
+    def __init__(self, spawn: KernelSpawner, max_kernels: int, idle_ttl: float):
+        self._spawn = spawn
+        self.max_kernels = max(1, max_kernels)
+        self.idle_ttl = idle_ttl
+        self._kernels: "OrderedDict[str, SessionKernel]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._wakeup = threading.Event()
+        self._reaper: Optional[threading.Thread] = None
+
+    def execute(self, session_id: str, code: str, timeout_sec: float, max_chars: int) -> Optional[KernelResult]:
+        """Run code in the session's kernel, starting one if needed.
+
+        Returns None when every kernel slot is busy with another session;
+        the caller should fall back to a one-shot run.
+        """
+        metrics = get_metrics()
+        kernel, started = self._checkout(session_id)
+        if kernel is None:
+            metrics.sandbox_kernel_requests_total.inc({"result": "fallback"})
+            return None
+        metrics.sandbox_kernel_requests_total.inc({"result": "started" if started else "reused"})
+
+        with kernel.lock:
+            if kernel.closed:
+                # Evicted while this call waited for the previous one
+                return self.execute(session_id, code, timeout_sec, max_chars)
+            try:
+                result = kernel.execute(code, timeout_sec, max_chars)
+            except Exception as exc:
+                result = KernelResult("", f"Sandbox kernel failed to start: {exc}", "exited")
+
+        if result.status != "ok":
+            self.discard(session_id, kernel, "timeout" if result.status == "timeout" else "exited")
+        return result
+
+    def discard(self, session_id: str, kernel: Optional[SessionKernel] = None, reason: str = "cancelled"):
+        """Shut down a session's kernel (only `kernel`, if given)."""
+        with self._lock:
+            current = self._kernels.get(session_id)
+            if current is None or (kernel is not None and current is not kernel):
+                return
+            del self._kernels[session_id]
+            self._publish()
+        self._close(current, reason)
+
+    def close(self):
+        """Shut down every kernel (called on shutdown)."""
+        with self._lock:
+            self._closed = True
+            kernels, self._kernels = list(self._kernels.values()), OrderedDict()
+            self._publish()
+        self._wakeup.set()
+        for kernel in kernels:
+            self._close(kernel, "shutdown")
+
+    def _checkout(self, session_id: str) -> Tuple[Optional[SessionKernel], bool]:
+        evicted = []
+        try:
+            with self._lock:
+                self._ensure_reaper()
+                kernel = self._kernels.get(session_id)
+                if kernel is not None:
+                    self._kernels.move_to_end(session_id)
+                    return kernel, False
+
+                if len(self._kernels) >= self.max_kernels:
+                    victim = next((sid for sid, k in self._kernels.items() if not k.busy), None)
+                    if victim is None:
+                        return None, False
+                    evicted.append(self._kernels.pop(victim))
+
+                kernel = SessionKernel(self._spawn)
+                self._kernels[session_id] = kernel
+                self._publish()
+                return kernel, True
+        finally:
+            for victim in evicted:
+                self._close(victim, "lru")
+
+    def _ensure_reaper(self):
+        # Called with self._lock held
+        if self._reaper is None and not self._closed:
+            self._reaper = threading.Thread(target=self._reap_loop, name="nabd-sandbox-kernel-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap_loop(self):
+        interval = min(30.0, max(1.0, self.idle_ttl / 2))
+        while not self._closed:
+            self._wakeup.wait(timeout=interval)
+            self._reap_idle()
+
+    def _reap_idle(self):
+        cutoff = time.time() - self.idle_ttl
+        with self._lock:
+            expired = [
+                sid for sid, kernel in self._kernels.items()
+                if not kernel.busy and kernel.last_used < cutoff
+            ]
+            kernels = [self._kernels.pop(sid) for sid in expired]
+            if kernels:
+                self._publish()
+        for kernel in kernels:
+            self._close(kernel, "ttl")
+
+    def _publish(self):
+        # Called with self._lock held
+        get_metrics().sandbox_kernels_live.set(len(self._kernels))
+
+    @staticmethod
+    def _close(kernel: SessionKernel, reason: str):
+        get_metrics().sandbox_kernel_evictions_total.inc({"reason": reason})
+        kernel.close()
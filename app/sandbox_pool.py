@@ -0,0 +1,149 @@
+"""
+Warm container pool for the Docker Python sandbox.
+
+Containers are pre-started with the same isolation flags as the one-shot
+`docker run --rm` path and idle on a no-op process. Each container runs
+exactly one job through `docker exec` and is then removed; a background
+thread keeps the pool topped up.
+"""
+
+import os
+import queue
+import subprocess
+import threading
+import time
+import uuid
+from typing import List, Optional
+
+from app.metrics import get_metrics
+
+
+POOL_LABEL = "nabd.sandbox.owner"
+
+# Keeps PID 1 alive without doing any work until `docker exec` runs a job
+IDLE_COMMAND = ["python", "-c", "import signal; signal.pause()"]
+
+
+class DockerSandboxPool:
+    """Keeps `size` locked-down containers started and ready for one job each."""
+
+    def __init__(self, size: int, run_args: List[str], image: str):
+        self.size = size
+        # Flags for `docker run` (limits, mounts, workdir), without the image
+        self.run_args = run_args
+        self.image = image
+        self._idle: "queue.Queue[str]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._starting = 0
+        self._closed = False
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._refill_loop, name="nabd-sandbox-pool", daemon=True)
+        self._thread.start()
+
+    @property
+    def owner(self) -> str:
+        return str(os.getpid())
+
+    def acquire(self, timeout: float) -> Optional[str]:
+        """Take a warm container id, or None if none became ready in time."""
+        start_time = time.time()
+        try:
+            container = self._idle.get(timeout=timeout) if timeout > 0 else self._idle.get_nowait()
+        except queue.Empty:
+            container = None
+        metrics = get_metrics()
+        metrics.sandbox_pool_wait_seconds.observe(time.time() - start_time)
+        metrics.sandbox_pool_idle.set(self._idle.qsize())
+        self._wakeup.set()
+        return container
+
+    def discard(self, container: str):
+        """
+        Remove a used container in the background and schedule a replacement.
+
+        Safe after close(): the container is still removed, and nothing is
+        started in its place.
+        """
+        threading.Thread(target=self._remove, args=(container,), daemon=True).start()
+        if not self._closed:
+            self._wakeup.set()
+
+    def close(self):
+        """Stop refilling and remove every idle container."""
+        self._closed = True
+        self._wakeup.set()
+        while True:
+            try:
+                self._remove(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        get_metrics().sandbox_pool_idle.set(0)
+
+    def _refill_loop(self):
+        self._remove_orphans()
+        while not self._closed:
+            with self._lock:
+                missing = self.size - self._idle.qsize() - self._starting
+                self._starting += max(0, missing)
+            for _ in range(max(0, missing)):
+                threading.Thread(target=self._start_one, daemon=True).start()
+            self._wakeup.wait(timeout=5.0)
+            self._wakeup.clear()
+
+    def _start_one(self):
+        name = f"nabd-sbx-{uuid.uuid4().hex[:12]}"
+        cmd = [
+            "docker", "run", "-d", "--name", name,
+            "--label", f"{POOL_LABEL}={self.owner}",
+            *self.run_args, self.image, *IDLE_COMMAND,
+        ]
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+            if result.returncode == 0 and not self._closed:
+                self._idle.put(name)
+                get_metrics().sandbox_pool_idle.set(self._idle.qsize())
+            else:
+                if result.returncode != 0:
+                    print(f"Sandbox pool start failed: {result.stderr.strip()}")
+                self._remove(name)
+                # Back off so a broken image or daemon does not spin the loop
+                time.sleep(5.0)
+        except Exception as exc:
+            print(f"Sandbox pool start failed: {exc}")
+            time.sleep(5.0)
+        finally:
+            with self._lock:
+                self._starting -= 1
+            self._wakeup.set()
+
+    def _remove_orphans(self):
+        """Remove pool containers left behind by worker processes that died."""
+        try:
+            result = subprocess.run(
+                ["docker", "ps", "-a", "--filter", f"label={POOL_LABEL}",
+                 "--format", f'{{{{.Names}}}} {{{{.Label "{POOL_LABEL}"}}}}'],
+                capture_output=True, text=True, timeout=30,
+            )
+        except Exception:
+            return
+        for line in result.stdout.splitlines():
+            name, _, owner = line.partition(" ")
+            if owner.isdigit() and not _pid_alive(int(owner)):
+                self._remove(name)
+
+    @staticmethod
+    def _remove(container: str):
+        try:
+            subprocess.run(["docker", "rm", "-f", container], capture_output=True, timeout=30)
+        except Exception:
+            pass
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,382 @@
+"""
+Local process backend for the Python sandbox (PYTHON_TOOL_MODE=process).
+
+Runs code in a fresh child interpreter instead of a container. Before user
+code starts, the child:
+- drops into new user + network namespaces when the kernel allows it, so
+  it has no network interfaces besides a downed loopback
+- applies rlimits for CPU time, address space, open files, file size and
+  process count
+- runs as init of a new PID namespace, so killing it on timeout also
+  kills every process it started, even ones that called setsid()
+- runs in a private temporary directory whose only link outward is a
+  `data/` symlink to the shared data directory
+- pivots into a new mount namespace whose root holds read-only system and
+  interpreter paths, plus the workspace and data directory read-write;
+  the rest of the host (the app, .env, /proc) is not there. It then drops
+  its namespace capabilities so the binds cannot be remounted. When this
+  is unavailable the child refuses to run unless
+  require_filesystem_isolation is off
+
+The child gets a scrubbed environment (no API keys), runs in its own
+session, and its whole process group is SIGKILLed on timeout or when the
+caller is cancelled.
+"""
+
+import asyncio
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Iterator, List, NamedTuple, Tuple
+
+
+# Executed by the child interpreter before handing control to user code
+BOOTSTRAP = r'''
+import ctypes, json, os, resource, runpy, signal, sys
+
+limits = json.loads(sys.argv[1])
+sys.argv = sys.argv[2:]
+
+def _user_tasks():
+    # RLIMIT_NPROC counts every task of the user, so grant headroom over the current count
+    uid, total = os.getuid(), 0
+    for pid in os.listdir("/proc"):
+        if pid.isdigit():
+            try:
+                if os.stat("/proc/" + pid).st_uid == uid:
+                    total += len(os.listdir("/proc/" + pid + "/task"))
+            except OSError:
+                pass
+    return total
+
+# Counted before the filesystem is confined, which hides /proc
+nproc = _user_tasks() + limits["processes"] if os.path.isdir("/proc") else None
+
+CLONE_NEWNS, CLONE_NEWUSER, CLONE_NEWPID, CLONE_NEWNET = 0x00020000, 0x10000000, 0x20000000, 0x40000000
+MS_RDONLY, MS_NOSUID, MS_NODEV, MS_NOEXEC = 0x1, 0x2, 0x4, 0x8
+MS_REMOUNT, MS_NOATIME, MS_NODIRATIME, MS_BIND = 0x20, 0x400, 0x800, 0x1000
+MS_REC, MS_PRIVATE, MS_RELATIME = 0x4000, 0x40000, 0x200000
+SYS_PIVOT_ROOT = {"x86_64": 155, "aarch64": 41}.get(os.uname().machine)
+# Read-only system paths; the interpreter's own prefix and sys.path are added below
+SYSTEM_PATHS = ["/usr", "/bin", "/sbin", "/lib", "/lib32", "/lib64", "/libx32", "/etc",
+                "/dev/null", "/dev/zero", "/dev/random", "/dev/urandom"]
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+def _check(result, what):
+    if result != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, what + ": " + os.strerror(errno))
+
+def _mount(source, target, fstype, flags, data=None):
+    encode = lambda value: value.encode() if value is not None else None
+    _check(libc.mount(encode(source), encode(target), encode(fstype), ctypes.c_ulong(flags), encode(data)),
+           "mount " + target)
+
+def _write(path, text):
+    with open(path, "w") as handle:
+        handle.write(text)
+
+def _map_ids(uid, gid):
+    # Keep the same uid/gid inside the namespace so the workspace stays writable
+    _write("/proc/self/setgroups", "deny")
+    _write("/proc/self/uid_map", "%d %d 1" % (uid, uid))
+    _write("/proc/self/gid_map", "%d %d 1" % (gid, gid))
+
+def _locked_flags(path):
+    # Flags inherited from the parent namespace cannot be cleared by a remount
+    flags = os.statvfs(path).f_flag
+    return ((flags & os.ST_NOSUID and MS_NOSUID) | (flags & os.ST_NODEV and MS_NODEV)
+            | (flags & os.ST_NOEXEC and MS_NOEXEC) | (flags & os.ST_NOATIME and MS_NOATIME)
+            | (flags & os.ST_NODIRATIME and MS_NODIRATIME) | (flags & os.ST_RELATIME and MS_RELATIME))
+
+def _bind(root, path, writable):
+    target = root + path
+    if os.path.isdir(path):
+        os.makedirs(target, exist_ok=True)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        open(target, "a").close()
+    _mount(path, target, None, MS_BIND)
+    _mount(None, target, None, MS_BIND | MS_REMOUNT | _locked_flags(path) | (0 if writable else MS_RDONLY))
+
+def _confine_filesystem():
+    # New root holding read-only system and interpreter paths, the workspace
+    # and the shared data directory; everything else (the app, .env, /proc,
+    # other users' files) is absent
+    if SYS_PIVOT_ROOT is None:
+        raise OSError("pivot_root is not supported on " + os.uname().machine)
+    workdir = os.getcwd()
+    data_dir = os.path.realpath(os.path.join(workdir, "data"))
+    # Merged-/usr hosts link /bin, /lib, ... into /usr; those links are recreated as-is
+    links = [path for path in SYSTEM_PATHS if os.path.islink(path)]
+    readonly = [path for path in SYSTEM_PATHS if path not in links]
+    readonly += [sys.prefix, sys.base_prefix, sys.exec_prefix] + sys.path
+    readonly = sorted({os.path.realpath(path) for path in readonly if path and os.path.exists(path)})
+
+    _mount(None, "/", None, MS_REC | MS_PRIVATE)
+    root = os.path.join(workdir, ".root")
+    os.mkdir(root, 0o700)
+    _mount("tmpfs", root, "tmpfs", MS_NOSUID | MS_NODEV, "size=1m,mode=0755")
+    for path in readonly:
+        if not (path == workdir or path.startswith(workdir + "/")):
+            _bind(root, path, writable=False)
+    for path in links:
+        os.symlink(os.readlink(path), root + path)
+    _bind(root, workdir, writable=True)
+    if os.path.isdir(data_dir):
+        _bind(root, data_dir, writable=True)
+    _mount(None, root, None, MS_REMOUNT | MS_RDONLY | MS_NOSUID | MS_NODEV)
+
+    # Swap roots and detach the old one so it cannot be reached again
+    os.chdir(root)
+    _check(libc.syscall(SYS_PIVOT_ROOT, b".", b"."), "pivot_root")
+    _check(libc.umount2(b".", 2), "umount old root")  # MNT_DETACH
+    os.chdir(workdir)
+
+def _drop_capabilities():
+    # The namespace's capabilities would let user code remount the binds writable
+    _check(libc.prctl(38, 1, 0, 0, 0), "no_new_privs")  # PR_SET_NO_NEW_PRIVS
+    header = (ctypes.c_uint32 * 2)(0x20080522, 0)  # _LINUX_CAPABILITY_VERSION_3, this thread
+    data = (ctypes.c_uint32 * 6)()
+    _check(libc.capset(header, data), "capset")
+
+def _run_as_init():
+    # The first child in a new PID namespace is its init: when it dies the
+    # kernel kills everything left in the namespace, including descendants
+    # that left the process group with setsid(). This process stays behind
+    # only to pass on the exit status.
+    pid = os.fork()
+    if pid == 0:
+        # Also die if the supervisor is killed while init is in another session
+        libc.prctl(1, signal.SIGKILL, 0, 0, 0)  # PR_SET_PDEATHSIG
+        return
+    while True:
+        try:
+            _, status = os.waitpid(pid, 0)
+            break
+        except InterruptedError:
+            pass
+    code = os.waitstatus_to_exitcode(status)
+    os._exit(code if code >= 0 else 128 - code)
+
+flags = CLONE_NEWUSER
+if limits["isolate_network"]:
+    flags |= CLONE_NEWNET
+if limits["isolate_filesystem"]:
+    flags |= CLONE_NEWNS
+namespaces = False
+if flags != CLONE_NEWUSER:
+    flags |= CLONE_NEWPID
+    uid, gid = os.getuid(), os.getgid()
+    try:
+        namespaces = libc.unshare(flags) == 0
+        if namespaces:
+            _map_ids(uid, gid)
+    except OSError:
+        namespaces = False
+    if not namespaces and limits["isolate_network"] and limits["require_network_isolation"]:
+        sys.stderr.write("Sandbox error: network namespaces are not available on this host.\n")
+        sys.exit(3)
+
+if limits["isolate_filesystem"]:
+    try:
+        if not namespaces:
+            raise OSError("user namespaces are not available on this host")
+        _confine_filesystem()
+        _drop_capabilities()
+    except OSError as e:
+        if limits["require_filesystem_isolation"]:
+            sys.stderr.write("Sandbox error: cannot confine the filesystem (%s).\n" % e)
+            sys.exit(3)
+
+if namespaces:
+    _run_as_init()
+
+cpu = limits["cpu_seconds"]
+resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+address_space = limits["address_space_mb"] * 1024 * 1024
+resource.setrlimit(resource.RLIMIT_AS, (address_space, address_space))
+resource.setrlimit(resource.RLIMIT_NOFILE, (limits["open_files"], limits["open_files"]))
+file_size = limits["file_size_mb"] * 1024 * 1024
+resource.setrlimit(resource.RLIMIT_FSIZE, (file_size, file_size))
+if nproc is not None:
+    resource.setrlimit(resource.RLIMIT_NPROC, (nproc, nproc))
+resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+del ctypes, json, resource, limits, libc
+runpy.run_path(sys.argv[0], run_name="__main__")
+'''
+
+
+@dataclass
+class ProcessLimits:
+    """Resource limits applied inside the child interpreter."""
+    cpu_seconds: int = 10
+    address_space_mb: int = 1024
+    open_files: int = 64
+    file_size_mb: int = 64
+    processes: int = 64
+    isolate_network: bool = True
+    require_network_isolation: bool = False
+    # Only the workspace and data/ writable, and the rest of the host hidden
+    isolate_filesystem: bool = True
+    require_filesystem_isolation: bool = True
+
+
+class ProcessResult(NamedTuple):
+    stdout: str
+    stderr: str
+    timed_out: bool
+
+
+def _child_env(workdir: str) -> dict:
+    """Minimal environment: nothing from the server (API keys included) leaks in."""
+    return {
+        "PATH": os.environ.get("PATH", "/usr/bin:/bin"),
+        "HOME": workdir,
+        "TMPDIR": workdir,
+        "LANG": "C.UTF-8",
+        "PYTHONDONTWRITEBYTECODE": "1",
+        "PYTHONUNBUFFERED": "1",
+        "MPLBACKEND": "Agg",
+        "MPLCONFIGDIR": workdir,
+    }
+
+
+def _command(limits: ProcessLimits, script: str) -> List[str]:
+    return [sys.executable, "-I", "-u", "-c", BOOTSTRAP, json.dumps(asdict(limits)), script]
+
+
+def _create_workspace(code: str, data_dir: str) -> str:
+    workdir = tempfile.mkdtemp(prefix="nabd-sbx-")
+    try:
+        os.chmod(workdir, 0o700)
+        with open(os.path.join(workdir, "main.py"), "w", encoding="utf-8") as handle:
+            handle.write(code)
+        os.symlink(os.path.abspath(data_dir), os.path.join(workdir, "data"))
+    except BaseException:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+    return workdir
+
+
+@contextmanager
+def _workspace(code: str, data_dir: str) -> Iterator[str]:
+    workdir = _create_workspace(code, data_dir)
+    try:
+        yield workdir
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _kill_group(pid: int):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def spawn_process(code: str, limits: ProcessLimits, data_dir: str) -> Tuple[subprocess.Popen, str]:
+    """Start a long-lived limited child with pipes for stdin and stdout.
+
+    Stderr is merged into stdout. The caller owns the returned workspace
+    directory and must pass both to stop_process when done.
+    """
+    workdir = _create_workspace(code, data_dir)
+    try:
+        proc = subprocess.Popen(
+            _command(limits, "main.py"),
+            cwd=workdir,
+            env=_child_env(workdir),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+    except BaseException:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+    return proc, workdir
+
+
+def stop_process(proc: subprocess.Popen, workdir: str):
+    """Kill a spawned child's process group and remove its workspace."""
+    _kill_group(proc.pid)
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        pass
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_process(code: str, limits: ProcessLimits, timeout_sec: int, data_dir: str) -> ProcessResult:
+    """Run `code` in a limited child interpreter and wait for it."""
+    with _workspace(code, data_dir) as workdir:
+        proc = subprocess.Popen(
+            _command(limits, "main.py"),
+            cwd=workdir,
+            env=_child_env(workdir),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout_sec)
+        except subprocess.TimeoutExpired:
+            _kill_group(proc.pid)
+            proc.communicate()
+            return ProcessResult("", "", True)
+        except BaseException:
+            _kill_group(proc.pid)
+            proc.wait()
+            raise
+        finally:
+            # Reap anything the child left running in its session
+            _kill_group(proc.pid)
+
+    return ProcessResult(
+        stdout.decode("utf-8", errors="replace"),
+        stderr.decode("utf-8", errors="replace"),
+        False,
+    )
+
+
+async def arun_process(code: str, limits: ProcessLimits, timeout_sec: int, data_dir: str) -> ProcessResult:
+    """Async variant of run_process; cancellation kills the child's process group."""
+    with _workspace(code, data_dir) as workdir:
+        proc = await asyncio.create_subprocess_exec(
+            *_command(limits, "main.py"),
+            cwd=workdir,
+            env=_child_env(workdir),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout_sec)
+        except asyncio.TimeoutError:
+            _kill_group(proc.pid)
+            await proc.wait()
+            return ProcessResult("", "", True)
+        except BaseException:
+            _kill_group(proc.pid)
+            # Reap the child so its transport is closed on this loop
+            await asyncio.shield(proc.wait())
+            raise
+        finally:
+            _kill_group(proc.pid)
+
+    return ProcessResult(
+        stdout.decode("utf-8", errors="replace"),
+        stderr.decode("utf-8", errors="replace"),
+        False,
+    )
@@ -0,0 +1,80 @@
+"""
+Bounded job queue for async sandbox executions.
+
+Limits how many sandbox jobs run at once across the whole process, caps how
+many may wait behind them, and gives up on jobs that wait too long.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from app.metrics import get_metrics
+
+
+class SandboxQueueFull(Exception):
+    """Raised when a job cannot be queued or waited too long for a slot."""
+
+
+class SandboxJobQueue:
+    """Admission control for sandbox jobs on one event loop."""
+
+    def __init__(self, max_concurrent: int, max_waiting: int, wait_timeout: float):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_waiting = max(0, max_waiting)
+        self.wait_timeout = wait_timeout
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop = None
+        self._waiting = 0
+        self._running = 0
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # Semaphores belong to one event loop; rebuild if scripts run several loops
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_concurrent)
+            self._waiting = 0
+            self._running = 0
+        return self._slots
+
+    def _publish(self):
+        get_metrics().sandbox_queue_depth.set(self._waiting, {"state": "waiting"})
+        get_metrics().sandbox_queue_depth.set(self._running, {"state": "running"})
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold one execution slot for the duration of the block."""
+        slots = self._semaphore()
+        start_time = time.time()
+        if not slots.locked():
+            # A slot is free: acquire() returns without suspending
+            await slots.acquire()
+        else:
+            if self._waiting >= self.max_waiting:
+                get_metrics().sandbox_rejected_total.inc({"reason": "queue_full"})
+                raise SandboxQueueFull("Sandbox queue is full. Try again shortly.")
+
+            self._waiting += 1
+            self._publish()
+            try:
+                await asyncio.wait_for(slots.acquire(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                get_metrics().sandbox_rejected_total.inc({"reason": "queue_timeout"})
+                raise SandboxQueueFull(
+                    f"Sandbox is busy; no slot became free within {self.wait_timeout:g}s."
+                ) from None
+            finally:
+                self._waiting -= 1
+                self._publish()
+        get_metrics().sandbox_queue_wait_seconds.observe(time.time() - start_time)
+
+        self._running += 1
+        self._publish()
+        try:
+            yield
+        finally:
+            self._running -= 1
+            slots.release()
+            self._publish()
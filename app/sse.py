@@ -0,0 +1,207 @@
+"""
+Server-Sent Events output for /run/stream.
+
+Model tokens arrive one at a time; sending each as its own SSE frame costs
+a string build, an ASGI send and usually a TCP segment per token. The
+emitter below coalesces answer tokens into one frame per flush window
+(or sooner once a byte threshold is reached), passes named events such as
+`session` and `progress` through immediately, and sends comment
+heartbeats while a stream is idle so proxies keep it open.
+"""
+
+import asyncio
+import os
+from contextlib import suppress
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, NamedTuple, Optional
+
+
+@dataclass
+class SSEConfig:
+    """Configuration for SSE output."""
+    # Longest a token waits for more tokens before its frame is sent (0 sends
+    # whatever has queued up as soon as the stream is scheduled)
+    flush_interval_ms: float = 30.0
+    # Send the pending frame once it holds this many bytes
+    flush_bytes: int = 2048
+    # Comment sent after this many idle seconds (0 disables heartbeats)
+    heartbeat_sec: float = 15.0
+    # Frames the producer may run ahead of the client
+    max_pending: int = 256
+
+
+class SSEFrame(NamedTuple):
+    """One item from a stream's producer."""
+    data: str
+    event: Optional[str] = None
+    # Answer text that may be merged with neighbouring frames
+    merge: bool = False
+
+
+HEARTBEAT = ": ping\n\n"
+_END = object()
+
+
+def format_sse(data: str, event: Optional[str] = None) -> str:
+    """Format one SSE frame; multi-line data becomes several data lines."""
+    lines = data.splitlines() or [""]
+    payload = []
+    if event:
+        payload.append(f"event: {event}")
+    payload.extend([f"data: {line}" for line in lines])
+    return "\n".join(payload) + "\n\n"
+
+
+class SSEEmitter:
+    """Turns a producer of SSEFrames into coalesced SSE text."""
+
+    def __init__(self, config: Optional[SSEConfig] = None, on_data: Optional[Callable[[], None]] = None):
+        self.config = config or SSEConfig()
+        self._load_env_config()
+        # Called whenever a frame of merged answer text is sent
+        self.on_data = on_data
+        self.closed = False
+        self._wake: Optional[Callable[[str], None]] = None
+
+    def _load_env_config(self):
+        """Load configuration from environment variables."""
+        if os.getenv("SSE_FLUSH_INTERVAL_MS"):
+            self.config.flush_interval_ms = float(os.getenv("SSE_FLUSH_INTERVAL_MS"))
+        if os.getenv("SSE_FLUSH_BYTES"):
+            self.config.flush_bytes = int(os.getenv("SSE_FLUSH_BYTES"))
+        if os.getenv("SSE_HEARTBEAT_SEC"):
+            self.config.heartbeat_sec = float(os.getenv("SSE_HEARTBEAT_SEC"))
+
+    def _flush(self, buffer: list) -> str:
+        if self.on_data is not None:
+            self.on_data()
+        return format_sse("".join(buffer))
+
+    def _format_batch(self, batch: list) -> list:
+        """SSE text for queued items: runs of mergeable frames become one frame each."""
+        out, buffer = [], []
+        for item in batch:
+            if item.merge:
+                buffer.append(item.data)
+                continue
+            if buffer:
+                out.append(self._flush(buffer))
+                buffer = []
+            out.append(format_sse(item.data, item.event))
+        if buffer:
+            out.append(self._flush(buffer))
+        return out
+
+    def close(self):
+        """End the stream early (e.g. the client went away); the producer is cancelled."""
+        self.closed = True
+        if self._wake is not None:
+            self._wake("closed")
+
+    async def stream(self, source: AsyncIterator[SSEFrame]) -> AsyncIterator[str]:
+        """
+        Yield SSE text for everything `source` produces.
+
+        The producer runs as its own task and appends to a shared list, so
+        a token costs no wakeup of this generator: it wakes once per flush
+        window (sooner for a named event, the byte threshold or the end)
+        and sends everything queued. Closing this generator, or close(),
+        cancels the producer and closes `source`.
+        """
+        loop = asyncio.get_running_loop()
+        interval = self.config.flush_interval_ms / 1000
+        heartbeat = self.config.heartbeat_sec
+        items: list = []
+        pending_bytes = 0
+        # Send now rather than at the end of the window
+        urgent = False
+        # Future this generator sleeps on, and whether any new item wakes it
+        waiter: Optional[asyncio.Future] = None
+        wake_on_item = True
+        # Set while the producer waits for the client to catch up
+        room: Optional[asyncio.Future] = None
+
+        def wake(result: str = "item"):
+            if waiter is not None and not waiter.done():
+                waiter.set_result(result)
+
+        async def sleep(timeout: Optional[float], on_item: bool) -> bool:
+            """Wait for the producer or `timeout`; True if the timeout fired."""
+            nonlocal waiter, wake_on_item
+            waiter, wake_on_item = loop.create_future(), on_item
+            timer = loop.call_later(timeout, wake, "timeout") if timeout is not None else None
+            try:
+                return await waiter == "timeout"
+            finally:
+                waiter = None
+                if timer is not None:
+                    timer.cancel()
+
+        async def pump():
+            nonlocal pending_bytes, urgent, room
+            try:
+                async for frame in source:
+                    if len(items) >= self.config.max_pending:
+                        room = loop.create_future()
+                        await room
+                    items.append(frame)
+                    if frame.merge:
+                        pending_bytes += len(frame.data)
+                        urgent = urgent or pending_bytes >= self.config.flush_bytes
+                    else:
+                        urgent = True
+                    if urgent or wake_on_item:
+                        wake()
+            except Exception as e:
+                items.append(e)
+            else:
+                items.append(_END)
+            finally:
+                # Cancelled while waiting for room: the producer is parked at a
+                # yield and only runs its cleanup once closed
+                aclose = getattr(source, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+            urgent = True
+            wake()
+
+        task = asyncio.create_task(pump())
+        self._wake = wake
+        last_sent = loop.time()
+        try:
+            while not self.closed:
+                if not items:
+                    timeout = max(0.0, heartbeat - (loop.time() - last_sent)) if heartbeat > 0 else None
+                    if await sleep(timeout, on_item=True) and not items:
+                        yield HEARTBEAT
+                        last_sent = loop.time()
+                        continue
+                if interval > 0 and not urgent and not self.closed:
+                    # Let more tokens gather for the rest of the window
+                    await sleep(interval, on_item=False)
+                if self.closed:
+                    break
+
+                batch = items[:]
+                items.clear()
+                pending_bytes = 0
+                urgent = False
+                if room is not None and not room.done():
+                    room.set_result(None)
+
+                end = batch and batch[-1] is _END
+                if end:
+                    batch.pop()
+                error = batch.pop() if batch and isinstance(batch[-1], Exception) else None
+                for text in self._format_batch(batch):
+                    yield text
+                last_sent = loop.time()
+                if error is not None:
+                    raise error
+                if end:
+                    break
+        finally:
+            self._wake = None
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
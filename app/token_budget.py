@@ -0,0 +1,173 @@
+"""
+Per-user LLM token budgets.
+
+A second limit next to the request rate limiter, measured in LLM tokens
+per window for each client key (X-User-ID, else IP) and tier. Requests are
+rejected up front when the estimated prompt alone does not fit in what is
+left; graph nodes are charged their actual usage as they finish and stop
+calling the model once the budget is spent.
+
+Budgets reuse the rate limiter's GCRA store (each token advances the TAT
+by window / tokens_per_window), so RATE_LIMIT_BACKEND=shm shares them
+across workers too.
+"""
+
+import math
+import os
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional, Tuple
+
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import RunnableConfig
+
+from app.metrics import get_metrics
+from app.rate_limiter import get_rate_limiter
+
+
+@dataclass
+class TokenBudgetConfig:
+    """Configuration for token budgets."""
+    # auto: enabled only in production (ENV=production), like the rate limiter
+    enabled: str = "auto"
+    # Tokens per window for each tier
+    anonymous_tpm: int = 20_000
+    authenticated_tpm: int = 100_000
+    premium_tpm: int = 500_000
+    # Window size in seconds
+    window_seconds: int = 60
+
+
+def estimate_tokens(messages: Iterable[BaseMessage]) -> int:
+    """Rough token count for a prompt (about four characters per token)."""
+    total = 0
+    for message in messages:
+        total += len(str(message.content)) // 4 + 4
+    return total
+
+
+def usage_tokens(response: BaseMessage, prompt: Iterable[BaseMessage] = ()) -> int:
+    """Tokens a model call used, from usage_metadata or else estimated."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage and usage.get("total_tokens"):
+        return int(usage["total_tokens"])
+    return estimate_tokens(prompt) + estimate_tokens([response])
+
+
+class TokenBudget:
+    """Token-per-window budgets kept in the rate limiter's GCRA store."""
+
+    def __init__(self, config: Optional[TokenBudgetConfig] = None):
+        self.config = config or TokenBudgetConfig()
+        self._load_env_config()
+
+    def _load_env_config(self):
+        """Load configuration from environment variables."""
+        if os.getenv("TOKEN_BUDGET_ENABLED"):
+            self.config.enabled = os.getenv("TOKEN_BUDGET_ENABLED").lower()
+        if os.getenv("TOKEN_BUDGET_ANONYMOUS_TPM"):
+            self.config.anonymous_tpm = int(os.getenv("TOKEN_BUDGET_ANONYMOUS_TPM"))
+        if os.getenv("TOKEN_BUDGET_AUTHENTICATED_TPM"):
+            self.config.authenticated_tpm = int(os.getenv("TOKEN_BUDGET_AUTHENTICATED_TPM"))
+        if os.getenv("TOKEN_BUDGET_PREMIUM_TPM"):
+            self.config.premium_tpm = int(os.getenv("TOKEN_BUDGET_PREMIUM_TPM"))
+        if os.getenv("TOKEN_BUDGET_WINDOW_SECONDS"):
+            self.config.window_seconds = int(os.getenv("TOKEN_BUDGET_WINDOW_SECONDS"))
+
+    @property
+    def enabled(self) -> bool:
+        if self.config.enabled == "auto":
+            return os.getenv("ENV", "development").lower() == "production"
+        return self.config.enabled == "true"
+
+    def _get_limit_for_tier(self, tier: str) -> int:
+        limits = {
+            "anonymous": self.config.anonymous_tpm,
+            "authenticated": self.config.authenticated_tpm,
+            "premium": self.config.premium_tpm,
+        }
+        return max(1, limits.get(tier, self.config.anonymous_tpm))
+
+    def _per_token(self, tier: str) -> float:
+        return self.config.window_seconds / self._get_limit_for_tier(tier)
+
+    def _debt(self, key: str, tier: str, tokens: int, now: float) -> float:
+        """Seconds of budget already committed after charging `tokens`."""
+        # An infinite tolerance always admits; interval 0 makes it a pure read
+        _, tat = get_rate_limiter().store.update(
+            f"tokens:{key}", tier, now, tokens * self._per_token(tier), math.inf
+        )
+        return tat - now
+
+    def remaining(self, key: str, tier: str) -> int:
+        """Tokens still available to the client in the current window."""
+        debt = self._debt(key, tier, 0, time.time())
+        return max(0, math.floor((self.config.window_seconds - debt) / self._per_token(tier)))
+
+    def check(self, key: str, tier: str, estimated: int) -> Tuple[bool, Optional[int]]:
+        """
+        Check whether a request estimated at `estimated` tokens fits.
+
+        Returns (allowed, retry_after); retry_after is None when the
+        estimate exceeds the tier's whole budget and can never fit.
+        """
+        if estimated > self._get_limit_for_tier(tier):
+            get_metrics().token_budget_rejected_total.inc({"tier": tier, "stage": "admission"})
+            return False, None
+        overdraw = self._debt(key, tier, 0, time.time()) + estimated * self._per_token(tier)
+        overdraw -= self.config.window_seconds
+        if overdraw > 0:
+            get_metrics().token_budget_rejected_total.inc({"tier": tier, "stage": "admission"})
+            return False, math.ceil(overdraw)
+        return True, 0
+
+    def charge(self, key: str, tier: str, tokens: int):
+        """Deduct tokens actually used; the balance may go negative."""
+        if tokens <= 0:
+            return
+        self._debt(key, tier, tokens, time.time())
+        get_metrics().token_budget_charged_total.inc({"tier": tier}, tokens)
+
+
+def budget_scope(config: Optional[RunnableConfig]) -> Optional[Tuple[str, str]]:
+    """The (client key, tier) a graph run is billed to, if budgets apply."""
+    configurable = (config or {}).get("configurable") or {}
+    key = configurable.get("budget_key")
+    if not key:
+        return None
+    return key, configurable.get("budget_tier", "anonymous")
+
+
+def budget_config(key: str, tier: str) -> dict:
+    """Configurable entries that bill a graph run to a client."""
+    return {"budget_key": key, "budget_tier": tier}
+
+
+def budget_exhausted(config: Optional[RunnableConfig]) -> bool:
+    """True when the run's client has no tokens left."""
+    scope = budget_scope(config)
+    if scope is None:
+        return False
+    if get_token_budget().remaining(*scope) > 0:
+        return False
+    get_metrics().token_budget_rejected_total.inc({"tier": scope[1], "stage": "midrun"})
+    return True
+
+
+def charge_usage(config: Optional[RunnableConfig], tokens: int):
+    """Charge a finished node's token usage to the run's client."""
+    scope = budget_scope(config)
+    if scope is not None:
+        get_token_budget().charge(scope[0], scope[1], tokens)
+
+
+# Singleton instance
+_token_budget = None
+
+
+def get_token_budget() -> TokenBudget:
+    """Get the global token budget instance."""
+    global _token_budget
+    if _token_budget is None:
+        _token_budget = TokenBudget()
+    return _token_budget
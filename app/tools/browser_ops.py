@@ -1,76 +1,141 @@
 import os
 import uuid
 import asyncio
-from typing import Literal
+import concurrent.futures
+from typing import Literal, Optional, Tuple
 from urllib.parse import urlparse
 import socket
-from langchain_core.tools import tool
-from playwright.async_api import async_playwright
+from langchain_core.tools import StructuredTool
+from playwright.async_api import Page, async_playwright
+
+from app.tools.browser_pool import USER_AGENT, VIEWPORT, LAUNCH_ARGS, get_browser_pool
 
 # Create screenshots directory
 SCREENSHOTS_DIR = "static/screenshots"
 os.makedirs(SCREENSHOTS_DIR, exist_ok=True)
 
 
+async def _browse_page(page: Page, url: str, action: Literal["read", "screenshot"] = "read") -> str:
+    """Navigate an open page and read or screenshot it."""
+    try:
+        await page.goto(url, wait_until="networkidle", timeout=30000)
+    except Exception:
+        # Fallback to domcontentloaded if networkidle times out
+        await page.goto(url, wait_until="domcontentloaded", timeout=30000)
+    
+    result = ""
+    
+    if action == "read":
+        # Extract text content from the page
+        content = await page.inner_text("body")
+        # Clean up and truncate if too long
+        content = content.strip()
+        if len(content) > 8000:
+            content = content[:8000] + "\n\n[Content truncated...]"
+        result = f"**Page Content from {url}:**\n\n{content}"
+        
+    elif action == "screenshot":
+        # Generate unique filename
+        filename = f"screenshot_{uuid.uuid4().hex[:8]}.png"
+        filepath = os.path.join(SCREENSHOTS_DIR, filename)
+        
+        # Take full page screenshot
+        await page.screenshot(path=filepath, full_page=True)
+        
+        # Return markdown image link
+        result = f"**Screenshot captured from {url}:**\n\n![Screenshot](/static/screenshots/{filename})\n\nFile saved to: {filepath}"
+    
+    return result
+
+
 async def _browse_website_async(url: str, action: Literal["read", "screenshot"] = "read") -> str:
-    """Internal async function to browse websites using Playwright."""
+    """Browse with a one-off browser (used when the pool is not running)."""
     
     try:
         async with async_playwright() as p:
             # Launch headless browser
-            browser = await p.chromium.launch(
-                headless=True,
-                args=['--no-sandbox', '--disable-dev-shm-usage']
-            )
+            browser = await p.chromium.launch(headless=True, args=LAUNCH_ARGS)
             
             # Create context with realistic user agent
-            context = await browser.new_context(
-                user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                viewport={"width": 1280, "height": 720}
-            )
-            
-            # Create page and navigate
+            context = await browser.new_context(user_agent=USER_AGENT, viewport=VIEWPORT)
             page = await context.new_page()
             
             try:
-                await page.goto(url, wait_until="networkidle", timeout=30000)
-            except Exception:
-                # Fallback to domcontentloaded if networkidle times out
-                await page.goto(url, wait_until="domcontentloaded", timeout=30000)
-            
-            result = ""
-            
-            if action == "read":
-                # Extract text content from the page
-                content = await page.inner_text("body")
-                # Clean up and truncate if too long
-                content = content.strip()
-                if len(content) > 8000:
-                    content = content[:8000] + "\n\n[Content truncated...]"
-                result = f"**Page Content from {url}:**\n\n{content}"
-                
-            elif action == "screenshot":
-                # Generate unique filename
-                filename = f"screenshot_{uuid.uuid4().hex[:8]}.png"
-                filepath = os.path.join(SCREENSHOTS_DIR, filename)
-                
-                # Take full page screenshot
-                await page.screenshot(path=filepath, full_page=True)
-                
-                # Return markdown image link
-                result = f"**Screenshot captured from {url}:**\n\n![Screenshot](/static/screenshots/{filename})\n\nFile saved to: {filepath}"
-            
-            # Close browser to free resources
-            await browser.close()
-            
-            return result
+                return await _browse_page(page, url, action)
+            finally:
+                # Close browser to free resources
+                await browser.close()
             
     except Exception as e:
         return f"Browser error: {str(e)}"
 
 
-@tool
-def browse_website(url: str, action: str = "read") -> str:
+async def _browse_pooled(url: str, action: Literal["read", "screenshot"] = "read") -> str:
+    """Browse with a page borrowed from the shared browser pool."""
+    try:
+        async with get_browser_pool().page() as page:
+            return await _browse_page(page, url, action)
+    except asyncio.TimeoutError:
+        return "Browser error: all browser pages are busy, try again shortly."
+    except Exception as e:
+        return f"Browser error: {str(e)}"
+
+
+def _normalize_url(url: str) -> str:
+    # Validate URL structure
+    if not url.startswith(("http://", "https://")):
+        url = "https://" + url
+    return url
+
+
+def _check_resolved_host(hostname: str, ip: str) -> Optional[str]:
+    """Return an error message if the address is on an internal network."""
+    # Check for private IP ranges (Basic check)
+    is_private = ip.startswith("127.") or ip.startswith("10.") or ip.startswith("192.168.") or ip == "0.0.0.0"
+    if is_private or hostname in ["localhost", "0.0.0.0"]:
+        return f"Security Error: Access to internal network address ({hostname}) is BLOCKED."
+    return None
+
+
+def _validate_url(url: str) -> Tuple[str, Optional[str]]:
+    """🛡️ SECURITY: SSRF Protection. Returns (url, error)."""
+    url = _normalize_url(url)
+    try:
+        hostname = urlparse(url).hostname
+        if not hostname:
+            return url, "Error: Invalid URL"
+        
+        # Resolve IP to check for private networks
+        try:
+            ip = socket.gethostbyname(hostname)
+        except socket.gaierror:
+            return url, "Error: Could not resolve hostname"
+
+        return url, _check_resolved_host(hostname, ip)
+    except Exception as e:
+        return url, f"URL Validation Error: {str(e)}"
+
+
+async def _avalidate_url(url: str) -> Tuple[str, Optional[str]]:
+    """Async variant of _validate_url that resolves without blocking the loop."""
+    url = _normalize_url(url)
+    try:
+        hostname = urlparse(url).hostname
+        if not hostname:
+            return url, "Error: Invalid URL"
+        
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(hostname, None, family=socket.AF_INET)
+            ip = infos[0][4][0]
+        except (socket.gaierror, IndexError):
+            return url, "Error: Could not resolve hostname"
+
+        return url, _check_resolved_host(hostname, ip)
+    except Exception as e:
+        return url, f"URL Validation Error: {str(e)}"
+
+
+def _browse_website(url: str, action: str = "read") -> str:
     """Browse a website using a real headless browser that renders JavaScript.
     
     Use this tool to:
@@ -86,41 +151,45 @@ def browse_website(url: str, action: str = "read") -> str:
         For "read": The text content of the page.
         For "screenshot": A markdown image link to the captured screenshot.
     """
-    # Validate URL structure
-    if not url.startswith(("http://", "https://")):
-        url = "https://" + url
-
-    # 🛡️ SECURITY: SSRF Protection
+    url, error = _validate_url(url)
+    if error:
+        return error
+    
     try:
-        parsed = urlparse(url)
-        hostname = parsed.hostname
-        if not hostname:
-            return "Error: Invalid URL"
-        
-        # Resolve IP to check for private networks
-        try:
-            ip = socket.gethostbyname(hostname)
-        except socket.gaierror:
-             return "Error: Could not resolve hostname"
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
 
-        # Check for private IP ranges (Basic check)
-        is_private = ip.startswith("127.") or ip.startswith("10.") or ip.startswith("192.168.") or ip == "0.0.0.0"
-        if is_private or hostname in ["localhost", "0.0.0.0"]:
-            return f"Security Error: Access to internal network address ({hostname}) is BLOCKED."
-            
-    except Exception as e:
-        return f"URL Validation Error: {str(e)}"
-    
-    # Run async function
+    pool = get_browser_pool()
     try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            # If we're already in an async context, create a new task
-            import concurrent.futures
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(asyncio.run, _browse_website_async(url, action))
-                return future.result(timeout=60)
-        else:
+        if pool.running and pool.loop is not running_loop:
+            # Hand the work to the pool's event loop from this worker thread
+            future = asyncio.run_coroutine_threadsafe(_browse_pooled(url, action), pool.loop)
+            return future.result(timeout=60)
+        if running_loop is None:
             return asyncio.run(_browse_website_async(url, action))
+        # Called synchronously from inside an event loop: use a helper thread
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(asyncio.run, _browse_website_async(url, action))
+            return future.result(timeout=60)
     except Exception as e:
         return f"Browser execution error: {str(e)}"
+
+
+async def abrowse_website(url: str, action: str = "read") -> str:
+    """Async entry point for browse_website; runs on the caller's event loop."""
+    url, error = await _avalidate_url(url)
+    if error:
+        return error
+
+    pool = get_browser_pool()
+    if pool.running and pool.loop is asyncio.get_running_loop():
+        return await _browse_pooled(url, action)
+    return await _browse_website_async(url, action)
+
+
+browse_website = StructuredTool.from_function(
+    func=_browse_website,
+    coroutine=abrowse_website,
+    name="browse_website",
+)
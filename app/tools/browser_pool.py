@@ -0,0 +1,126 @@
+"""
+Long-lived headless Chromium service for browse_website.
+
+One browser process is launched with the FastAPI lifespan and shared by all
+browse calls; launching Chromium is the expensive part. Each call gets a
+fresh incognito context with a single page, closed when the call ends, so
+no cookies, storage, service workers or cache carry over between callers.
+A semaphore bounds how many pages are open at once.
+"""
+
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+
+from playwright.async_api import Browser, BrowserContext, Page, Playwright, async_playwright
+
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+VIEWPORT = {"width": 1280, "height": 720}
+LAUNCH_ARGS = ['--no-sandbox', '--disable-dev-shm-usage']
+
+
+@dataclass
+class BrowserPoolConfig:
+    """Configuration for the pooled browser."""
+    enabled: bool = True
+    # Maximum pages open at once
+    size: int = 4
+    # Seconds a caller waits for a free page
+    acquire_timeout: float = 30.0
+
+
+class BrowserPool:
+    """Bounded pages, each in its own context, on one shared Chromium process."""
+
+    def __init__(self, config: Optional[BrowserPoolConfig] = None):
+        self.config = config or BrowserPoolConfig()
+        self._load_env_config()
+        self._playwright: Optional[Playwright] = None
+        self._browser: Optional[Browser] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._launch_lock: Optional[asyncio.Lock] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _load_env_config(self):
+        """Load configuration from environment variables."""
+        if os.getenv("BROWSER_POOL_ENABLED"):
+            self.config.enabled = os.getenv("BROWSER_POOL_ENABLED").lower() != "false"
+        if os.getenv("BROWSER_POOL_SIZE"):
+            self.config.size = int(os.getenv("BROWSER_POOL_SIZE"))
+        if os.getenv("BROWSER_POOL_ACQUIRE_TIMEOUT_SEC"):
+            self.config.acquire_timeout = float(os.getenv("BROWSER_POOL_ACQUIRE_TIMEOUT_SEC"))
+
+    @property
+    def running(self) -> bool:
+        return self.loop is not None
+
+    async def start(self):
+        """Launch the shared browser on the current event loop."""
+        if self.running or not self.config.enabled:
+            return
+        self._playwright = await async_playwright().start()
+        try:
+            self._browser = await self._playwright.chromium.launch(headless=True, args=LAUNCH_ARGS)
+        except Exception:
+            await self._playwright.stop()
+            self._playwright = None
+            raise
+        self._slots = asyncio.Semaphore(max(1, self.config.size))
+        self._launch_lock = asyncio.Lock()
+        self.loop = asyncio.get_running_loop()
+
+    async def stop(self):
+        """Close the browser, and with it any page still borrowed."""
+        if not self.running:
+            return
+        self.loop = None
+        if self._browser is not None:
+            await self._browser.close()
+            self._browser = None
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+    async def _ensure_browser(self) -> Browser:
+        async with self._launch_lock:
+            if self._browser is None or not self._browser.is_connected():
+                # Chromium crashed: relaunch
+                self._browser = await self._playwright.chromium.launch(headless=True, args=LAUNCH_ARGS)
+            return self._browser
+
+    @asynccontextmanager
+    async def page(self) -> AsyncIterator[Page]:
+        """Borrow a page in a fresh context for the duration of the block."""
+        if not self.running:
+            raise RuntimeError("Browser pool is not running.")
+
+        await asyncio.wait_for(self._slots.acquire(), self.config.acquire_timeout)
+        context: Optional[BrowserContext] = None
+        try:
+            browser = await self._ensure_browser()
+            context = await browser.new_context(user_agent=USER_AGENT, viewport=VIEWPORT)
+            yield await context.new_page()
+        finally:
+            try:
+                if context is not None:
+                    # Drops the page with every bit of state the caller left behind
+                    await context.close()
+            except Exception:
+                pass
+            finally:
+                self._slots.release()
+
+
+# Singleton instance
+_browser_pool = None
+
+
+def get_browser_pool() -> BrowserPool:
+    """Get the global browser pool instance."""
+    global _browser_pool
+    if _browser_pool is None:
+        _browser_pool = BrowserPool()
+    return _browser_pool
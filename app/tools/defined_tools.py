@@ -1,8 +1,11 @@
 import os
+import time
 from typing import List, Optional
-from langchain_core.tools import tool
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import StructuredTool, tool
 from langchain_community.tools import DuckDuckGoSearchRun
-from app.sandbox import run_python_sandboxed
+from app.sandbox import run_python_sandboxed, arun_python_sandboxed
+from app.tools.search_cache import get_search_cache
 
 try:
     from tavily import TavilyClient
@@ -14,6 +17,9 @@ except ImportError:
 DATA_DIR = "./data"
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# What web_search returns when the provider found nothing
+NO_SEARCH_RESULTS = "No search results found."
+
 
 def _get_search_provider() -> str:
     """Determine which search provider to use based on config."""
@@ -63,14 +69,28 @@ def _search_with_tavily(query: str) -> str:
         content = item.get("content", "")[:300]
         results.append(f"{i}. **{title}**\n   {content}...\n   🔗 {url}\n")
     
-    return "\n".join(results) if results else "No search results found."
+    return "\n".join(results) if results else NO_SEARCH_RESULTS
 
 
 def _search_with_duckduckgo(query: str) -> str:
     """Search using DuckDuckGo (fallback, free)."""
     search_tool = DuckDuckGoSearchRun()
     results = search_tool.invoke(query)
-    return results if results else "No search results found."
+    return results if results else NO_SEARCH_RESULTS
+
+
+def _cached_search(provider: str, query: str) -> str:
+    """Run a provider search through the shared result cache."""
+    cache = get_search_cache()
+    cached = cache.get(provider, query)
+    if cached is not None:
+        return cached
+
+    search = _search_with_tavily if provider == "tavily" else _search_with_duckduckgo
+    start_time = time.time()
+    result = search(query)
+    cache.set(provider, query, result, time.time() - start_time, empty=result == NO_SEARCH_RESULTS)
+    return result
 
 
 @tool
@@ -88,16 +108,12 @@ def web_search(query: str) -> str:
     """
     try:
         provider = _get_search_provider()
-        
-        if provider == "tavily":
-            return _search_with_tavily(query)
-        else:
-            return _search_with_duckduckgo(query)
+        return _cached_search(provider, query)
             
     except Exception as e:
         # Fallback to DuckDuckGo if Tavily fails
         try:
-            return _search_with_duckduckgo(query)
+            return _cached_search("duckduckgo", query)
         except Exception as fallback_error:
             return f"Search error: {str(e)} | Fallback error: {str(fallback_error)}"
 
@@ -125,14 +141,28 @@ def file_writer(content: str, filename: str) -> str:
         return f"File write error: {str(e)}"
 
 
-@tool
-def python_repl(code: str) -> str:
+def _session_id(config: Optional[RunnableConfig]) -> Optional[str]:
+    return ((config or {}).get("configurable") or {}).get("thread_id")
+
+
+def _python_repl(code: str, config: RunnableConfig) -> str:
     """Execute Python code inside a sandboxed container.
 
     IMPORTANT: To persist files, write only to './data/' directory.
     Example: plt.savefig('./data/chart.png')
     """
-    return run_python_sandboxed(code)
+    return run_python_sandboxed(code, _session_id(config))
+
+
+async def _apython_repl(code: str, config: RunnableConfig) -> str:
+    return await arun_python_sandboxed(code, _session_id(config))
+
+
+python_repl = StructuredTool.from_function(
+    func=_python_repl,
+    coroutine=_apython_repl,
+    name="python_repl",
+)
 
 
 from app.tools.video_ops import get_youtube_transcript
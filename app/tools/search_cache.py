@@ -0,0 +1,228 @@
+"""
+Shared TTL/LRU cache for web_search results.
+
+Entries are keyed by provider plus the normalized query. The in-memory LRU
+is always used; setting SEARCH_CACHE_DB adds a SQLite file behind it so
+results survive restarts and are shared by every uvicorn worker on the host.
+
+Reads never write to SQLite one by one: the access times that drive its LRU
+eviction are collected in memory and flushed in one batch on the next store
+or once TOUCH_FLUSH_SECONDS have passed.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from app.metrics import get_metrics
+
+# Longest a batch of SQLite last_access updates waits to be written
+TOUCH_FLUSH_SECONDS = 30.0
+# Flush early once this many keys are waiting
+TOUCH_FLUSH_MAX_KEYS = 256
+
+
+@dataclass
+class SearchCacheConfig:
+    """Configuration for the search result cache."""
+    enabled: bool = True
+    # Seconds a cached result stays valid
+    ttl_seconds: float = 900.0
+    # Seconds an empty result stays valid, so a query that finds nothing now
+    # is retried soon; 0 disables caching empty results
+    empty_ttl_seconds: float = 30.0
+    # Maximum entries kept in memory (and in the SQLite file)
+    max_entries: int = 1024
+    # Optional SQLite file shared across workers and restarts
+    db_path: Optional[str] = None
+
+
+def normalize_query(query: str) -> str:
+    """Case-fold and collapse whitespace so trivially different queries share an entry."""
+    return " ".join(query.casefold().split())
+
+
+class SearchCache:
+    """Thread-safe TTL + LRU cache with an optional SQLite backing store."""
+
+    def __init__(self, config: Optional[SearchCacheConfig] = None):
+        self.config = config or SearchCacheConfig()
+        self._load_env_config()
+        self._lock = threading.Lock()
+        # key -> (expires_at, value, fetch_latency)
+        self._entries: "OrderedDict[str, Tuple[float, str, float]]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        # key -> last access time not yet written to SQLite
+        self._touched: Dict[str, float] = {}
+        self._touched_since = time.time()
+        if self.config.enabled and self.config.db_path:
+            self._db = self._open_db(self.config.db_path)
+
+    def _load_env_config(self):
+        """Load configuration from environment variables."""
+        if os.getenv("SEARCH_CACHE_ENABLED"):
+            self.config.enabled = os.getenv("SEARCH_CACHE_ENABLED").lower() != "false"
+        if os.getenv("SEARCH_CACHE_TTL_SEC"):
+            self.config.ttl_seconds = float(os.getenv("SEARCH_CACHE_TTL_SEC"))
+        if os.getenv("SEARCH_CACHE_EMPTY_TTL_SEC"):
+            self.config.empty_ttl_seconds = float(os.getenv("SEARCH_CACHE_EMPTY_TTL_SEC"))
+        if os.getenv("SEARCH_CACHE_MAX_ENTRIES"):
+            self.config.max_entries = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES"))
+        if os.getenv("SEARCH_CACHE_DB"):
+            self.config.db_path = os.getenv("SEARCH_CACHE_DB")
+
+    @staticmethod
+    def _open_db(path: str) -> sqlite3.Connection:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS search_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, latency REAL NOT NULL,"
+            " expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS search_cache_last_access ON search_cache (last_access)")
+        return db
+
+    def _key(self, provider: str, query: str) -> str:
+        return f"{provider}:{normalize_query(query)}"
+
+    def get(self, provider: str, query: str) -> Optional[str]:
+        """Return a cached result, or None on a miss."""
+        if not self.config.enabled:
+            return None
+
+        key = self._key(provider, query)
+        now = time.time()
+        hit = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    hit = entry
+                else:
+                    del self._entries[key]
+
+            if hit is None and self._db is not None:
+                hit = self._db_get(key, now)
+                if hit is not None:
+                    self._remember(key, hit)
+
+            if hit is not None and self._db is not None:
+                self._touch(key, now)
+
+        metrics = get_metrics()
+        if hit is None:
+            metrics.record_search_cache(provider, hit=False)
+            return None
+        metrics.record_search_cache(provider, hit=True, saved_seconds=hit[2])
+        return hit[1]
+
+    def set(self, provider: str, query: str, value: str, latency: float, empty: bool = False):
+        """
+        Store a fresh result together with how long it took to fetch.
+
+        Empty results (the provider found nothing) are kept for
+        empty_ttl_seconds only, or not at all when that is 0.
+        """
+        if not self.config.enabled:
+            return
+        ttl_seconds = self.config.empty_ttl_seconds if empty else self.config.ttl_seconds
+        if ttl_seconds <= 0:
+            return
+
+        key = self._key(provider, query)
+        now = time.time()
+        entry = (now + ttl_seconds, value, latency)
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                self._db_set(key, entry, now)
+
+    def clear(self):
+        """Drop every cached result."""
+        with self._lock:
+            self._entries.clear()
+            self._touched.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM search_cache")
+
+    def _remember(self, key: str, entry: Tuple[float, str, float]):
+        # Called with self._lock held
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.config.max_entries:
+            self._entries.popitem(last=False)
+
+    def _touch(self, key: str, now: float):
+        # Called with self._lock held
+        self._touched[key] = now
+        if len(self._touched) >= TOUCH_FLUSH_MAX_KEYS or now - self._touched_since >= TOUCH_FLUSH_SECONDS:
+            self._flush_touched(now)
+
+    def _flush_touched(self, now: float):
+        # Called with self._lock held
+        touched, self._touched = self._touched, {}
+        self._touched_since = now
+        if not touched:
+            return
+        try:
+            self._db.executemany(
+                "UPDATE search_cache SET last_access = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in touched.items()],
+            )
+        except sqlite3.Error as e:
+            print(f"Search cache write error: {e}")
+
+    def _db_get(self, key: str, now: float) -> Optional[Tuple[float, str, float]]:
+        try:
+            row = self._db.execute(
+                "SELECT expires_at, value, latency FROM search_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[0] <= now:
+                self._db.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+                return None
+            return row
+        except sqlite3.Error as e:
+            print(f"Search cache read error: {e}")
+            return None
+
+    def _db_set(self, key: str, entry: Tuple[float, str, float], now: float):
+        # Pending access times first, so eviction below sees the real LRU order
+        self._flush_touched(now)
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO search_cache (key, value, latency, expires_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, entry[1], entry[2], entry[0], now),
+            )
+            # Evict expired rows, then the least recently used beyond max_entries
+            self._db.execute("DELETE FROM search_cache WHERE expires_at <= ?", (now,))
+            self._db.execute(
+                "DELETE FROM search_cache WHERE key IN ("
+                " SELECT key FROM search_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.config.max_entries,),
+            )
+        except sqlite3.Error as e:
+            print(f"Search cache write error: {e}")
+
+
+# Singleton instance
+_search_cache = None
+
+
+def get_search_cache() -> SearchCache:
+    """Get the global search cache instance."""
+    global _search_cache
+    if _search_cache is None:
+        _search_cache = SearchCache()
+    return _search_cache
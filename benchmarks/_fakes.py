@@ -0,0 +1,66 @@
+"""
+Fake Groq stand-ins for the benchmark harness.
+
+The fakes sleep for a fixed latency instead of calling the provider, so the
+benchmarks measure Nabd's own scheduling and I/O overhead.
+"""
+
+import asyncio
+import json
+import time
+from typing import Any, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+class FakeGroq(BaseChatModel):
+    """Chat model that answers planner prompts with a plan and everything else with text."""
+
+    latency: float = 0.2
+    plan: List[Any] = ["step one"]
+    answer: str = "Benchmark answer from the fake model."
+    token_delay: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-groq"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _reply(self, messages: List[BaseMessage]) -> str:
+        if any("You are the Planner" in str(m.content) for m in messages):
+            return json.dumps({"plan": self.plan})
+        return self.answer
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs):
+        await asyncio.sleep(self.latency)
+        for word in self._reply(messages).split(" "):
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+def install_fake_llm(model: FakeGroq):
+    """Route every graph node to `model` instead of the pooled Groq clients."""
+    from app.agent import graph
+
+    graph.get_llm = lambda model_name="llama-3.1-8b-instant": model
+    graph.get_tool_llm = lambda model_name="llama-3.1-8b-instant": model
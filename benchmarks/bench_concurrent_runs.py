@@ -0,0 +1,80 @@
+"""
+Concurrent /run capacity of a single worker: sync nodes vs async nodes.
+
+Drives the FastAPI app in-process (one event loop, like one uvicorn worker)
+with a fake LLM that sleeps for --latency seconds per call. With sync nodes
+every in-flight run holds a thread from the default executor, so latency
+climbs once concurrency passes the pool size; async nodes only hold a
+coroutine.
+
+Usage:
+    python -m benchmarks.bench_concurrent_runs --latency 0.2 --levels 8,32,128,256
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+import httpx
+
+from benchmarks._fakes import FakeGroq, install_fake_llm
+
+
+async def _run_level(client: httpx.AsyncClient, concurrency: int) -> list:
+    async def one() -> float:
+        start = time.perf_counter()
+        response = await client.post("/run", json={"message": "benchmark"})
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    return await asyncio.gather(*(one() for _ in range(concurrency)))
+
+
+def _p95(values: list) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * 0.95))]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.2, help="fake LLM latency per call (seconds)")
+    parser.add_argument("--levels", default="8,32,64,128,256", help="comma-separated concurrency levels")
+    parser.add_argument("--slo", type=float, default=1.5, help="p95 budget as a multiple of the unloaded latency")
+    args = parser.parse_args()
+
+    install_fake_llm(FakeGroq(latency=args.latency))
+
+    from app.main import app
+    from app.agent.graph import create_agent_workflow
+
+    levels = [int(level) for level in args.levels.split(",")]
+    transport = httpx.ASGITransport(app=app)
+
+    print(f"{'nodes':<6} {'concurrency':>11} {'p50 (s)':>9} {'p95 (s)':>9} {'req/s':>8}")
+    for use_async in (False, True):
+        label = "async" if use_async else "sync"
+        app.state.agent_app = create_agent_workflow(use_async=use_async).compile()
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            baseline = statistics.median(await _run_level(client, 1))
+            sustained = 0
+            for concurrency in levels:
+                start = time.perf_counter()
+                latencies = await _run_level(client, concurrency)
+                elapsed = time.perf_counter() - start
+                p95 = _p95(latencies)
+                print(f"{label:<6} {concurrency:>11} {statistics.median(latencies):>9.3f} "
+                      f"{p95:>9.3f} {concurrency / elapsed:>8.1f}")
+                if p95 <= baseline * args.slo:
+                    sustained = concurrency
+
+        print(f"{label:<6} sustains {sustained} concurrent /run requests "
+              f"(p95 <= {args.slo}x unloaded {baseline:.3f}s)\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,123 @@
+"""
+Cost of one metric update, and thread safety of the metrics core.
+
+Times Histogram.observe and Counter.inc through the label-dict API and
+through a pre-bound `labels(...)` child, next to the previous
+implementation (reproduced below: a Python loop over the buckets and a
+sorted label tuple per call). Then hammers one counter and one histogram
+from several threads and checks that no update was lost.
+
+Usage:
+    python -m benchmarks.bench_metrics_core --iterations 200000 --threads 8
+"""
+
+import argparse
+import os
+import threading
+import time
+from collections import defaultdict
+
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+from app.metrics import Counter, Histogram
+
+
+class LegacyHistogram:
+    """The histogram this repo used before."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+    def __init__(self):
+        self._values = defaultdict(lambda: {"buckets": defaultdict(float), "sum": 0.0, "count": 0})
+
+    def observe(self, value: float, labels: dict = None):
+        entry = self._values[tuple(sorted((labels or {}).items()))]
+        for bucket in self.BUCKETS:
+            if value <= bucket:
+                entry["buckets"][bucket] += 1
+        entry["sum"] += value
+        entry["count"] += 1
+
+
+class LegacyCounter:
+    """The counter this repo used before."""
+
+    def __init__(self):
+        self._values = defaultdict(float)
+
+    def inc(self, labels: dict = None, value: float = 1.0):
+        self._values[tuple(sorted((labels or {}).items()))] += value
+
+
+def _time(func, iterations: int) -> float:
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(i)
+    return (time.perf_counter() - start) / iterations * 1e9
+
+
+def _single_thread(iterations: int):
+    labels = {"method": "POST", "path": "/run"}
+    # Values spread over the bucket range, including the +Inf bucket
+    values = [0.003, 0.04, 0.3, 2.0, 20.0]
+
+    legacy_histogram = LegacyHistogram()
+    histogram = Histogram("bench_seconds", "bench", labels=["method", "path"])
+    child_histogram = histogram.labels(method="POST", path="/run")
+    legacy_counter = LegacyCounter()
+    counter = Counter("bench_total", "bench", labels=["method", "path"])
+    child_counter = counter.labels(method="POST", path="/run")
+
+    cases = [
+        ("histogram", "legacy", lambda i: legacy_histogram.observe(values[i % 5], labels)),
+        ("histogram", "labels dict", lambda i: histogram.observe(values[i % 5], labels)),
+        ("histogram", "bound child", lambda i: child_histogram.observe(values[i % 5])),
+        ("counter", "legacy", lambda i: legacy_counter.inc(labels)),
+        ("counter", "labels dict", lambda i: counter.inc(labels)),
+        ("counter", "bound child", lambda i: child_counter.inc()),
+    ]
+    print(f"{'metric':>10} {'api':>12} {'ns/update':>10}")
+    for metric, api, func in cases:
+        print(f"{metric:>10} {api:>12} {_time(func, iterations):>10.0f}")
+
+
+def _threaded(iterations: int, threads: int) -> bool:
+    counter = Counter("bench_threads_total", "bench", labels=["worker"])
+    histogram = Histogram("bench_threads_seconds", "bench")
+    shared = counter.labels(worker="shared")
+
+    def work():
+        for _ in range(iterations):
+            shared.inc()
+            histogram.observe(0.1)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    expected = iterations * threads
+    counted = counter.collect()[0]["value"]
+    observed = histogram.collect()[0]["count"]
+    ok = counted == expected and observed == expected
+    print(f"\n{threads} threads x {iterations} updates in {elapsed:.2f}s: "
+          f"counter={counted:.0f} histogram={observed} expected={expected} -> {'ok' if ok else 'LOST UPDATES'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200000, help="updates per measurement")
+    parser.add_argument("--threads", type=int, default=8, help="threads in the thread-safety check")
+    args = parser.parse_args()
+
+    _single_thread(args.iterations)
+    if not _threaded(args.iterations // 4, args.threads):
+        raise SystemExit("metrics lost updates under concurrent use")
+
+
+if __name__ == "__main__":
+    main()
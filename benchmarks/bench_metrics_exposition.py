@@ -0,0 +1,109 @@
+"""
+Scrape cost of /metrics with about 10k series.
+
+Fills a registry with --series label sets (60% counters, 30% histograms,
+10% gauges) and formats it with the previous format_prometheus
+(reproduced below: labels formatted from dicts, buckets sorted and one
+joined string per scrape) and with the current cached, streamed
+exposition. Reports time per scrape, the first scrape (which fills the
+label cache) separately, the peak traced memory and the gzip size.
+
+Usage:
+    python -m benchmarks.bench_metrics_exposition --series 10000 --scrapes 20
+"""
+
+import argparse
+import os
+import time
+import tracemalloc
+import zlib
+
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+from app.metrics import MetricsConfig, NabdMetrics, _batched, _gzipped
+
+
+def legacy_format(metrics: NabdMetrics) -> str:
+    """The format_prometheus this repo used before."""
+    lines = []
+    for kind, group in (("counter", metrics._counters()), ("gauge", metrics._gauges())):
+        for metric in group:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            for item in metric.collect():
+                labels_str = ",".join(f'{k}="{v}"' for k, v in item["labels"].items())
+                lines.append(f'{metric.name}{{{labels_str}}} {item["value"]}')
+    for metric in metrics._histograms():
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} histogram")
+        for item in metric.collect():
+            labels_str = ",".join(f'{k}="{v}"' for k, v in item["labels"].items())
+            for bucket, count in sorted(item["buckets"].items()):
+                le = "+Inf" if bucket == float("inf") else str(bucket)
+                bucket_labels = f'{labels_str},le="{le}"' if labels_str else f'le="{le}"'
+                lines.append(f'{metric.name}_bucket{{{bucket_labels}}} {count}')
+            lines.append(f'{metric.name}_sum{{{labels_str}}} {item["sum"]}')
+            lines.append(f'{metric.name}_count{{{labels_str}}} {item["count"]}')
+    return "\n".join(lines)
+
+
+def _populate(series: int) -> NabdMetrics:
+    metrics = NabdMetrics(MetricsConfig(max_series=series))
+    for i in range(series * 6 // 10):
+        metrics.http_requests_total.inc({"method": "GET", "path": f"/route/{i}", "status": "200"}, i)
+    for i in range(series * 3 // 10):
+        metrics.http_request_duration_seconds.observe(i % 7 * 0.05, {"method": "POST", "path": f"/route/{i}"})
+    for i in range(series // 10):
+        metrics.active_connections.set(i % 5, {"endpoint": f"/route/{i}"})
+    return metrics
+
+
+def _streamed(metrics: NabdMetrics) -> int:
+    return sum(len(chunk) for chunk in _batched(metrics.iter_exposition()))
+
+
+def _measure(func, scrapes: int) -> tuple:
+    start = time.perf_counter()
+    for _ in range(scrapes):
+        func()
+    elapsed_ms = (time.perf_counter() - start) / scrapes * 1e3
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed_ms, peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--series", type=int, default=10000, help="label sets across all metrics")
+    parser.add_argument("--scrapes", type=int, default=20, help="scrapes per measurement")
+    args = parser.parse_args()
+
+    metrics = _populate(args.series)
+    start = time.perf_counter()
+    body = metrics.format_prometheus().encode("utf-8")
+    first_ms = (time.perf_counter() - start) * 1e3
+    lines = body.count(b"\n")
+    gzipped = b"".join(_gzipped([body]))
+    assert zlib.decompress(gzipped, 16 + zlib.MAX_WBITS) == body
+
+    print(f"{args.series} series, {lines} lines, {len(body) / 1024:.0f} KiB "
+          f"({len(gzipped) / 1024:.0f} KiB gzipped)\n")
+    print(f"{'exposition':>22} {'ms/scrape':>10} {'peak KiB':>9}")
+    cases = [
+        ("legacy", lambda: legacy_format(metrics)),
+        ("cached, first scrape", None),
+        ("cached, streamed", lambda: _streamed(metrics)),
+        ("cached, streamed+gzip", lambda: sum(len(c) for c in _gzipped(_batched(metrics.iter_exposition())))),
+    ]
+    for name, func in cases:
+        if func is None:
+            print(f"{name:>22} {first_ms:>10.1f} {'-':>9}")
+            continue
+        elapsed_ms, peak_kib = _measure(func, args.scrapes)
+        print(f"{name:>22} {elapsed_ms:>10.1f} {peak_kib:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Per-request cost of the rate-limit + metrics middleware stack.
+
+Calls the ASGI app directly (no HTTP client or server in the loop) for a
+plain JSON route and a 50-chunk streaming route, through:
+
+- no middleware
+- the previous BaseHTTPMiddleware implementations (reproduced below)
+- the current pure ASGI RateLimitMiddleware and MetricsMiddleware
+
+The rate limiter runs enabled with limits high enough to never reject.
+
+Usage:
+    python -m benchmarks.bench_middleware_overhead --requests 5000
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from typing import Callable
+
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+os.environ["RATE_LIMIT_ENABLED"] = "true"
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from app.metrics import MetricsMiddleware, NabdMetrics
+from app.rate_limiter import RateLimitConfig, RateLimiter, RateLimitMiddleware
+
+
+class LegacyRateLimitMiddleware(BaseHTTPMiddleware):
+    """The dispatch-based rate limiter this repo used before."""
+
+    def __init__(self, app, rate_limiter: RateLimiter):
+        super().__init__(app)
+        self.rate_limiter = rate_limiter
+
+    async def dispatch(self, request: Request, call_next: Callable):
+        env = os.getenv("ENV", "development").lower()
+        rate_limit_enabled = os.getenv("RATE_LIMIT_ENABLED", "auto").lower()
+        if rate_limit_enabled == "false" or (rate_limit_enabled == "auto" and env != "production"):
+            return await call_next(request)
+        _, rate_info = self.rate_limiter.is_allowed(request)
+        response = await call_next(request)
+        for key, value in rate_info.items():
+            response.headers[key] = value
+        return response
+
+
+class LegacyMetricsMiddleware(BaseHTTPMiddleware):
+    """The dispatch-based metrics middleware this repo used before."""
+
+    def __init__(self, app, metrics: NabdMetrics):
+        super().__init__(app)
+        self.metrics = metrics
+
+    async def dispatch(self, request: Request, call_next: Callable):
+        start_time = time.time()
+        path = request.url.path
+        self.metrics.active_connections.inc({"endpoint": path})
+        try:
+            response = await call_next(request)
+            self.metrics.record_http_request(request.method, path, response.status_code, time.time() - start_time)
+            return response
+        finally:
+            self.metrics.active_connections.dec({"endpoint": path})
+
+
+def _build_app(stack: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/json")
+    async def json_route():
+        return {"status": "ok"}
+
+    @app.get("/stream")
+    async def stream_route():
+        async def body():
+            for _ in range(50):
+                yield b"data: token\n\n"
+        return StreamingResponse(body(), media_type="text/event-stream")
+
+    limiter = RateLimiter(RateLimitConfig(anonymous_rpm=10**9, anonymous_concurrency=10**6, burst_ratio=1.0))
+    if stack == "legacy":
+        app.add_middleware(LegacyRateLimitMiddleware, rate_limiter=limiter)
+        app.add_middleware(LegacyMetricsMiddleware, metrics=NabdMetrics())
+    elif stack == "asgi":
+        app.add_middleware(RateLimitMiddleware, rate_limiter=limiter)
+        app.add_middleware(MetricsMiddleware, metrics=NabdMetrics())
+    return app
+
+
+async def _call(app, path: str):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": b"", "root_path": "", "headers": [(b"host", b"bench")],
+        "client": ("127.0.0.1", 1234), "server": ("bench", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+async def _measure(app, path: str, requests: int) -> float:
+    for _ in range(200):
+        await _call(app, path)
+    start = time.perf_counter()
+    for _ in range(requests):
+        await _call(app, path)
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000, help="sequential requests per measurement")
+    args = parser.parse_args()
+
+    print(f"{'route':>7} {'stack':>7} {'us/request':>11} {'overhead us':>12}")
+    for path in ("/json", "/stream"):
+        baseline = None
+        for stack in ("none", "legacy", "asgi"):
+            micros = await _measure(_build_app(stack), path, args.requests)
+            baseline = micros if baseline is None else baseline
+            print(f"{path:>7} {stack:>7} {micros:>11.1f} {micros - baseline:>12.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+"""
+Cost of is_allowed() with the memory and shm rate-limit backends.
+
+Starts --workers processes that each build their own RateLimiter (as each
+uvicorn worker does) and hammer is_allowed() for the same client for
+--duration seconds, then reports the calls made and the mean time per
+call. With shm every call takes the table's lock, so contention between
+workers shows up here. That the shared table actually holds the workers to
+the configured limit is checked by tests/test_rate_limit_shm.py.
+
+Usage:
+    python -m benchmarks.bench_shared_rate_limit --workers 4 --rpm 600 --duration 3
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+from app.rate_limiter import RateLimitConfig, RateLimiter
+
+
+def _request(client: str):
+    # is_allowed() only reads the path, headers and client address
+    return SimpleNamespace(
+        url=SimpleNamespace(path="/run"),
+        headers={"X-Forwarded-For": client},
+        client=None,
+    )
+
+
+def _worker(backend: str, shm_path: str, rpm: int, window: int, start_at: float, duration: float, results):
+    config = RateLimitConfig(anonymous_rpm=rpm, window_seconds=window, backend=backend, shm_path=shm_path)
+    limiter = RateLimiter(config)
+    request = _request("203.0.113.7")
+    allowed = attempts = 0
+    busy = 0.0
+    while time.time() < start_at:
+        time.sleep(0.001)
+    while time.time() < start_at + duration:
+        attempts += 1
+        call_start = time.perf_counter()
+        admitted = limiter.is_allowed(request)[0]
+        busy += time.perf_counter() - call_start
+        if admitted:
+            allowed += 1
+    results.put((allowed, attempts, busy))
+
+
+def _run(backend: str, args, shm_path: str) -> tuple:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    start_at = time.time() + 2.0
+    workers = [
+        context.Process(
+            target=_worker,
+            args=(backend, shm_path, args.rpm, args.window, start_at, args.duration, results),
+        )
+        for _ in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    counts = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    return sum(c[0] for c in counts), sum(c[1] for c in counts), sum(c[2] for c in counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4, help="worker processes")
+    parser.add_argument("--rpm", type=int, default=600, help="requests allowed per window")
+    parser.add_argument("--window", type=int, default=60, help="window length in seconds")
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds each worker sends requests")
+    args = parser.parse_args()
+
+    print(f"{args.workers} workers, {args.rpm} req/{args.window}s, {args.duration:g}s run\n")
+    print(f"{'backend':>8} {'admitted':>9} {'calls':>10} {'calls/s':>10} {'us/call':>8}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        shm_path = os.path.join(directory, "ratelimit")
+        for backend in ("memory", "shm"):
+            admitted, attempts, busy = _run(backend, args, shm_path)
+            rate = attempts / args.duration
+            per_call = busy / attempts * 1e6 if attempts else 0.0
+            print(f"{backend:>8} {admitted:>9} {attempts:>10} {rate:>10.0f} {per_call:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
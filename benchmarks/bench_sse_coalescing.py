@@ -0,0 +1,126 @@
+"""
+Frames sent vs CPU spent for concurrent SSE streams.
+
+Runs --streams concurrent /run/stream-shaped responses through a FastAPI
+app with the metrics middleware, called directly over ASGI; every body
+message is written to a socket (one send syscall per frame, as the server
+would do). Each stream emits --tokens model tokens --gap-ms apart.
+Compares the previous
+behaviour (one frame and one ASGI send per token) with SSEEmitter at
+several flush intervals, reporting frames sent, frames per second, CPU
+time per token, and the worst delay a token waited in the buffer.
+
+Usage:
+    python -m benchmarks.bench_sse_coalescing --streams 200 --tokens 200 --gap-ms 5
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import time
+
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+from app.metrics import MetricsMiddleware, NabdMetrics
+from app.sse import SSEConfig, SSEEmitter, SSEFrame, format_sse
+
+
+class Stats:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.max_wait = 0.0
+        # perf_counter time of the oldest token not yet sent, per stream
+        self.pending = {}
+
+
+def _build_app(args, flush_interval_ms, stats: Stats) -> FastAPI:
+    app = FastAPI()
+
+    async def tokens(stream_id: int):
+        yield SSEFrame(str(stream_id), event="session")
+        for i in range(args.tokens):
+            await asyncio.sleep(args.gap_ms / 1000)
+            stats.pending.setdefault(stream_id, time.perf_counter())
+            yield SSEFrame(f"tok{i} ", merge=True)
+        yield SSEFrame("[DONE]")
+
+    async def legacy(stream_id: int):
+        async for frame in tokens(stream_id):
+            yield format_sse(frame.data, frame.event)
+
+    @app.get("/stream/{stream_id}")
+    async def stream(stream_id: int):
+        if flush_interval_ms is None:
+            body = legacy(stream_id)
+        else:
+            emitter = SSEEmitter(SSEConfig(flush_interval_ms=flush_interval_ms, heartbeat_sec=0))
+            body = emitter.stream(tokens(stream_id))
+        return StreamingResponse(body, media_type="text/event-stream")
+
+    app.add_middleware(MetricsMiddleware, metrics=NabdMetrics())
+    return app
+
+
+async def _call(app, stream_id: int, stats: Stats):
+    path = f"/stream/{stream_id}"
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": b"", "root_path": "", "headers": [(b"host", b"bench")],
+        "client": ("127.0.0.1", 1234), "server": ("bench", 80),
+    }
+
+    async def receive():
+        await asyncio.sleep(3600)
+
+    client, server = socket.socketpair()
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            # A few KiB per stream in total, well within the socket buffer
+            server.sendall(message["body"])
+            stats.frames += 1
+            stats.bytes += len(message["body"])
+            produced = stats.pending.pop(stream_id, None)
+            if produced is not None:
+                stats.max_wait = max(stats.max_wait, time.perf_counter() - produced)
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        client.close()
+        server.close()
+
+
+async def _run(args, flush_interval_ms) -> tuple:
+    stats = Stats()
+    app = _build_app(args, flush_interval_ms, stats)
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    await asyncio.gather(*(_call(app, i, stats) for i in range(args.streams)))
+    return stats, time.process_time() - cpu_start, time.perf_counter() - wall_start
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=200, help="concurrent streams")
+    parser.add_argument("--tokens", type=int, default=200, help="tokens per stream")
+    parser.add_argument("--gap-ms", type=float, default=5.0, help="delay between a stream's tokens")
+    args = parser.parse_args()
+
+    total_tokens = args.streams * args.tokens
+    print(f"{args.streams} streams x {args.tokens} tokens, one token every {args.gap_ms:g} ms per stream\n")
+    print(f"{'writer':>16} {'frames':>8} {'frames/s':>9} {'CPU s':>7} {'CPU us/token':>13} {'max wait ms':>12}")
+    for name, interval in (("per token", None), ("emitter 0 ms", 0.0), ("emitter 20 ms", 20.0),
+                           ("emitter 50 ms", 50.0)):
+        stats, cpu, wall = await _run(args, interval)
+        print(f"{name:>16} {stats.frames:>8} {stats.frames / wall:>9.0f} {cpu:>7.2f} "
+              f"{cpu / total_tokens * 1e6:>13.1f} {stats.max_wait * 1e3:>12.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
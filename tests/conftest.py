@@ -0,0 +1,9 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# app.main refuses to import without a key; no test talks to Groq
+os.environ.setdefault("GROQ_API_KEY", "test-key")
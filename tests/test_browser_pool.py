@@ -0,0 +1,91 @@
+"""Browser state never carries over from one borrow of the pool to the next."""
+
+import asyncio
+
+import pytest
+
+from app.tools.browser_pool import BrowserPool, BrowserPoolConfig
+
+
+class FakeContext:
+    def __init__(self):
+        self.closed = False
+
+    async def new_page(self):
+        return ("page", self)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeBrowser:
+    def __init__(self):
+        self.contexts = []
+
+    def is_connected(self):
+        return True
+
+    async def new_context(self, **kwargs):
+        context = FakeContext()
+        self.contexts.append(context)
+        return context
+
+
+def _fake_pool(browser: FakeBrowser) -> BrowserPool:
+    pool = BrowserPool(BrowserPoolConfig(size=2))
+    pool._browser = browser
+    pool._slots = asyncio.Semaphore(2)
+    pool._launch_lock = asyncio.Lock()
+    pool.loop = asyncio.get_running_loop()
+    return pool
+
+
+def test_each_borrow_gets_a_fresh_context():
+    browser = FakeBrowser()
+
+    async def scenario():
+        pool = _fake_pool(browser)
+        pages = []
+        for _ in range(3):
+            async with pool.page() as page:
+                pages.append(page)
+        return pages
+
+    pages = asyncio.run(scenario())
+
+    assert len(browser.contexts) == 3
+    assert len({id(context) for _, context in pages}) == 3
+    assert all(context.closed for context in browser.contexts)
+
+
+def test_storage_does_not_leak_between_borrows():
+    async def scenario():
+        pool = BrowserPool(BrowserPoolConfig(size=1))
+        try:
+            await pool.start()
+        except Exception as exc:
+            pytest.skip(f"Chromium is not available: {exc}")
+        try:
+            # A real origin is needed for storage; serve a blank page for it
+            async def blank(route):
+                await route.fulfill(status=200, content_type="text/html", body="<html></html>")
+
+            async with pool.page() as page:
+                await page.route("https://example.test/**", blank)
+                await page.goto("https://example.test/")
+                await page.evaluate("localStorage.setItem('who', 'first'); sessionStorage.setItem('who', 'first')")
+                await page.context.add_cookies([{"name": "who", "value": "first", "url": "https://example.test/"}])
+
+            async with pool.page() as page:
+                await page.route("https://example.test/**", blank)
+                await page.goto("https://example.test/")
+                stored = await page.evaluate("[localStorage.getItem('who'), sessionStorage.getItem('who')]")
+                cookies = await page.context.cookies()
+            return stored, cookies
+        finally:
+            await pool.stop()
+
+    stored, cookies = asyncio.run(scenario())
+
+    assert stored == [None, None]
+    assert cookies == []
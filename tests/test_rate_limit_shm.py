@@ -0,0 +1,69 @@
+"""Workers sharing one shm rate-limit table admit no more than the configured limit in total."""
+
+import math
+import multiprocessing
+import os
+import time
+from types import SimpleNamespace
+
+from app.rate_limiter import RateLimitConfig, RateLimiter
+
+WORKERS = 4
+RPM = 600
+WINDOW = 60
+DURATION = 1.5
+
+
+def _request(client: str):
+    # is_allowed() only reads the path, headers and client address
+    return SimpleNamespace(
+        url=SimpleNamespace(path="/run"),
+        headers={"X-Forwarded-For": client},
+        client=None,
+    )
+
+
+def _worker(shm_path: str, start_at: float, results):
+    # A limiter of its own, as each uvicorn worker builds
+    config = RateLimitConfig(anonymous_rpm=RPM, window_seconds=WINDOW, backend="shm", shm_path=shm_path)
+    limiter = RateLimiter(config)
+    request = _request("203.0.113.7")
+    allowed = attempts = 0
+    while time.time() < start_at:
+        time.sleep(0.001)
+    while time.time() < start_at + DURATION:
+        attempts += 1
+        if limiter.is_allowed(request)[0]:
+            allowed += 1
+    results.put((allowed, attempts))
+
+
+def test_workers_share_one_limit(tmp_path, monkeypatch):
+    # RATE_LIMIT_* would override the config below in the (inherited) worker environment
+    for name in [name for name in os.environ if name.startswith("RATE_LIMIT_")]:
+        monkeypatch.delenv(name)
+
+    config = RateLimitConfig(anonymous_rpm=RPM, window_seconds=WINDOW)
+    interval = WINDOW / RPM
+    burst = max(1, math.ceil(RPM * config.burst_ratio))
+    # +1: the request at exactly the last interval boundary may be admitted
+    ceiling = burst + math.floor(DURATION / interval) + 1
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    start_at = time.time() + 2.0
+    workers = [
+        context.Process(target=_worker, args=(str(tmp_path / "ratelimit"), start_at, results))
+        for _ in range(WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    counts = [results.get(timeout=30) for _ in workers]
+    for worker in workers:
+        worker.join(timeout=10)
+
+    admitted = sum(allowed for allowed, _ in counts)
+    attempts = sum(tried for _, tried in counts)
+    # Every worker kept trying well past the limit, so the shared table is what held them back
+    assert attempts > WORKERS * ceiling
+    assert 0 < admitted <= ceiling
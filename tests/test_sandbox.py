@@ -0,0 +1,61 @@
+"""Warm containers are not leaked when the caller is cancelled."""
+
+import asyncio
+import time
+
+from app import sandbox
+
+
+class SlowPool:
+    """Pool whose acquire blocks for a while, like waiting on an empty queue."""
+
+    def __init__(self):
+        self.discarded = []
+
+    def acquire(self, timeout: float):
+        time.sleep(0.2)
+        return "warm-1"
+
+    def discard(self, container: str):
+        self.discarded.append(container)
+
+
+def test_cancelled_acquire_discards_container(monkeypatch):
+    pool = SlowPool()
+    monkeypatch.setattr(sandbox, "get_sandbox_pool", lambda: pool)
+
+    async def scenario():
+        task = asyncio.create_task(sandbox._aacquire_warm_container())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        await asyncio.sleep(0.4)
+
+    asyncio.run(scenario())
+
+    assert pool.discarded == ["warm-1"]
+
+
+def test_container_goes_back_to_the_pool_that_handed_it_out(monkeypatch):
+    pool, replacement = SlowPool(), SlowPool()
+    monkeypatch.setattr(sandbox, "get_sandbox_pool", lambda: pool)
+
+    async def scenario():
+        task = asyncio.create_task(sandbox._aacquire_warm_container())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        # The pool is closed and the singleton rebuilt while the worker still waits
+        monkeypatch.setattr(sandbox, "get_sandbox_pool", lambda: replacement)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        await asyncio.sleep(0.4)
+
+    asyncio.run(scenario())
+
+    assert pool.discarded == ["warm-1"]
+    assert replacement.discarded == []
@@ -0,0 +1,95 @@
+"""The process sandbox only lets user code write to its workspace and data/."""
+
+import os
+import sys
+import time
+
+import pytest
+
+from app.sandbox_process import ProcessLimits, run_process
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="process sandbox is Linux-only")
+
+NAMESPACES_MISSING = "cannot confine the filesystem"
+
+
+def _run(code: str, data_dir: str):
+    result = run_process(code, ProcessLimits(), 20, data_dir)
+    if NAMESPACES_MISSING in result.stderr:
+        pytest.skip("user and mount namespaces are not available on this host")
+    return result
+
+
+def test_writes_outside_workspace_fail(tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    outside = tmp_path / "outside.txt"
+    code = (
+        "import os\n"
+        f"open({str(outside)!r}, 'w').write('x')\n"
+    )
+
+    result = _run(code, str(data_dir))
+
+    assert "Read-only file system" in result.stderr or "No such file" in result.stderr
+    assert not outside.exists()
+
+
+def test_host_files_are_hidden(tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    secret = os.path.abspath(__file__)
+
+    result = _run(f"print(open({secret!r}).read())", str(data_dir))
+
+    assert "FileNotFoundError" in result.stderr
+    assert "test_host_files_are_hidden" not in result.stdout
+
+
+def test_workspace_and_data_stay_writable(tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    code = (
+        "open('scratch.txt', 'w').write('a')\n"
+        "open('data/result.txt', 'w').write('b')\n"
+        "print(open('scratch.txt').read() + open('data/result.txt').read())\n"
+    )
+
+    result = _run(code, str(data_dir))
+
+    assert result.stdout.strip() == "ab", result.stderr
+    assert (data_dir / "result.txt").read_text() == "b"
+
+
+def test_timeout_kills_detached_descendants(tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    heartbeat = data_dir / "heartbeat"
+    code = (
+        "import os, time\n"
+        "if os.fork() == 0:\n"
+        "    os.setsid()\n"
+        "    if os.fork() == 0:\n"
+        "        # Let go of the output pipes so only the kill can stop it\n"
+        "        null = os.open(os.devnull, os.O_RDWR)\n"
+        "        for fd in (0, 1, 2):\n"
+        "            os.dup2(null, fd)\n"
+        "        # Kept open: the workspace (and its data/ link) is removed after the run\n"
+        "        beat = os.open('data/heartbeat', os.O_WRONLY | os.O_CREAT | os.O_APPEND)\n"
+        "        while True:\n"
+        "            os.write(beat, b'.')\n"
+        "            time.sleep(0.05)\n"
+        "    os._exit(0)\n"
+        "time.sleep(60)\n"
+    )
+
+    result = run_process(code, ProcessLimits(), 1, str(data_dir))
+    if NAMESPACES_MISSING in result.stderr:
+        pytest.skip("user and mount namespaces are not available on this host")
+
+    assert result.timed_out
+    assert heartbeat.exists()
+    time.sleep(0.3)
+    beats = heartbeat.stat().st_size
+    time.sleep(0.5)
+    assert heartbeat.stat().st_size == beats
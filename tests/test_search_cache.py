@@ -0,0 +1,49 @@
+"""Empty search results expire quickly, and cache hits do not write to SQLite one by one."""
+
+import time
+
+from app.tools.search_cache import SearchCache, SearchCacheConfig
+
+
+def make_cache(tmp_path, **overrides) -> SearchCache:
+    cache = SearchCache(SearchCacheConfig(db_path=str(tmp_path / "search_cache.sqlite"), **overrides))
+    # The constructor reads the environment over the config we passed
+    for name, value in overrides.items():
+        setattr(cache.config, name, value)
+    return cache
+
+
+def test_empty_results_use_the_short_ttl(tmp_path):
+    cache = make_cache(tmp_path, empty_ttl_seconds=0.2)
+    cache.set("duckduckgo", "nothing here", "No search results found.", 0.5, empty=True)
+    cache.set("duckduckgo", "something", "1. a result", 0.5)
+
+    assert cache.get("duckduckgo", "nothing here") is not None
+    time.sleep(0.3)
+    assert cache.get("duckduckgo", "nothing here") is None
+    assert cache.get("duckduckgo", "something") == "1. a result"
+
+
+def test_empty_results_not_cached_when_disabled(tmp_path):
+    cache = make_cache(tmp_path, empty_ttl_seconds=0)
+    cache.set("duckduckgo", "nothing here", "No search results found.", 0.5, empty=True)
+
+    assert cache.get("duckduckgo", "nothing here") is None
+
+
+def test_memory_hits_batch_last_access_updates(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.set("tavily", "query", "result", 1.0)
+
+    statements = []
+    cache._db.set_trace_callback(statements.append)
+    for _ in range(50):
+        assert cache.get("tavily", "query") == "result"
+    assert statements == []
+
+    # The next store writes the pending access time before evicting
+    cache.set("tavily", "other", "result", 1.0)
+    updates = [sql for sql in statements if sql.startswith("UPDATE")]
+    assert len(updates) == 1
+    row = cache._db.execute("SELECT last_access FROM search_cache WHERE key = 'tavily:query'").fetchone()
+    assert row[0] > time.time() - 5
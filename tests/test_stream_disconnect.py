@@ -0,0 +1,99 @@
+"""A client disconnecting from a streamed run cancels the run."""
+
+import asyncio
+import json
+import time
+
+import pytest
+
+from benchmarks._fakes import FakeGroq, install_fake_llm
+
+
+# Start times of the model calls made by CountingGroq
+MODEL_CALLS: list = []
+
+
+class CountingGroq(FakeGroq):
+    """FakeGroq that records the model calls it starts."""
+
+    async def _agenerate(self, *args, **kwargs):
+        MODEL_CALLS.append(time.monotonic())
+        return await super()._agenerate(*args, **kwargs)
+
+    async def _astream(self, *args, **kwargs):
+        MODEL_CALLS.append(time.monotonic())
+        async for chunk in super()._astream(*args, **kwargs):
+            yield chunk
+
+
+async def _post_and_disconnect(app, path: str, body: dict, disconnect_after: float) -> list:
+    """POST to the ASGI app as a spec-2.4 server would, then drop the connection."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json"), (b"host", b"testserver")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+        "state": {},
+    }
+    payload = json.dumps(body).encode()
+    sent_body = False
+    started = time.monotonic()
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        await asyncio.sleep(max(0.0, started + disconnect_after - time.monotonic()))
+        return {"type": "http.disconnect"}
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages
+
+
+def _cancelled_runs() -> float:
+    from app.metrics import get_metrics
+
+    return sum(sample["value"] for sample in get_metrics().agent_runs_cancelled_total.collect())
+
+
+@pytest.mark.parametrize("path, body", [
+    ("/run/stream", {"message": "hi"}),
+    ("/run", {"message": "hi", "stream": True}),
+])
+def test_disconnect_cancels_streamed_run(path, body):
+    install_fake_llm(CountingGroq(latency=0.3, plan=["s1", "s2", "s3"], token_delay=0.05))
+    from app import main
+
+    async def scenario():
+        MODEL_CALLS.clear()
+        cancelled = _cancelled_runs()
+        started = time.monotonic()
+        messages = await _post_and_disconnect(main.app, path, body, disconnect_after=0.2)
+        elapsed = time.monotonic() - started
+        calls = len(MODEL_CALLS)
+        # Nothing keeps running once the response has ended
+        await asyncio.sleep(0.5)
+        return messages, elapsed, calls, _cancelled_runs() - cancelled
+
+    messages, elapsed, calls, cancelled = asyncio.run(scenario())
+
+    text = b"".join(m.get("body", b"") for m in messages if m["type"] == "http.response.body")
+    assert b"[DONE]" not in text
+    # The full pipeline takes well over a second with this model
+    assert elapsed < 1.0
+    assert len(MODEL_CALLS) == calls
+    assert cancelled == 1